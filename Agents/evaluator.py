@@ -20,6 +20,8 @@ from time import time as curtime
 from Utils.tensor_section_functions import *
 
 from Utils.adaptive_batchsize import get_optimized_batchsize
+from Utils.amp import autocast
+from Utils.distributed import is_distributed, shard_range, all_reduce_sum, all_gather_cat, broadcast_buffers
 from Dataset.samplers import PosNegPairSampler
 
 
@@ -35,6 +37,11 @@ class ReIDEvaluator:
         self.galleryFliploader = galleryFliploader
         self.ranks = ranks
 
+    def _run(self, *inputs, mode):
+        """the model under autocast when opt.amp, its outputs are returned in float32"""
+        with autocast(next(self.model.parameters()).device, self.opt.amp):
+            return tensor_float(self.model(*inputs, mode=mode))
+
     def _save_top10_results(self, distmat, g_pids, q_pids, g_camids, q_camids, fig_dir):
         print("Saving visualization figures")
 
@@ -147,8 +154,8 @@ class ReIDEvaluator:
             num_rel.append(m.sum())
             results.append(m[:max_rank].unsqueeze(0))
 
-        matches = torch.cat(results, dim=0).cuda()
-        num_rel = torch.Tensor(num_rel).cuda()
+        matches = tensor_cuda(torch.cat(results, dim=0))
+        num_rel = tensor_cuda(torch.Tensor(num_rel))
 
         # num_rel = torch.sum(matches, dim=(1,))
         # matches = matches[:, :max_rank]
@@ -157,7 +164,7 @@ class ReIDEvaluator:
         cmc[cmc > 1] = 1
         all_cmc = cmc.sum(dim=0) / cmc.size(0)
 
-        pos = torch.Tensor(range(1, max_rank + 1)).cuda()
+        pos = tensor_cuda(torch.Tensor(range(1, max_rank + 1)))
         temp_cmc = matches.cumsum(dim=1) / pos * matches
         AP = temp_cmc.sum(dim=1) / num_rel
         mAP = AP.sum() / AP.size(0)
@@ -206,7 +213,7 @@ class ReIDEvaluator:
     @staticmethod
     def _parse_data(inputs):
         imgs, pids, camids = inputs
-        return imgs.cuda(), pids, camids
+        return tensor_cuda(imgs), pids, camids
 
     def _compare_features(self, a, b):
         l_a = tensor_size(a, 0)
@@ -217,13 +224,14 @@ class ReIDEvaluator:
 
         # cur_idx_a = -1
         with torch.no_grad():
-            fun = lambda a, b: self.model(a, b, mode='metric').view(-1)
+            fun = lambda a, b: self._run(a, b, mode='metric').view(-1)
             batch_size = get_optimized_batchsize(fun, slice_tensor(a, [0]), slice_tensor(b, [0]))
             # batch_size = min(batch_size, l_b)
 
-            task_num = l_a * l_b
-            for start in range(0, task_num, batch_size):
-                end = min(start + batch_size, task_num)
+            # the processes of the distributed training compare a shard of the pairs each
+            shard_start, shard_end = shard_range(l_a * l_b)
+            for start in range(shard_start, shard_end, batch_size):
+                end = min(start + batch_size, shard_end)
                 a_indices = tasks[0][start:end]
                 b_indices = tasks[1][start:end]
                 sub_fa = slice_tensor(a, a_indices)
@@ -232,39 +240,54 @@ class ReIDEvaluator:
                 scores = fun(sub_fa, sub_fb).cpu()
                 score_mat[a_indices, b_indices] = scores
 
-        return score_mat
+        return all_reduce_sum(score_mat)
 
-    def compare_features_symmetry(self, a):
+    @staticmethod
+    def _lower_triangle(start, end):
+        """(i, j) of the flat indices [start, end) of the lower triangle (with the diagonal), row by row"""
+        t = np.arange(start, end, dtype=np.int64)
+        i = ((np.sqrt(8. * t + 1.) - 1.) / 2.).astype(np.int64)
+        # correct the rounding errors of sqrt
+        i[i * (i + 1) // 2 > t] -= 1
+        i[(i + 1) * (i + 2) // 2 <= t] += 1
+        j = t - i * (i + 1) // 2
+        return i, j
+
+    def iter_scores_symmetry(self, a, tile_size=1 << 21):
+        """scores of the lower triangular pairs (with the diagonal) of a, yielded as (i, j, scores) tiles of
+        tile_size pairs, so that the N x N matrix is never held"""
         self.model.eval()
-        # only compute the lower triangular of the distmat
         l_a = tensor_size(a, 0)
-        score_mat = torch.zeros(l_a, l_a)
-
-        task_1 = []
-        task_2 = []
-        for i in range(l_a):
-            sub_1 = [i, ] * (i + 1)
-            sub_2 = [k for k in range(i + 1)]
-            task_1.extend(sub_1)
-            task_2.extend(sub_2)
-
-        task_num = len(task_1)
-        tasks = [task_1, task_2]
+        task_num = l_a * (l_a + 1) // 2
 
         with torch.no_grad():
-            fun = lambda x, y: self.model(x, y, mode='metric').view(-1)
+            fun = lambda x, y: self._run(x, y, mode='metric').view(-1)
             batch_size = get_optimized_batchsize(fun, slice_tensor(a, [0]), slice_tensor(a, [0]))
 
-            for start in range(0, task_num, batch_size):
-                end = min(start + batch_size, task_num)
-                a_indices = tasks[0][start:end]
-                b_indices = tasks[1][start:end]
-                sub_fa = slice_tensor(a, a_indices)
-                sub_fb = slice_tensor(a, b_indices)
-                sub_fa, sub_fb = tensor_cuda((sub_fa, sub_fb))
-                scores = fun(sub_fa, sub_fb).cpu().float()
-                score_mat[a_indices, b_indices] = scores
-                score_mat[b_indices, a_indices] = scores
+            for tile_start in range(0, task_num, tile_size):
+                tile_end = min(tile_start + tile_size, task_num)
+                a_indices, b_indices = self._lower_triangle(tile_start, tile_end)
+                a_tensor, b_tensor = torch.from_numpy(a_indices), torch.from_numpy(b_indices)
+                scores = np.empty(tile_end - tile_start, dtype=np.float32)
+                for start in range(0, tile_end - tile_start, batch_size):
+                    end = min(start + batch_size, tile_end - tile_start)
+                    sub_fa = slice_tensor(a, a_tensor[start:end])
+                    sub_fb = slice_tensor(a, b_tensor[start:end])
+                    sub_fa, sub_fb = tensor_cuda((sub_fa, sub_fb))
+                    scores[start:end] = fun(sub_fa, sub_fb).cpu().float().numpy()
+                yield a_indices, b_indices, scores
+
+    def compare_features_symmetry(self, a):
+        # only compute the lower triangular of the distmat
+        l_a = tensor_size(a, 0)
+        score_mat = torch.zeros(l_a, l_a)
+
+        for a_indices, b_indices, scores in self.iter_scores_symmetry(a):
+            a_indices = torch.from_numpy(a_indices)
+            b_indices = torch.from_numpy(b_indices)
+            scores = torch.from_numpy(scores)
+            score_mat[a_indices, b_indices] = scores
+            score_mat[b_indices, a_indices] = scores
 
         return score_mat
 
@@ -286,7 +309,7 @@ class ReIDEvaluator:
         tasks = [task_1, task_2]
 
         with torch.no_grad():
-            fun = lambda a, b: self.model(a, b, mode='y')
+            fun = lambda a, b: self._run(a, b, mode='y')
             batch_size = get_optimized_batchsize(fun, slice_tensor(features, [0]), slice_tensor(features, [0]))
 
             for start in range(0, task_num, batch_size):
@@ -329,7 +352,7 @@ class ReIDEvaluator:
         tasks = [task_1, task_2]
 
         with torch.no_grad():
-            fun = lambda a, b: self.model(a, b, mode='iy')
+            fun = lambda a, b: self._run(a, b, mode='iy')
             batch_size = get_optimized_batchsize(fun, slice_tensor(features, [0]), slice_tensor(features, [0]))
 
             for start in range(0, task_num, batch_size):
@@ -361,17 +384,20 @@ class ReIDEvaluator:
         tasks = [np.arange(l_a).repeat(l_b), np.tile(np.arange(l_b), l_a)]
 
         with torch.no_grad():
-            fun = lambda a, b: self.model(a, b, mode='normal').view(-1)
+            fun = lambda a, b: self._run(a, b, mode='normal').view(-1)
             one_ima = slice_tensor(next(iter(loader_a))[0], [0])
             one_imb = slice_tensor(next(iter(loader_b))[0], [0])
             batch_size = get_optimized_batchsize(fun, one_ima, one_imb)
             del one_ima, one_imb
+            # the processes of the distributed training compare a shard of the pairs each
+            shard_start, shard_end = shard_range(l_a * l_b)
+            tasks = [t[shard_start:shard_end] for t in tasks]
             self._change_batchsize(loader_a, batch_size)
             self._change_batchsize(loader_b, batch_size)
             self._change_sampler(loader_a, tasks[0])
             self._change_sampler(loader_b, tasks[1])
 
-            task_num = l_a * l_b
+            task_num = len(tasks[0])
             cur_idx = 0
             for (ima_s, _, _), (imb_s, _, _) in zip(loader_a, loader_b):
                 ima_s = tensor_cuda(ima_s)
@@ -381,7 +407,7 @@ class ReIDEvaluator:
                 score_mat[tasks[0][cur_idx:end], tasks[1][cur_idx:end]] = scores
                 cur_idx = end
 
-        return score_mat
+        return all_reduce_sum(score_mat)
 
     @staticmethod
     def _change_batchsize(dataloader, batch_size):
@@ -402,16 +428,22 @@ class ReIDEvaluator:
         dataloader.batch_sampler.drop_last = False
         dataloader._DataLoader__initialized = True
 
-    def _get_feature(self, dataloader):
+    def _get_feature(self, dataloader, reduce=None):
+        """reduce: applied to the features of each batch on the device, before they are moved to cpu"""
         with torch.no_grad():
-            fun = lambda d: self.model(d, None, mode='extract')
+            fun = lambda d: self._run(d, None, mode='extract')
             batch_size = get_optimized_batchsize(fun, slice_tensor(next(iter(dataloader))[0], [0]))
             batch_size = min(batch_size, len(dataloader))
             self._change_batchsize(dataloader, batch_size)
+            if is_distributed():
+                # each process extracts a contiguous shard, gathered in order
+                self._change_sampler(dataloader, list(range(*shard_range(len(dataloader.dataset)))))
 
-            features = [tensor_cpu(fun(tensor_cuda(data))) for data, _, _ in dataloader]
+            if reduce is None:
+                reduce = lambda f: f
+            features = [tensor_cpu(reduce(fun(tensor_cuda(data)))) for data, _, _ in dataloader]
             features = cat_tensors(features, dim=0)  # torch.cat(features, dim=0)
-        return features
+        return all_gather_cat(features)
 
     def evaluate(self, eval_flip=False, re_ranking=False):
         q_pids, q_camids, g_pids, g_camids = self._get_labels()
@@ -444,6 +476,8 @@ class ReIDEvaluator:
 
     def _get_dist_matrix(self, flip_fuse=False, re_ranking=False):
         self.model.eval()
+        # the shards of the distributed evaluation should see the same BN statistics
+        broadcast_buffers(self.model)
         if flip_fuse:
             print('**** flip fusion based distance matrix ****')
 
@@ -1,25 +1,34 @@
 # encoding: utf-8
+import json
 import os
-import random
 import time
+from contextlib import contextmanager
 from pprint import pprint
 
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from PIL import Image, ImageDraw, ImageFont
 from prettytable import PrettyTable
-from sklearn import preprocessing
-from sklearn import svm
-from sklearn.metrics import confusion_matrix
+from torch.utils.checkpoint import checkpoint
 
-from Dataset.attributes import get_market_attributes
+from Dataset.attributes import AttributeTable, LABEL2WORD
+from Dataset.samplers import HardPairMining, loader_sampler_state, load_loader_sampler_state
+from Utils.amp import autocast, get_grad_scaler, fp32_criterion
 from Utils.meters import AverageMeter
-from Utils.serialization import save_best_model, save_current_status, get_best_model
+from Utils.prefetcher import DevicePrefetcher
+from Utils.serialization import save_best_model, save_current_status, get_best_model, save_step_status, \
+    remove_step_status, get_rng_states, set_rng_states
 from Utils.standard_actions import print_time
-from Utils.tensor_section_functions import slice_tensor, tensor_size, tensor_cuda, tensor_cpu
+from Utils.tensor_section_functions import slice_tensor, tensor_size, tensor_cuda, tensor_cpu, tensor_detach
 from Utils.loss import CrossSimilarityLBCELoss
 from Utils.summary_writers import SummaryWriters
+from Utils.threshold_search import ThresholdSearch, worst_class_recall
+from Utils.attribute_probe import probe_attributes
+from Utils.distributed import average_gradients, all_gather_object, broadcast_buffers, get_rank, all_gather_cat, \
+    all_gather_cat_with_grad
+from Utils.pair_statistics import AttributePairStatistics
+from Utils.feature_collection import collect_features
+from Utils.pair_canvas import select_pairs, render_pair_canvases, PAIRS_NUM, LEFT, GREEN, RED
 
 from SampleRateLearning.serialization import save_current_srl_status
 from SampleRateLearning.loss import SRL_BCELoss
@@ -29,6 +38,21 @@ from Models.braidnet.primitives_v2.blocks import Pair2Bi, Bi2Pair
 from WeightModification.recentralize import recentralize
 
 
+@contextmanager
+def frozen_bn(model, enabled=True):
+    """the BN layers of model (those with running statistics) normalize by their running statistics,
+    without updating them, as in eval mode, while the other layers keep their mode"""
+    layers = [m for m in model.modules() if m.training and getattr(m, 'running_mean', None) is not None] \
+        if enabled else []
+    for m in layers:
+        m.training = False
+    try:
+        yield
+    finally:
+        for m in layers:
+            m.training = True
+
+
 class _Trainer:
     def __init__(self, opt, train_loader, evaluator, optimzier, lr_strategy,
                  criterion,  phase_num=1, done_epoch=0):
@@ -39,6 +63,10 @@ class _Trainer:
         self.optimizer = optimzier
         self.lr_strategy = lr_strategy
         self.criterion = criterion
+        self.device = next(self.model.parameters()).device
+        self.scaler = get_grad_scaler(self.device, opt.amp)
+        if opt.amp:
+            fp32_criterion(self.criterion)
 
         self.recorder = SummaryWriters(opt)
 
@@ -47,6 +75,7 @@ class _Trainer:
         self.best_epoch = best_epoch
         self.phase_num = phase_num
         self.done_epoch = done_epoch
+        self.step_state = None
 
     @print_time
     def continue_train(self):
@@ -78,11 +107,50 @@ class _Trainer:
         self.evaluate(eval_flip)
         print('The whole process should be terminated.')
 
+    def _resumes(self, epoch):
+        """whether epoch continues from a step checkpoint, the model of which is already in the middle of it"""
+        return self.step_state is not None and self.step_state['epoch'] == epoch
+
+    def _step_states(self, step):
+        # the samplers are the same on all the processes, but the rngs of augmentation and dropout differ
+        extra_states = {'sampler': loader_sampler_state(self.train_loader, step),
+                        'rng': all_gather_object(get_rng_states()) if self.opt.distributed else get_rng_states()}
+        if self.opt.srl:
+            extra_states['criterion'] = self.criterion.state_dict()
+            extra_states['criterion_optimizer'] = self.criterion.optimizer.state_dict()
+        if self.scaler.is_enabled():
+            extra_states['scaler'] = self.scaler.state_dict()
+        return extra_states
+
+    def _save_step_state(self, epoch, step):
+        save_step_status(self.model, self.optimizer, self.opt.exp_dir, epoch, step, **self._step_states(step))
+
+    def _load_step_state(self, state):
+        """the model and the optimizer have been restored by get_model_with_optimizer, returns the step"""
+        load_loader_sampler_state(self.train_loader, state['sampler'])
+        rng_states = state['rng']
+        if isinstance(rng_states, list):
+            # saved by several processes
+            rng_states = rng_states[get_rank() % len(rng_states)]
+        set_rng_states(rng_states)
+        if self.opt.srl:
+            self.criterion.load_state_dict(state['criterion'])
+            self.criterion.optimizer.load_state_dict(state['criterion_optimizer'])
+            self.criterion.pos_rate = self.criterion.alpha.sigmoid()
+            self.criterion.sampler.update(self.criterion.pos_rate)
+        if 'scaler' in state:
+            self.scaler.load_state_dict(state['scaler'])
+
+        print('resume epoch {0} from step {1}'.format(state['epoch'], state['step']))
+        return state['step']
+
     def _train(self, epoch):
         """Note: epoch should start with 1"""
 
+        # the epoch-start changes of the model are already in the model of a step checkpoint
+        resumes = self._resumes(epoch)
         try:
-            if epoch == self.opt.freeze_pretrained_untill:
+            if epoch == self.opt.freeze_pretrained_untill and not resumes:
                 print('no longer freeze pretrained params (if there were any pretrained params)!')
                 self.model.module.unlable_pretrained()
                 self.optimizer = self.model.module.get_optimizer(optim=self.opt.optim,
@@ -102,25 +170,42 @@ class _Trainer:
         if self.opt.srl and self.opt.srl_syn_lr:
             self.lr_strategy(self.criterion.optimizer, epoch)
 
-        if self.opt.wrc:
-            recentralize(self.model)
+        start_step = 0
+        if resumes:
+            start_step = self._load_step_state(self.step_state)
+        else:
+            if self.opt.wrc:
+                recentralize(self.model)
 
-        global_step = (epoch - 1) * len(self.train_loader)
-        self.recorder.record(model=self.model,
-                             criterion=self.criterion,
-                             optimizer=self.optimizer,
-                             global_step=global_step)
+            global_step = (epoch - 1) * len(self.train_loader)
+            self.recorder.record(model=self.model,
+                                 criterion=self.criterion,
+                                 optimizer=self.optimizer,
+                                 global_step=global_step)
+        self.step_state = None
 
-        for i, inputs in enumerate(self.train_loader):
+        if self.opt.device_prefetch:
+            train_loader = DevicePrefetcher(self.train_loader, self.device)
+        else:
+            train_loader = self.train_loader
+
+        samples_num = 0
+        for i, inputs in enumerate(train_loader, start_step):
             data_time.update(time.time() - start)
             # model optimizing
             self._parse_data(inputs)
-            self._forward()
+            with autocast(self.device, self.opt.amp):
+                self._forward()
             self.optimizer.zero_grad()
             self._backward()
-            self.optimizer.step()
+            if self.opt.distributed:
+                average_gradients(self.model)
+            # with amp on CUDA, the gradients are unscaled and the step is skipped if they overflowed
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
 
             losses.update(self.loss.item())
+            samples_num += tensor_size(self.data, 0)
 
             # tensorboard
             global_step = (epoch - 1) * len(self.train_loader) + i
@@ -130,6 +215,10 @@ class _Trainer:
                                  loss=self.loss,
                                  global_step=global_step)
 
+            if self.opt.step_checkpoint > 0 and (i + 1) % self.opt.step_checkpoint == 0 \
+                    and i + 1 < len(self.train_loader):
+                self._save_step_state(epoch, i + 1)
+
             batch_time.update(time.time() - start)
             start = time.time()
 
@@ -143,13 +232,27 @@ class _Trainer:
 
             correction_factor = ((pos_rate * (1 - pos_rate)) ** 0.5) * 2.
 
-            print('Epoch: [{}]\tEpoch Time {:.0f} s\tLoss {:.6f}\t'
+            print('Epoch: [{}]\tEpoch Time {:.0f} s\tData Wait {:.0f} s\tCompute {:.0f} s\tLoss {:.6f}\t'
                   'Calibrated Loss {:.6f}\tLr {:.2e}'
-                  .format(epoch, batch_time.sum, losses.mean, losses.mean/correction_factor, cur_lr))
+                  .format(epoch, batch_time.sum, data_time.sum, batch_time.sum - data_time.sum,
+                          losses.mean, losses.mean/correction_factor, cur_lr))
         else:
-            print('Epoch: [{}]\tEpoch Time {:.0f} s\tLoss {:.6f}\t'
+            print('Epoch: [{}]\tEpoch Time {:.0f} s\tData Wait {:.0f} s\tCompute {:.0f} s\tLoss {:.6f}\t'
                   'Lr {:.2e}'
-                  .format(epoch, batch_time.sum, losses.mean, cur_lr))
+                  .format(epoch, batch_time.sum, data_time.sum, batch_time.sum - data_time.sum,
+                          losses.mean, cur_lr))
+
+        # the throughput, with rank-1 below, for comparing the precisions (opt.amp) of a model
+        samples_per_second = samples_num / max(batch_time.sum - data_time.sum, 1e-12)
+        self.recorder.summary_writer.add_scalar('samples_per_second', samples_per_second, epoch)
+        print('{0:.1f} samples/s in computation ({1})'.format(samples_per_second,
+                                                              'mixed precision' if self.opt.amp else 'float32'))
+
+        read_failures = getattr(self.train_loader.dataset, 'read_failures', None)
+        if read_failures is not None:
+            self.recorder.summary_writer.add_scalar('image_read_failures', read_failures, epoch)
+            if read_failures > 0:
+                print('{} images failed to be read so far'.format(read_failures))
 
         if isinstance(self.criterion, CrossSimilarityLBCELoss):
             print(
@@ -161,6 +264,7 @@ class _Trainer:
 
         if self.opt.eval_step > 0 and epoch % self.opt.eval_step == 0 or epoch == self.opt.max_epoch:
             rank1 = self.evaluate(eval_flip=False)
+            self.recorder.summary_writer.add_scalar('rank1', rank1, epoch)
 
             if rank1 > self.best_rank1:
                 save_best_model(self.model, exp_dir=self.opt.exp_dir, epoch=epoch, rank1=rank1)
@@ -170,6 +274,7 @@ class _Trainer:
         save_current_status(self.model, self.optimizer, self.opt.exp_dir, epoch, self.opt.eval_step)
         if self.opt.srl:
             save_current_srl_status(self.criterion, self.opt.exp_dir, epoch, self.opt.eval_step)
+        remove_step_status(self.opt.exp_dir)
 
     @print_time
     def evaluate(self, eval_flip=None):
@@ -180,45 +285,18 @@ class _Trainer:
             rank1 = self.evaluator.evaluate(re_ranking=self.opt.re_ranking, eval_flip=eval_flip)
             return rank1
 
-    def _get_feature_with_id(self, dataloader, norm=True, return_im_path=False, sub_num=-1):
+    def _get_feature_with_id(self, dataloader, norm=True, return_im_path=False, sub_num=-1, memmap_path=None):
         self.model.eval()
+        tpaths = [p for p, _, _ in dataloader.dataset.dataset]
         with torch.no_grad():
             # mode = 'half' if self.opt.model_name in ['aabraidosnet', ] else 'extract'
             mode = 'extract'
-            fun = lambda d: self.model(d, None, mode=mode)
-            records = [(tensor_cpu(fun(tensor_cuda(data))), identity) for data, identity, _ in dataloader]
-            tpaths = [p for p, _, _ in dataloader.dataset.dataset]
-
-            features = []
-            ids = []
-            paths = []
-            cur_i = -1
-            for features_, ids_ in records:
-                features_ = features_.tolist()
-                ids_ = [str(i.item()) for i in ids_]
-                for id_, feature_ in zip(ids_, features_):
-                    cur_i += 1
-                    if id_ == '0':
-                        continue
-                    features.append(feature_)
-                    ids.append(id_)
-                    paths.append(tpaths[cur_i])
-
-        # shuffle
-        num = len(ids)
-        indices = [i for i in range(num)]
-        random.shuffle(indices)
-        if sub_num >= 0:
-            indices = indices[:sub_num]
-        features = [features[i] for i in indices]
-        ids = [ids[i] for i in indices]
-        paths = [paths[i] for i in indices]
-
-        features = np.array(features)
-        if norm:
-            features = preprocessing.scale(features)
+            fun = lambda d: tensor_cpu(self.model(tensor_cuda(d), None, mode=mode)).float().numpy()
+            features, ids, rows = collect_features(fun, dataloader, len(tpaths), norm=norm, sub_num=sub_num,
+                                                   memmap_path=memmap_path)
 
         if return_im_path:
+            paths = [tpaths[i] for i in rows]
             return features, ids, paths
         else:
             return features, ids
@@ -236,66 +314,55 @@ class _Trainer:
             data_loader = self.train_loader
         elif set_name == 'test':
             data_loader = self.evaluator.queryloader  # has already been merged with galleryloader
+        start = time.time()
         features, ids = self._get_feature_with_id(data_loader)
+        extract_time = time.time() - start
 
         sample_num = len(features)
         split_border = sample_num // 2 + 1
-        features_train = features[:split_border]
-        features_test = features[split_border:]
-
-        attributes, label2word = get_market_attributes(set_name=set_name)
 
-        attribute_ids = attributes.pop('image_index')
-        index_map = [attribute_ids.index(i) for i in ids]
-
-        attributes_new = dict()
-        for key, label in attributes.items():
-            label_new = [label[i] for i in index_map]
-            attributes_new[key] = np.array(label_new)
+        attributes_new = AttributeTable(set_name=set_name).columns(ids)
+        label2word = LABEL2WORD
 
         field_names = ('Attribute', 'Accuracy', 'The Worst Precision')
         table = PrettyTable(field_names=field_names)
 
-        x = []
-        y = []
+        tasks = []
         for key, labels in attributes_new.items():
-            labels_train = labels[:split_border]
-            labels_test = labels[split_border:]
             classes = set(labels)
             for class_ in classes:
                 if len(classes) == 2 and class_ == 1:
                     continue
-                # print('checking the discriminant for the label {0} of {1}'.format(class_, key))
-                print('checking the discriminant for {0} ...'.format(label2word[key][class_]))
-                hitted_train = (labels_train == class_).astype(int)
-                hitted_test = (labels_test == class_).astype(int)
+                hitted = (labels == class_).astype(int)
+                hitted_train = hitted[:split_border]
                 if sum(hitted_train) == 0 or sum(hitted_train) == len(hitted_train):
-                    print('skip it due to missing pos/neg samples')
-                    print()
+                    print('skip {0} due to missing pos/neg samples'.format(label2word[key][class_]))
                     continue
+                tasks.append((label2word[key][class_], hitted))
 
-                model = svm.SVC(kernel='linear', max_iter=1000000)
-                model.fit(features_train, hitted_train)
-                prediction = model.predict(features_test)
-
-                cm = confusion_matrix(y_pred=prediction, y_true=hitted_test)
-                accuracy = float(cm[1, 1] + cm[0, 0]) / float(cm[0, 0] + cm[0, 1] + cm[1, 1] + cm[1, 0])
-                precision_pos = float(cm[1, 1]) / float(cm[1, 1] + cm[1, 0])
-                precision_neg = float(cm[0, 0]) / float(cm[0, 0] + cm[0, 1])
-                worst_precision = min(precision_pos, precision_neg)
-
-                table.add_row([label2word[key][class_],
-                               '{0:.3%}'.format(accuracy),
-                               '{0:.3%}'.format(worst_precision)])
-
-                x.append(label2word[key][class_])
-                y.append(worst_precision * 100)
+        print('fitting the discriminants for {0} attribute classes ...'.format(len(tasks)))
+        start = time.time()
+        results = probe_attributes(features, tasks, split_border,
+                                   solver=self.opt.probe_solver, workers=self.opt.probe_workers)
+        probe_time = time.time() - start
 
-                print('accuracy: {0:.3%}'.format(accuracy))
-                print('worst_precision: {0:.3%}'.format(worst_precision))
-                print('confusion matrix:')
-                pprint(cm)
-                print()
+        x = []
+        y = []
+        for result in results:
+            table.add_row([result['name'],
+                           '{0:.3%}'.format(result['accuracy']),
+                           '{0:.3%}'.format(result['worst_precision'])])
+
+            x.append(result['name'])
+            y.append(result['worst_precision'] * 100)
+
+            print(result['name'])
+            print('accuracy: {0:.3%}'.format(result['accuracy']))
+            print('worst_precision: {0:.3%}'.format(result['worst_precision']))
+            print('confusion matrix:')
+            pprint(result['confusion_matrix'])
+            print('fitted in {0:.2f}s'.format(result['fit_time']))
+            print()
 
         print(table)
 
@@ -319,6 +386,14 @@ class _Trainer:
         plt.savefig(os.path.join(save_dir, '{0}_DA_{1}_extract_v9.png'.format(self.opt.exp_name, set_name)))
         plt.close()
 
+        with open(os.path.join(save_dir, '{0}_DA_{1}_extract_v9.json'.format(self.opt.exp_name, set_name)), 'w') as f:
+            json.dump({'solver': self.opt.probe_solver,
+                       'sample_num': sample_num,
+                       'feature_dim': int(features.shape[1]),
+                       'extract_time': extract_time,
+                       'probe_time': probe_time,
+                       'results': results}, f, indent=2)
+
         print('The whole process should be terminated.')
 
     @print_time
@@ -341,19 +416,15 @@ class _Trainer:
         features_train = features[:split_border]
         features_test = features[split_border:]
 
-        attributes, label2word = get_market_attributes(set_name=set_name)
-
-        attribute_ids = attributes.pop('image_index')
-        index_map = [attribute_ids.index(i) for i in ids]
-
-        attributes_new = dict()
-        for key, label in attributes.items():
-            label_new = [label[i] for i in index_map]
-            attributes_new[key] = np.array(label_new)
+        attributes_new = AttributeTable(set_name=set_name).columns(ids)
+        label2word = LABEL2WORD
 
         field_names = ('Attribute', 'The Best Worst Precision')
         table = PrettyTable(field_names=field_names)
 
+        # the best 1-D linear classifier of each feature is a threshold, searched for all the features at once
+        threshold_search = ThresholdSearch(features_train)
+
         x = []
         y = []
         for key, labels in attributes_new.items():
@@ -372,23 +443,9 @@ class _Trainer:
                     print()
                     continue
 
-                feature_length = features_train.shape[1]
-                best_worst_precision = 0.
-                for i in range(feature_length):
-                    # print('{0}/{1}'.format(i + 1, feature_length))
-                    features_train_one = features_train[:, i]
-                    features_test_one = features_test[:, i]
-
-                    model = svm.SVC(kernel='linear', max_iter=100000)
-                    model.fit(features_train_one.reshape(-1, 1), hitted_train)
-                    prediction = model.predict(features_test_one.reshape(-1, 1))
-
-                    cm = confusion_matrix(y_pred=prediction, y_true=hitted_test)
-                    precision_pos = float(cm[1, 1]) / float(cm[1, 1] + cm[1, 0])
-                    precision_neg = float(cm[0, 0]) / float(cm[0, 0] + cm[0, 1])
-                    worst_precision = min(precision_pos, precision_neg)
-
-                    best_worst_precision = max(best_worst_precision, worst_precision)
+                thresholds, directions = threshold_search.fit(hitted_train)
+                worst_precisions = worst_class_recall(features_test, hitted_test, thresholds, directions)
+                best_worst_precision = max(float(np.nanmax(worst_precisions)), 0.)
 
                 table.add_row([label2word[key][class_],
                                '{0:.3%}'.format(best_worst_precision)])
@@ -436,89 +493,12 @@ class _Trainer:
         features, ids = self._get_feature_with_id(data_loader, norm=False)
         features = torch.FloatTensor(features)
 
-        attributes, label2word = get_market_attributes(set_name=set_name)
-        attribute_ids = attributes.pop('image_index')
-        index_map = [attribute_ids.index(i) for i in ids]
-        attributes_new = dict()
-        for key, label in attributes.items():
-            label_new = [label[i] for i in index_map]
-            attributes_new[key] = np.array(label_new)
-
-        score_mat = self.evaluator.compare_features_symmetry(features)
-        N = score_mat.size(0)
-        labels = torch.Tensor([int(i) for i in ids])
-        is_pos = labels.expand(N, N).eq(labels.expand(N, N).t()).to(dtype=torch.bool)
-
-        pos_scores = score_mat[is_pos].numpy()
-        neg_scores = score_mat[~is_pos].numpy()
+        attributes_new = AttributeTable(set_name=set_name).columns(ids)
 
-        pos_score_mean = np.mean(pos_scores, axis=(0,), keepdims=False)
-        neg_score_mean = np.mean(neg_scores, axis=(0,), keepdims=False)
-
-        pos_score_std = np.std(pos_scores, axis=(0,), keepdims=False)
-        neg_score_std = np.std(neg_scores, axis=(0,), keepdims=False)
-
-        # score_mean = np.mean(score_mat, axis=(0, 1), keepdims=False)
-        # score_std = np.std(score_mat, axis=(0, 1), keepdims=False)
-        score_mat = score_mat.numpy()
-        is_pos = is_pos.numpy().astype(bool)
-
-        words = []
-        pos_effects = []
-        neg_effects = []
-        for key, labels in attributes_new.items():
-            classes = set(labels)
-            for class_ in classes:
-                word = label2word[key][class_]
-                print(word)
-                words.append(word)
-                hitted = (labels == class_)
-                scores_i = score_mat[hitted, :]
-                is_pos_i = is_pos[hitted, :]
-                num1 = sum(hitted)
-                pos_effects_ = []
-                neg_effects_ = []
-
-                for key2, labels2 in attributes_new.items():
-                    classes2 = set(labels2)
-                    for class2_ in classes2:
-                        hitted2 = (labels2 == class2_)
-
-                        if (not any(hitted)) or (not any(hitted2)):
-                            pos_effects_.append(0.)
-                            neg_effects_.append(0.)
-                            continue
-
-                        scores = scores_i[:, hitted2]
-                        is_pos_i_j = is_pos_i[:, hitted2]
-                        pos_num_i_j = np.sum(is_pos_i_j, axis=(0, 1), keepdims=False)
-                        neg_num_i_j = np.sum(np.invert(is_pos_i_j), axis=(0, 1), keepdims=False)
-
-                        pos_num = min(num1, pos_num_i_j)
-                        neg_num = min(num1, neg_num_i_j)
-
-                        if pos_num > 0:
-                            pos_score = np.mean(scores[is_pos_i_j], axis=(0,), keepdims=False)
-                            pos_e = ((pos_score - pos_score_mean) / pos_score_std) * pos_num / (pos_num + 1)
-                        else:
-                            pos_e = 0.
-
-                        if neg_num > 0:
-                            neg_score = np.mean(scores[np.invert(is_pos_i_j)], axis=(0,), keepdims=False)
-                            neg_e = ((neg_score - neg_score_mean) / neg_score_std) * neg_num / (neg_num + 1)
-                        else:
-                            neg_e = 0.
-
-                        # pos_score = np.mean(scores[is_pos_i_j], axis=(0,), keepdims=False)
-                        # neg_score = np.mean(scores[np.invert(is_pos_i_j)], axis=(0,), keepdims=False)
-                        #
-                        # pos_e = ((pos_score - pos_score_mean) / pos_score_std) * pos_num / (pos_num + 1)
-                        # neg_e = ((neg_score - neg_score_mean) / neg_score_std) * neg_num / (neg_num + 1)
-                        pos_effects_.append(float(pos_e))
-                        neg_effects_.append(float(neg_e))
-
-                pos_effects.append(pos_effects_)
-                neg_effects.append(neg_effects_)
+        statistics = AttributePairStatistics([int(i) for i in ids], attributes_new)
+        for i, j, scores in self.evaluator.iter_scores_symmetry(features):
+            statistics.update(i, j, scores)
+        pos_effects, neg_effects = statistics.effects()
 
         for amplitude in (2, 1, 0.5, 0.2):
             for label, effects in zip(['POS', 'NEG'], [pos_effects, neg_effects]):
@@ -553,313 +533,43 @@ class _Trainer:
         score_mat, weights = self.evaluator.compare_features_symmetry_y(features)
         pa_mat, qa_mat, pb_mat, qb_mat = self.evaluator.compare_features_symmetry_internal_y(features)
         N = score_mat.size(0)
-        indices_j = torch.Tensor([i for i in range(N)]).to(dtype=torch.long).expand(N, N).contiguous().view(-1)
-        indices_i = torch.Tensor([i for i in range(N)]).to(dtype=torch.long).expand(N, N).t().contiguous().view(-1)
-
-        head = 32
-        width = 32
-        height = 64
-        margin = 10
-        block = 36
-        pairs_num = 16
-        total_width = ((width + margin) * 2 + block) * 2
-        total_height = (height + margin) * pairs_num + head
 
         save_dir = os.path.join(self.opt.exp_dir, 'visualize', 'pairs_with_scores_v8', set_name)
         os.makedirs(save_dir, exist_ok=True)
 
-        font1 = ImageFont.truetype("utils/ubuntu-font-family-0.83/Ubuntu-B.ttf", 10)
-        font2 = ImageFont.truetype("utils/ubuntu-font-family-0.83/Ubuntu-B.ttf", 7)
-        font3 = ImageFont.truetype("utils/ubuntu-font-family-0.83/Ubuntu-B.ttf", 9)
-
-        border = pairs_num // 2
+        border = PAIRS_NUM // 2
+        tasks = []
         for f in range(self.opt.feats):
-            print('{0}/{1}'.format(f + 1, self.opt.feats))
-            canvas = Image.new('RGB', (total_width, total_height))
-            draw = ImageDraw.Draw(canvas)
-
-            scores = score_mat[:, :, f].view(-1)
-            pas = pa_mat[:, :, f].view(-1)
-            qas = qa_mat[:, :, f].view(-1)
-            pbs = pb_mat[:, :, f].view(-1)
-            qbs = qb_mat[:, :, f].view(-1)
-            weight = weights[f].item()
-
-            scores, indices = scores.sort(descending=True)
-            pas, qas, pbs, qbs = slice_tensor((pas, qas, pbs, qbs), indices)
-
-            idx_i = indices_i[indices]
-            idx_j = indices_j[indices]
-
-            draw.text((10, 10), '{:.3f}'.format(weight), (255, 255, 255))
-
-            pre_score = None
-            cur_num = 0
-            used_indices = set()
-            for row in range(len(scores)):
-                i = idx_i[row].item()
-                j = idx_j[row].item()
-                s = scores[row].item()
-
-                if i in used_indices or j in used_indices:
-                    continue
-                if s == pre_score:
-                    continue
-                pre_score = s
-                used_indices.add(i)
-                used_indices.add(j)
-
-                im_i = Image.open(ims_path[i]).resize((width, height))
-                im_j = Image.open(ims_path[j]).resize((width, height))
-                ##############################
-                # a patch
-                pa = pas[row].item()
-                qa = qas[row].item()
-                pb = pbs[row].item()
-                qb = qbs[row].item()
-
-                draw_a = ImageDraw.Draw(im_i)
-                draw_b = ImageDraw.Draw(im_j)
-
-                draw_a.text((2, 10),
-                            '{:.3f}'.format(pa),
-                            (0, 255, 0),
-                            font=font3)
-                draw_a.text((2, 40),
-                            '{:.3f}'.format(qa),
-                            (0, 255, 0),
-                            font=font3)
-                draw_b.text((2, 10),
-                            '{:.3f}'.format(pb),
-                            (0, 255, 0),
-                            font=font3)
-                draw_b.text((2, 40),
-                            '{:.3f}'.format(qb),
-                            (0, 255, 0),
-                            font=font3)
-                ##############################
-                canvas.paste(im_i, (0, head + (height + margin) * cur_num))
-                canvas.paste(im_j, (width + margin, head + (height + margin) * cur_num))
-                draw.text(((width + margin) * 2, head + (height + margin) * cur_num), '{:.3f}'.format(s), (0, 255, 0),
-                          font=font1)
-
-                score_same = (scores == s)
-                i_same = (idx_i == i)
-                j_same = (idx_j == j)
-
-                i_s_same_num = (i_same * score_same).sum().item()
-                j_s_same_num = (j_same * score_same).sum().item()
-
-                i_same_ratio = '{0}/{1}'.format(i_s_same_num,
-                                                i_same.sum())  # float(i_s_same_num) / float(i_same.sum().item()) * 2
-                j_same_ratio = '{0}/{1}'.format(j_s_same_num,
-                                                j_same.sum())  # float(j_s_same_num) / float(j_same.sum().item()) * 2
-
-                # draw.text(((width + margin) * 2,
-                #            head + (height + margin) * cur_num + height // 2 + 1),
-                #           '{0:.3f}_{1:.3f}'.format(i_same_ratio, j_same_ratio),
-                #           (0, 255, 0), font=font2)
-
-                draw.text((0,
-                           head + (height + margin) * cur_num + height + 1),
-                          '{0}          {1}'.format(i_same_ratio, j_same_ratio),
-                          (0, 255, 0), font=font2)
-
-                cur_num += 1
-                if cur_num >= border:
-                    break
-
-            pre_score = None
-            used_indices = set()
-            for row in range(len(scores) - 1, 0, -1):
-                i = idx_i[row].item()
-                j = idx_j[row].item()
-                s = scores[row].item()
-                if i in used_indices or j in used_indices:
-                    continue
-                if s == pre_score:
-                    continue
-                pre_score = s
-                used_indices.add(i)
-                used_indices.add(j)
-
-                im_i = Image.open(ims_path[i]).resize((width, height))
-                im_j = Image.open(ims_path[j]).resize((width, height))
-                ##############################
-                # a patch
-                pa = pas[row].item()
-                qa = qas[row].item()
-                pb = pbs[row].item()
-                qb = qbs[row].item()
-
-                draw_a = ImageDraw.Draw(im_i)
-                draw_b = ImageDraw.Draw(im_j)
-
-                draw_a.text((2, 10),
-                            '{:.3f}'.format(pa),
-                            (255, 0, 0),
-                            font=font3)
-                draw_a.text((2, 40),
-                            '{:.3f}'.format(qa),
-                            (255, 0, 0),
-                            font=font3)
-                draw_b.text((2, 10),
-                            '{:.3f}'.format(pb),
-                            (255, 0, 0),
-                            font=font3)
-                draw_b.text((2, 40),
-                            '{:.3f}'.format(qb),
-                            (255, 0, 0),
-                            font=font3)
-                ##############################
-                canvas.paste(im_i, (0, head + (height + margin) * cur_num))
-                canvas.paste(im_j, (width + margin, head + (height + margin) * cur_num))
-                draw.text(((width + margin) * 2, head + (height + margin) * cur_num), '{:.3f}'.format(s), (255, 0, 0),
-                          font=font1)
-
-                score_same = (scores == s)
-                i_same = (idx_i == i)
-                j_same = (idx_j == j)
-
-                i_s_same_num = (i_same * score_same).sum().item()
-                j_s_same_num = (j_same * score_same).sum().item()
-
-                i_same_ratio = '{0}/{1}'.format(i_s_same_num,
-                                                i_same.sum())  # float(i_s_same_num) / float(i_same.sum().item()) * 2
-                j_same_ratio = '{0}/{1}'.format(j_s_same_num,
-                                                j_same.sum())  # float(j_s_same_num) / float(j_same.sum().item()) * 2
-
-                # draw.text(((width + margin) * 2,
-                #            head + (height + margin) * cur_num + height // 2 + 1),
-                #           '{0:.3f}_{1:.3f}'.format(i_same_ratio, j_same_ratio),
-                #           (255, 0, 0), font=font2)
-                draw.text((0,
-                           head + (height + margin) * cur_num + height + 1),
-                          '{0}          {1}'.format(i_same_ratio, j_same_ratio),
-                          (255, 0, 0), font=font2)
-
-                cur_num += 1
-                if cur_num >= pairs_num:
-                    break
-
-            left = (width + margin) * 2 + block
-
-            for row, (i, j, s) in enumerate(zip(idx_i[:border], idx_j[:border], scores[:border])):
-                im_i = Image.open(ims_path[i]).resize((width, height))
-                im_j = Image.open(ims_path[j]).resize((width, height))
-                ##############################
-                # a patch
-                pa = pas[row].item()
-                qa = qas[row].item()
-                pb = pbs[row].item()
-                qb = qbs[row].item()
-
-                draw_a = ImageDraw.Draw(im_i)
-                draw_b = ImageDraw.Draw(im_j)
-
-                draw_a.text((2, 10),
-                            '{:.3f}'.format(pa),
-                            (0, 255, 0),
-                            font=font3)
-                draw_a.text((2, 40),
-                            '{:.3f}'.format(qa),
-                            (0, 255, 0),
-                            font=font3)
-                draw_b.text((2, 10),
-                            '{:.3f}'.format(pb),
-                            (0, 255, 0),
-                            font=font3)
-                draw_b.text((2, 40),
-                            '{:.3f}'.format(qb),
-                            (0, 255, 0),
-                            font=font3)
-                ##############################
-                canvas.paste(im_i, (left, head + (height + margin) * row))
-                canvas.paste(im_j, (left + width + margin, head + (height + margin) * row))
-                draw.text((left + (width + margin) * 2, head + (height + margin) * row), '{:.3f}'.format(s),
-                          (0, 255, 0), font=font1)
-
-                score_same = (scores == s)
-                i_same = (idx_i == i)
-                j_same = (idx_j == j)
-
-                i_s_same_num = (i_same * score_same).sum().item()
-                j_s_same_num = (j_same * score_same).sum().item()
-
-                i_same_ratio = '{0}/{1}'.format(i_s_same_num,
-                                                i_same.sum())  # float(i_s_same_num) / float(i_same.sum().item()) * 2
-                j_same_ratio = '{0}/{1}'.format(j_s_same_num,
-                                                j_same.sum())  # float(j_s_same_num) / float(j_same.sum().item()) * 2
-
-                # draw.text((left + (width + margin) * 2,
-                #            head + (height + margin) * row + height // 2 + 1),
-                #           '{0:.3f}_{1:.3f}'.format(i_same_ratio, j_same_ratio),
-                #           (0, 255, 0), font=font2)
-
-                draw.text((left,
-                           head + (height + margin) * row + height + 1),
-                          '{0}          {1}'.format(i_same_ratio, j_same_ratio),
-                          (0, 255, 0), font=font2)
-
-            total_num = len(idx_i)
-            for row_, (i, j, s) in enumerate(
-                    zip(reversed(idx_i[-border:]), reversed(idx_j[-border:]), reversed(scores[-border:]))):
-                row = row_ + border
-                im_i = Image.open(ims_path[i]).resize((width, height))
-                im_j = Image.open(ims_path[j]).resize((width, height))
-                ##############################
-                # a patch
-                l = total_num - border + row_
-                pa = pas[l].item()
-                qa = qas[l].item()
-                pb = pbs[l].item()
-                qb = qbs[l].item()
-
-                draw_a = ImageDraw.Draw(im_i)
-                draw_b = ImageDraw.Draw(im_j)
-
-                draw_a.text((2, 10),
-                            '{:.3f}'.format(pa),
-                            (255, 0, 0),
-                            font=font3)
-                draw_a.text((2, 40),
-                            '{:.3f}'.format(qa),
-                            (255, 0, 0),
-                            font=font3)
-                draw_b.text((2, 10),
-                            '{:.3f}'.format(pb),
-                            (255, 0, 0),
-                            font=font3)
-                draw_b.text((2, 40),
-                            '{:.3f}'.format(qb),
-                            (255, 0, 0),
-                            font=font3)
-                ##############################
-                canvas.paste(im_i, (left, head + (height + margin) * row))
-                canvas.paste(im_j, (left + width + margin, head + (height + margin) * row))
-                draw.text((left + (width + margin) * 2, head + (height + margin) * row), '{:.3f}'.format(s),
-                          (255, 0, 0), font=font1)
-
-                score_same = (scores == s)
-                i_same = (idx_i == i)
-                j_same = (idx_j == j)
-
-                i_s_same_num = (i_same * score_same).sum().item()
-                j_s_same_num = (j_same * score_same).sum().item()
-
-                i_same_ratio = '{0}/{1}'.format(i_s_same_num,
-                                                i_same.sum())  # float(i_s_same_num) / float(i_same.sum().item()) * 2
-                j_same_ratio = '{0}/{1}'.format(j_s_same_num,
-                                                j_same.sum())  # float(j_s_same_num) / float(j_same.sum().item()) * 2
-
-                draw.text((left,
-                           head + (height + margin) * row + height + 1),
-                          '{0}          {1}'.format(i_same_ratio, j_same_ratio),
-                          (255, 0, 0), font=font2)
-
-            canvas.save(
-                os.path.join(save_dir, '{0}_{1}_{2}_pairs_with_scores.png'.format(self.opt.exp_name, set_name, f)),
-                'PNG')
+            scores = score_mat[:, :, f]
+            flat_scores = scores.reshape(-1)
+            internals = (pa_mat[:, :, f].reshape(-1), qa_mat[:, :, f].reshape(-1),
+                         pb_mat[:, :, f].reshape(-1), qb_mat[:, :, f].reshape(-1))
+
+            # left: distinct pairs, right: the plain top and bottom ones
+            top = select_pairs(scores, border, largest=True, distinct=True)
+            bottom = select_pairs(scores, PAIRS_NUM - len(top), largest=False, distinct=True)
+            plain_top = select_pairs(scores, border, largest=True)
+            plain_bottom = select_pairs(scores, border, largest=False)
+
+            rows = []
+            for x, first_row, color, selected in ((0, 0, GREEN, top),
+                                                  (0, len(top), RED, bottom),
+                                                  (LEFT, 0, GREEN, plain_top),
+                                                  (LEFT, border, RED, plain_bottom)):
+                for row, index in enumerate(selected, first_row):
+                    i, j = divmod(index, N)
+                    s = flat_scores[index].item()
+                    # how many pairs of the same image i (j) share the score
+                    i_s_same_num = (scores[i, :] == s).sum().item()
+                    j_s_same_num = (scores[:, j] == s).sum().item()
+                    ties = '{0}/{1}          {2}/{3}'.format(i_s_same_num, N, j_s_same_num, N)
+                    rows.append((x, row, i, j, s, tuple(m[index].item() for m in internals), ties, color))
+
+            save_path = os.path.join(save_dir,
+                                     '{0}_{1}_{2}_pairs_with_scores.png'.format(self.opt.exp_name, set_name, f))
+            tasks.append((weights[f].item(), rows, save_path))
+
+        render_pair_canvases(tasks, ims_path, workers=self.opt.render_workers)
 
     def _parse_data(self, inputs):
         raise NotImplementedError
@@ -878,38 +588,171 @@ class _Trainer:
 
 
 class BraidPairTrainer(_Trainer):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, bank_loader=None, **kwargs):
         super(BraidPairTrainer, self).__init__(*args, **kwargs)
         self.pair2bi = Pair2Bi()
         self.bi2pair = Bi2Pair()
 
+        # for the hard pair mining
+        self.bank_loader = bank_loader
+        self.bank_projection = None
+        self.mining_time = 0.
+
+        # positions of side a and side b in the unique images, when opt.dedup_pairs
+        self.pair_indices = None
+        # images of the pairs and the distinct ones among them, extracted in the current epoch
+        self.images_num = 0
+        self.unique_images_num = 0
+        # sample indices of the images of side a and side b, when opt.dedup_images
+        self.sample_indices = None
+        if (self.opt.dedup_pairs or self.opt.dedup_images) and self.phase_num == 2:
+            # these BN layers in the extractor group samples by pair labels, which unique images do not have
+            labeled_bns = [k for k in ('stable_bn20', 'stable_bn21', 'stable_bn22', 'stable_bn24', 'stable_bn27',
+                                       'stable_bn28', 'stable_bn29', 'stable_bn30', 'stable_bn31')
+                           if getattr(self.opt, k)]
+            if labeled_bns:
+                raise NotImplementedError('dedup_pairs/dedup_images is incompatible with {0}'
+                                          .format(', '.join(labeled_bns)))
+
         # for stable_bn
         Labels.classes_num = 2
 
-    def _parse_data(self, inputs):
-        (imgs_a, pids_a, _), (imgs_b, pids_b, _) = inputs
+    def _get_mining_sampler(self):
+        for sampler in (self.train_loader.batch_sampler, self.train_loader.sampler,
+                        getattr(self.train_loader.sampler, 'sampler', None)):
+            if isinstance(sampler, HardPairMining):
+                return sampler
+        raise TypeError('the training loader does not have a hard mining sampler')
+
+    def _reduce_bank_feature(self, feat):
+        if isinstance(feat, (list, tuple)):
+            feat = torch.cat([f.flatten(1) for f in feat], dim=1)
+        feat = feat.flatten(1).float()
+
+        if feat.size(1) > self.opt.bank_dim:
+            # a fixed random projection, which roughly preserves the distances
+            if self.bank_projection is None:
+                generator = torch.Generator().manual_seed(self.opt.seed)
+                projection = torch.randn(feat.size(1), self.opt.bank_dim, generator=generator)
+                self.bank_projection = projection.div_(self.opt.bank_dim ** 0.5).to(feat.device)
+            feat = torch.mm(feat, self.bank_projection)
+
+        return torch.nn.functional.normalize(feat, dim=1).half()
+
+    def _refresh_feature_bank(self):
+        sampler = self._get_mining_sampler()
+        self.model.eval()
 
-        target = [1. if a == b else 0. for a, b in zip(pids_a, pids_b)]
-        self.data = (imgs_a.cuda(), imgs_b.cuda())
-        self.target = torch.tensor(target).cuda().unsqueeze(1)
+        start = time.time()
+        # the bank is extracted by shards, which should see the same BN statistics
+        broadcast_buffers(self.model)
+        bank = self.evaluator._get_feature(self.bank_loader, reduce=self._reduce_bank_feature)
+        extract_end = time.time()
+        sampler.update_bank(bank)
+        mining_end = time.time()
+
+        self.mining_time += mining_end - start
+        print('feature bank of {0} samples refreshed, extraction {1:.0f} s, mining {2:.0f} s, {3:.0f} s in total'
+              .format(bank.size(0), extract_end - start, mining_end - extract_end, self.mining_time))
+
+    def _step_states(self, step):
+        extra_states = super(BraidPairTrainer, self)._step_states(step)
+        if self.bank_loader is not None:
+            extra_states['mining'] = self._get_mining_sampler().mining_state_dict()
+        return extra_states
+
+    def _load_step_state(self, state):
+        if self.bank_loader is not None:
+            if 'mining' in state:
+                self._get_mining_sampler().load_mining_state_dict(state['mining'])
+            else:
+                # saved without the bank, which can only be mined again from the current model
+                self._refresh_feature_bank()
+                self.model.train()
+        return super(BraidPairTrainer, self)._load_step_state(state)
 
-        # for stable_bn
-        Labels.parse_target(target)
+    def _train(self, epoch):
+        # a step checkpoint restores the bank of the epoch instead
+        if self.bank_loader is not None and not self._resumes(epoch):
+            if self._get_mining_sampler().bank is None or (epoch - 1) % self.opt.bank_refresh == 0:
+                self._refresh_feature_bank()
+
+        self.images_num = 0
+        self.unique_images_num = 0
+        super(BraidPairTrainer, self)._train(epoch)
+
+        if self.images_num > 0:
+            duplication_rate = 1. - float(self.unique_images_num) / float(self.images_num)
+            self.recorder.summary_writer.add_scalar('duplication_rate', duplication_rate, epoch)
+            print('{0:.1%} of the pair images were duplicates and extracted only once'.format(duplication_rate))
+
+    @staticmethod
+    def _unique_images(indices):
+        """(representatives, inverse): the positions of one draw of each distinct sample in indices, and the ones of
+        the draw standing for each position, i.e. indices == indices[representatives][inverse].
+        The other draws of a sample are differently augmented, but only one of them is extracted, as by dedup_pairs."""
+        unique_indices, inverse = torch.unique(indices, return_inverse=True)
+        if len(unique_indices) == len(indices):
+            return None, None
+        representatives = torch.empty(len(unique_indices), dtype=torch.long, device=indices.device)
+        representatives.scatter_(0, inverse, torch.arange(len(indices), device=indices.device))
+        return representatives, inverse
 
-    def _extract_feature(self, data):
-        return self.model(data, mode='extract')
+    def _parse_data(self, inputs):
+        if self.opt.dedup_pairs:
+            (imgs, pids, _), idx_a, idx_b = inputs
+            self.data = imgs.to(self.device)
+            self.pair_indices = (idx_a.to(self.device), idx_b.to(self.device))
+            pids = pids.to(self.device)
+            pids_a, pids_b = pids[self.pair_indices[0]], pids[self.pair_indices[1]]
+        else:
+            (imgs_a, pids_a, _), (imgs_b, pids_b, _) = [sample[:3] for sample in inputs]
+            self.data = (imgs_a.to(self.device), imgs_b.to(self.device))
+            pids_a, pids_b = pids_a.to(self.device), pids_b.to(self.device)
+            if len(inputs[0]) == 4:
+                # from the indexed dataset of opt.dedup_images, in the order of pair2bi
+                self.sample_indices = torch.cat((inputs[0][3], inputs[1][3])).to(self.device)
+
+        # the pair labels stay on the device, the stable BN layers derive their class groups from them there
+        self.target = (pids_a == pids_b).float().unsqueeze(1)
+
+    def _extract_feature(self, data, labels=None):
+        return self.model(data, mode='extract', labels=labels)
 
     def _compare_feature(self, *features):
-        return self.model(*features, mode='metric')
+        # the pair labels go through the forward pass for stable_bn, scattered along with the features
+        return self.model(*features, mode='metric', labels=self.target)
 
     def _forward(self):
         if self.phase_num == 1:
-            score = self.model(*self.data, mode='normal')
+            if self.pair_indices is not None:
+                data = [slice_tensor(self.data, indices) for indices in self.pair_indices]
+            else:
+                data = self.data
+            score = self.model(*data, mode='normal', labels=self.target)
 
         elif self.phase_num == 2:
-            data = self.pair2bi(self.data[0], self.data[1])
-            feat = self._extract_feature(data)
-            feat_a, feat_b = self.bi2pair(feat)
+            if self.pair_indices is not None:
+                # each unique image is extracted once, and gathering keeps the gradients accumulated correctly
+                feat = self._extract_feature(self.data)
+                feat_a, feat_b = [slice_tensor(feat, indices) for indices in self.pair_indices]
+                self.images_num += 2 * len(self.pair_indices[0])
+                self.unique_images_num += tensor_size(self.data, 0)
+            elif self.sample_indices is not None:
+                data = self.pair2bi(self.data[0], self.data[1])
+                representatives, inverse = self._unique_images(self.sample_indices)
+                if representatives is None:
+                    feat = self._extract_feature(data)
+                    self.unique_images_num += tensor_size(data, 0)
+                else:
+                    feat = slice_tensor(self._extract_feature(slice_tensor(data, representatives)), inverse)
+                    self.unique_images_num += len(representatives)
+                feat_a, feat_b = self.bi2pair(feat)
+                self.images_num += tensor_size(data, 0)
+            else:
+                data = self.pair2bi(self.data[0], self.data[1])
+                feat = self._extract_feature(data, labels=torch.cat((self.target, self.target)))
+                feat_a, feat_b = self.bi2pair(feat)
             # feat_a = self._extract_feature(self.data[0])
             # feat_b = self._extract_feature(self.data[1])
             score = self._compare_feature(feat_a, feat_b)
@@ -920,24 +763,119 @@ class BraidPairTrainer(_Trainer):
         self.loss = self.criterion(score, self.target)
 
     def _backward(self):
-        self.loss.backward()
+        self.scaler.scale(self.loss).backward()
         self.model.module.correct_grads()
 
 
 class BraidCrossTrainer(BraidPairTrainer):
+    def __init__(self, *args, **kwargs):
+        super(BraidCrossTrainer, self).__init__(*args, **kwargs)
+        # the pairs of the current step, by which the frozen BN statistics of the metric are updated after backward
+        self.metric_pairs = None
+
     def _parse_data(self, inputs):
         imgs, pids, _ = inputs
-        self.data = imgs.cuda()
-        self.target = pids.cuda()
+        self.data = imgs.to(self.device)
+        self.target = pids.to(self.device)
+
+    def _gather_batch(self, features):
+        """in distributed training, the features (differentiable) and the pids of all the ranks, so that every anchor
+        is compared with the whole batch as in a single process. Every rank then scores all the pairs of the batch."""
+        if not self.opt.distributed:
+            return features
+        self.target = all_gather_cat(self.target)
+        return all_gather_cat_with_grad(features)
+
+    def _frozen_metric(self):
+        """whether the pairs are compared by chunks or within a budget, and thus their BN statistics are frozen.
+        In train mode, every chunk or subset would be normalized by its own batch statistics instead of those
+        of all the pairs, so the scores would depend on the chunking and mix different normalizations."""
+        return self.opt.cross_chunk > 0 or self.opt.cross_pair_budget > 0
+
+    def _pair_scores(self, feat_a, feat_b):
+        # also applied when checkpoint recomputes the chunk in backward
+        with frozen_bn(self.model, self._frozen_metric()):
+            scores = self.model(feat_a, feat_b, mode='metric')
+        return scores.view(scores.size(0), -1)
+
+    def _update_metric_statistics(self, features, a_indices, b_indices):
+        """the running statistics of the BN layers of the metric updated once by the pairs (a random chunk of them,
+        if they are compared by chunks), since the frozen scores do not update them.
+        Done after backward, so that the chunks recomputed in backward see the statistics of their forward."""
+        chunk = self.opt.cross_chunk
+        if 0 < chunk < len(a_indices):
+            sample = torch.randperm(len(a_indices), device=a_indices.device)[:chunk]
+            a_indices, b_indices = a_indices[sample], b_indices[sample]
+        with torch.no_grad():
+            self.model(slice_tensor(features, a_indices), slice_tensor(features, b_indices), mode='metric')
+
+    def _metric(self, features, a_indices, b_indices):
+        """scores [P, C] of the pairs, by chunks of opt.cross_chunk pairs whose braid activations are
+        recomputed in backward instead of kept"""
+        chunk = self.opt.cross_chunk
+        if chunk <= 0 or len(a_indices) <= chunk:
+            return self._pair_scores(slice_tensor(features, a_indices), slice_tensor(features, b_indices))
+
+        checkpointed = torch.is_grad_enabled()
+        scores = []
+        for start in range(0, len(a_indices), chunk):
+            feat_a = slice_tensor(features, a_indices[start:start + chunk])
+            feat_b = slice_tensor(features, b_indices[start:start + chunk])
+            if not checkpointed:
+                scores.append(self._pair_scores(feat_a, feat_b))
+            elif isinstance(feat_a, torch.Tensor):
+                scores.append(checkpoint(self._pair_scores, feat_a, feat_b))
+            else:
+                # checkpoint only tracks the tensors passed directly
+                k = len(feat_a)
+                fun = lambda *feats: self._pair_scores(list(feats[:k]), list(feats[k:]))
+                scores.append(checkpoint(fun, *feat_a, *feat_b))
+        return torch.cat(scores, dim=0)
+
+    def _select_pairs(self, scores, a_indices, b_indices):
+        """all the positive pairs, then the hardest negatives and random other ones within opt.cross_pair_budget"""
+        is_pos = self.target[a_indices] == self.target[b_indices]
+        pos_indices = torch.nonzero(is_pos, as_tuple=False).view(-1)
+        neg_indices = torch.nonzero(~is_pos, as_tuple=False).view(-1)
+
+        neg_budget = max(self.opt.cross_pair_budget - len(pos_indices), 0)
+        if neg_budget >= len(neg_indices):
+            return None
+
+        hard_num = int(neg_budget * self.opt.cross_hard_ratio)
+        neg_scores = scores[neg_indices].mean(dim=1)
+        order = neg_scores.argsort(descending=True)
+        hard_indices = neg_indices[order[:hard_num]]
+        rest_indices = neg_indices[order[hard_num:]]
+        rest_order = torch.randperm(len(rest_indices), device=rest_indices.device)
+        rest_indices = rest_indices[rest_order[:neg_budget - hard_num]]
+        return torch.cat((pos_indices, hard_indices, rest_indices))
 
     def _compare_feature(self, features):
         # only compute the lower triangular of the distmat
 
         n = tensor_size(features, dim=0)
-        a_indices, b_indices = torch.tril_indices(n, n)
-        scores_l = self.model(slice_tensor(features, a_indices),
-                              slice_tensor(features, b_indices),
-                              mode='metric').squeeze()
+        a_indices, b_indices = torch.tril_indices(n, n, device=self.device)
+
+        if self._frozen_metric() and self.model.training:
+            self.metric_pairs = (tensor_detach(features), a_indices, b_indices)
+
+        selected = None
+        if 0 < self.opt.cross_pair_budget < len(a_indices):
+            # score all the pairs without gradients to choose the ones with, both passes normalized by the same
+            # (frozen) BN statistics, so that the detached scores of the others fit in the same score matrix
+            with torch.no_grad():
+                detached_scores = self._metric(features, a_indices, b_indices)
+            selected = self._select_pairs(detached_scores, a_indices, b_indices)
+
+        if selected is None:
+            scores_l = self._metric(features, a_indices, b_indices)
+        else:
+            scores_l = detached_scores.clone()
+            scores_l[selected] = self._metric(features, a_indices[selected], b_indices[selected])
+
+        if scores_l.size(1) == 1:
+            scores_l = scores_l.squeeze(1)
 
         if len(scores_l.size()) == 1:
             score_mat = torch.zeros((n, n), device=scores_l.device, dtype=scores_l.dtype)
@@ -951,12 +889,20 @@ class BraidCrossTrainer(BraidPairTrainer):
 
         return score_mat
 
+    def _backward(self):
+        # the checkpointed chunks are recomputed under the frozen BN statistics, so no buffer changes in backward
+        super(BraidCrossTrainer, self)._backward()
+
+        if self.metric_pairs is not None:
+            self._update_metric_statistics(*self.metric_pairs)
+            self.metric_pairs = None
+
     def _forward(self):
         if self.phase_num == 1:
             raise NotImplementedError('In most cases, it will waste too much computation.')
 
         elif self.phase_num == 2:
-            features = self._extract_feature(self.data)
+            features = self._gather_batch(self._extract_feature(self.data))
             score_mat = self._compare_feature(features)
 
         else:
@@ -978,8 +924,8 @@ class BraidCrossIDETrainer(BraidCrossTrainer):
 
     def _parse_data(self, inputs):
         imgs, pids, _ = inputs
-        self.data = imgs.cuda()
-        self.target = pids.cuda()
+        self.data = imgs.to(self.device)
+        self.target = pids.to(self.device)
 
     def _forward(self):
         if self.phase_num == 1:
@@ -987,20 +933,22 @@ class BraidCrossIDETrainer(BraidCrossTrainer):
 
         elif self.phase_num == 2:
             predicts, features = self._extract_feature(self.data)
-            score_mat = self._compare_feature(features)
+            # the predictions of the samples of the rank, before the pids of all the ranks are gathered
+            ide_loss = self.criterion[0](predicts, self.target)
+            score_mat = self._compare_feature(self._gather_batch(features))
 
         else:
             raise ValueError
 
-        self.loss = self.trade_off[0] * self.criterion[0](predicts, self.target) \
+        self.loss = self.trade_off[0] * ide_loss \
                     + self.trade_off[1] * self.criterion[1](score_mat, self.target)
 
 
 class NormalTrainer(_Trainer):
     def _parse_data(self, inputs):
         imgs, pids, _ = inputs
-        self.data = imgs.cuda()
-        self.target = pids.cuda()
+        self.data = imgs.to(self.device)
+        self.target = pids.to(self.device)
 
     def _forward(self):
         if self.phase_num == 1:
@@ -1015,7 +963,7 @@ class NormalTrainer(_Trainer):
         self.loss = self.criterion(predictions, self.target)
 
     def _backward(self):
-        self.loss.backward()
+        self.scaler.scale(self.loss).backward()
 
     def _extract_feature(self, data):
         return self.model(self.data, mode='extract')
@@ -1,53 +1,112 @@
+import os
+
+import numpy as np
 import scipy.io as scio
 
+MAT_PATH = 'Market-1501_Attribute/market_attribute.mat'
 
-def get_market_attributes(set_name='train'):
-    path = 'Market-1501_Attribute/market_attribute.mat'
+FIELDS = ['age', 'backpack', 'bag', 'handbag', 'downblack', 'downblue', 'downbrown', 'downgray', 'downgreen',
+          'downpink', 'downpurple', 'downwhite', 'downyellow', 'upblack', 'upblue', 'upgreen', 'upgray',
+          'uppurple', 'upred', 'upwhite', 'upyellow', 'clothes', 'down', 'up', 'hair', 'hat', 'gender']
+
+LABEL2WORD = {'gender': {1: 'male', 2: 'female'},
+              'hair': {1: 'short_hair', 2: 'long_hair'},
+              'up': {1: 'long_sleeve', 2: 'short_sleeve'},
+              'down': {1: 'long_lower_body_clothing', 2: 'short_lower_body_clothing'},
+              'clothes': {1: 'dress', 2: 'pants'},
+              'hat': {1: 'no_hat', 2: 'wearing_hat'},
+              'backpack': {1: 'no_backpack', 2: 'carrying_backpack'},
+              'bag': {1: 'no_bag', 2: 'carrying_bag'},
+              'handbag': {1: 'no_handbag', 2: 'carrying_handbag'},
+              'age': {1: 'young', 2: 'teenager', 3: 'adult', 4: 'old'},
+              'upblack': {1: 'not_upblack', 2: 'upblack'},
+              'upwhite': {1: 'not_upwhite', 2: 'upwhite'},
+              'upred': {1: 'not_upred', 2: 'upred'},
+              'uppurple': {1: 'not_uppurple', 2: 'uppurple'},
+              'upyellow': {1: 'not_upyellow', 2: 'upyellow'},
+              'upgray': {1: 'not_upgray', 2: 'upgray'},
+              'upblue': {1: 'not_upblue', 2: 'upblue'},
+              'upgreen': {1: 'not_upgreen', 2: 'upgreen'},
+              'downblack': {1: 'not_downblack', 2: 'downblack'},
+              'downwhite': {1: 'not_downwhite', 2: 'downwhite'},
+              'downpink': {1: 'not_downpink', 2: 'downpink'},
+              'downpurple': {1: 'not_downpurple', 2: 'downpurple'},
+              'downyellow': {1: 'not_downyellow', 2: 'downyellow'},
+              'downgray': {1: 'not_downgray', 2: 'downgray'},
+              'downblue': {1: 'not_downblue', 2: 'downblue'},
+              'downgreen': {1: 'not_downgreen', 2: 'downgreen'},
+              'downbrown': {1: 'not_downbrown', 2: 'downbrown'},
+              }
+
+
+def _parse_mat(path, set_name):
     data = scio.loadmat(path)
     data = data['market_attribute'][0][0]
     data = data[set_name]
 
+    ids = [int(s[0]) for s in data['image_index'][0][0][0]]
+    table = np.zeros(len(ids), dtype=[('id', np.int64)] + [(field, np.int8) for field in FIELDS])
+    table['id'] = ids
+    for field in FIELDS:
+        table[field] = data[field][0][0][0]
+
+    return table
+
+
+def _load_table(path, set_name):
+    """the structured array of the attributes, cached as .npy beside the .mat (ignored by git)"""
+    cache_path = '{0}_{1}.npy'.format(os.path.splitext(path)[0], set_name)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return np.load(cache_path, allow_pickle=False)
+
+    table = _parse_mat(path, set_name)
+    try:
+        np.save(cache_path, table, allow_pickle=False)
+    except OSError:
+        pass
+    return table
+
+
+class AttributeTable(object):
+    """The attributes of the Market-1501 identities of a set, one row per identity in the order of the .mat.
+    Identities are looked up by searchsorted on the sorted ids."""
+
+    def __init__(self, set_name='train', path=MAT_PATH):
+        self.table = _load_table(path, set_name)
+        self.ids = self.table['id']
+        self.sorter = np.argsort(self.ids, kind='stable')
+
+    def rows(self, ids):
+        """row indices of ids (str or int), KeyError for the unknown ones"""
+        ids = np.asarray(ids).astype(np.int64)
+        pos = np.searchsorted(self.ids, ids, sorter=self.sorter)
+        pos = np.minimum(pos, len(self.ids) - 1)
+        rows = self.sorter[pos]
+        missing = self.ids[rows] != ids
+        if missing.any():
+            raise KeyError('ids without attributes: {0}'.format(np.unique(ids[missing]).tolist()))
+        return rows
+
+    def lookup(self, ids):
+        """structured array of the attributes of ids, all the fields at once"""
+        return self.table[self.rows(ids)]
+
+    def columns(self, ids, fields=FIELDS):
+        """dict field -> array of the attribute of ids"""
+        records = self.lookup(ids)
+        return {field: records[field].astype(np.int64) for field in fields}
+
+
+def get_market_attributes(set_name='train'):
+    table = AttributeTable(set_name).table
+
     attributes = dict()
-    fields = ['age', 'backpack', 'bag', 'handbag', 'downblack', 'downblue', 'downbrown', 'downgray', 'downgreen',
-              'downpink', 'downpurple', 'downwhite', 'downyellow', 'upblack', 'upblue', 'upgreen', 'upgray',
-              'uppurple', 'upred', 'upwhite', 'upyellow', 'clothes', 'down', 'up', 'hair', 'hat', 'gender',
-              'image_index']
-
-    for field in fields:
-        attributes[field] = data[field][0][0][0].tolist()
-
-    attributes['image_index'] = [str(int(s[0])) for s in attributes['image_index']]
-
-    label2word = {'gender': {1: 'male', 2: 'female'},
-                  'hair': {1: 'short_hair', 2: 'long_hair'},
-                  'up': {1: 'long_sleeve', 2: 'short_sleeve'},
-                  'down': {1: 'long_lower_body_clothing', 2: 'short_lower_body_clothing'},
-                  'clothes': {1: 'dress', 2: 'pants'},
-                  'hat': {1: 'no_hat', 2: 'wearing_hat'},
-                  'backpack': {1: 'no_backpack', 2: 'carrying_backpack'},
-                  'bag': {1: 'no_bag', 2: 'carrying_bag'},
-                  'handbag': {1: 'no_handbag', 2: 'carrying_handbag'},
-                  'age': {1: 'young', 2: 'teenager', 3: 'adult', 4: 'old'},
-                  'upblack': {1: 'not_upblack', 2: 'upblack'},
-                  'upwhite': {1: 'not_upwhite', 2: 'upwhite'},
-                  'upred': {1: 'not_upred', 2: 'upred'},
-                  'uppurple': {1: 'not_uppurple', 2: 'uppurple'},
-                  'upyellow': {1: 'not_upyellow', 2: 'upyellow'},
-                  'upgray': {1: 'not_upgray', 2: 'upgray'},
-                  'upblue': {1: 'not_upblue', 2: 'upblue'},
-                  'upgreen': {1: 'not_upgreen', 2: 'upgreen'},
-                  'downblack': {1: 'not_downblack', 2: 'downblack'},
-                  'downwhite': {1: 'not_downwhite', 2: 'downwhite'},
-                  'downpink': {1: 'not_downpink', 2: 'downpink'},
-                  'downpurple': {1: 'not_downpurple', 2: 'downpurple'},
-                  'downyellow': {1: 'not_downyellow', 2: 'downyellow'},
-                  'downgray': {1: 'not_downgray', 2: 'downgray'},
-                  'downblue': {1: 'not_downblue', 2: 'downblue'},
-                  'downgreen': {1: 'not_downgreen', 2: 'downgreen'},
-                  'downbrown': {1: 'not_downbrown', 2: 'downbrown'},
-                  }
-
-    return attributes, label2word
+    for field in FIELDS:
+        attributes[field] = table[field].tolist()
+
+    attributes['image_index'] = [str(i) for i in table['id'].tolist()]
+
+    return attributes, LABEL2WORD
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+# encoding: utf-8
+import torch
+from torch.utils.data.dataloader import default_collate
+
+'''augmentations applied on a whole collated batch [B, C, H, W] rather than image by image'''
+
+
+def _region_mask(b, h, w, y1, x1, rh, rw, hitted):
+    """boolean mask of shape [B, 1, H, W], True inside the chosen rectangle of each hitted sample"""
+    rows = torch.arange(h).view(1, h, 1)
+    cols = torch.arange(w).view(1, 1, w)
+    y1, x1, rh, rw = [t.view(b, 1, 1) for t in (y1, x1, rh, rw)]
+    mask = (rows >= y1) & (rows < y1 + rh) & (cols >= x1) & (cols < x1 + rw)
+    mask &= hitted.view(b, 1, 1)
+    return mask.unsqueeze(1)
+
+
+def _random_offsets(limits):
+    """uniform integers in [0, limit] for each element, as random.randint(0, limit) does"""
+    return (torch.rand(limits.size()) * (limits + 1).float()).floor().long()
+
+
+def _fill(imgs, mask, mean):
+    c = imgs.size(1)
+    if c == 3:
+        value = torch.tensor(mean, dtype=imgs.dtype).view(1, 3, 1, 1)
+    else:
+        value = torch.tensor(mean[:1], dtype=imgs.dtype).view(1, 1, 1, 1)
+        mask = mask & (torch.arange(c) == 0).view(1, c, 1, 1)
+    return torch.where(mask, value.to(imgs.device), imgs)
+
+
+class BatchRandomHorizontalFlip(object):
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgs):
+        hitted = torch.rand(imgs.size(0)) < self.p
+        if hitted.any():
+            hitted = hitted.to(imgs.device)
+            imgs[hitted] = imgs[hitted].flip(-1)
+        return imgs
+
+
+class BatchNormalize(object):
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, imgs):
+        mean = self.mean.to(device=imgs.device, dtype=imgs.dtype)
+        std = self.std.to(device=imgs.device, dtype=imgs.dtype)
+        return imgs.sub_(mean).div_(std)
+
+
+class BatchCutout(object):
+    """the batched counterpart of Dataset.random_erasing.Cutout"""
+
+    def __init__(self, probability=0.5, size=64, mean=[0.4914, 0.4822, 0.4465]):
+        self.probability = probability
+        self.mean = mean
+        self.size = size
+
+    def __call__(self, imgs):
+        b, _, h, w = imgs.size()
+        if not (self.size < w and self.size < h):
+            return imgs
+
+        hitted = torch.rand(b) <= self.probability
+        size = torch.full((b,), self.size, dtype=torch.long)
+        y1 = _random_offsets(h - size)
+        x1 = _random_offsets(w - size)
+        mask = _region_mask(b, h, w, y1, x1, size, size, hitted)
+        return _fill(imgs, mask.to(imgs.device), self.mean)
+
+
+class BatchRandomErasing(object):
+    """the batched counterpart of Dataset.random_erasing.RandomErasing.
+    All the attempts of all the samples are drawn in one call, and the first valid attempt of each sample is kept."""
+
+    def __init__(self, probability=0.5, sl=0.02, sh=0.4, r1=0.3, mean=[0.4914, 0.4822, 0.4465], attempts=100):
+        self.probability = probability
+        self.mean = mean
+        self.sl = sl
+        self.sh = sh
+        self.r1 = r1
+        self.attempts = attempts
+
+    def __call__(self, imgs):
+        b, _, h, w = imgs.size()
+        area = h * w
+
+        hitted = torch.rand(b) <= self.probability
+        target_area = torch.empty(b, self.attempts).uniform_(self.sl, self.sh) * area
+        aspect_ratio = torch.empty(b, self.attempts).uniform_(self.r1, 1. / self.r1)
+
+        rh = torch.sqrt(target_area * aspect_ratio).round().long()
+        rw = torch.sqrt(target_area / aspect_ratio).round().long()
+
+        valid = (rw < w) & (rh < h)
+        hitted &= valid.any(dim=1)
+        first = valid.to(dtype=torch.uint8).argmax(dim=1, keepdim=True)
+        rh = rh.gather(1, first).squeeze(1)
+        rw = rw.gather(1, first).squeeze(1)
+
+        y1 = _random_offsets((h - rh).clamp(min=0))
+        x1 = _random_offsets((w - rw).clamp(min=0))
+        mask = _region_mask(b, h, w, y1, x1, rh, rw, hitted)
+        return _fill(imgs, mask.to(imgs.device), self.mean)
+
+
+class BatchTrainTransform(object):
+    """flip, normalize and erase a batch produced by TrainTransform(..., batch_augment=True)"""
+
+    def __init__(self, meta, augmentaion=None):
+        self.flip = BatchRandomHorizontalFlip()
+        self.normalize = BatchNormalize(mean=meta['mean'], std=meta['std'])
+
+        if augmentaion == 'Cutout':
+            self.augment = BatchCutout(probability=0.5, size=meta['imageSize'][1] // 2, mean=[0.0, 0.0, 0.0])
+        elif augmentaion == 'RandomErasing':
+            self.augment = BatchRandomErasing(probability=0.5, mean=[0.0, 0.0, 0.0])
+        else:
+            self.augment = None
+
+    def __call__(self, imgs):
+        if imgs.dtype == torch.uint8:
+            imgs = imgs.float().div_(255.)
+        imgs = self.flip(imgs)
+        imgs = self.normalize(imgs)
+        if self.augment is not None:
+            imgs = self.augment(imgs)
+        return imgs
+
+
+class BatchAugmentCollate(object):
+    """collate_fn of DataLoader, which augments every image batch (4-D tensor) after the default collation.
+    Set precollated=True when the dataset returns whole batches by itself (DataLoader with batch_size=None)."""
+
+    def __init__(self, transform: BatchTrainTransform, precollated=False):
+        self.transform = transform
+        self.precollated = precollated
+
+    def _apply(self, data):
+        if isinstance(data, torch.Tensor):
+            if data.dim() == 4:
+                return self.transform(data)
+            return data
+        elif isinstance(data, (list, tuple)):
+            return [self._apply(d) for d in data]
+        elif isinstance(data, dict):
+            return {k: self._apply(v) for k, v in data.items()}
+        else:
+            return data
+
+    def __call__(self, batch):
+        if not self.precollated:
+            batch = default_collate(batch)
+        return self._apply(batch)
@@ -0,0 +1,95 @@
+# encoding: utf-8
+import math
+import random
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data.dataloader import default_collate
+
+from Dataset.batch_transforms import BatchTrainTransform
+from Dataset.transforms import TrainTransform
+
+'''
+Statistical agreement of the batched augmentation (TrainTransform(..., batch_augment=True) + BatchTrainTransform)
+with the image-by-image one (TrainTransform): the flip rate, the erasing rate, and the histograms of the erased
+areas and aspect ratios, both paths run on the same fixed batch many times.
+run by: python -m Dataset.batch_transforms_check RandomErasing Cutout
+'''
+
+META = {'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225], 'imageSize': [256, 128]}
+
+
+def _fixed_image(height, width):
+    """a horizontally asymmetric image, none of whose normalized pixels is 0 (the erasing value)"""
+    columns = np.linspace(128, 255, width).astype(np.uint8)
+    return Image.fromarray(np.tile(columns[None, :, None], (height, 1, 3)))
+
+
+def _reference(image):
+    x = torch.from_numpy(np.asarray(image, dtype=np.float32) / 255.).permute(2, 0, 1)
+    mean = torch.tensor(META['mean']).view(3, 1, 1)
+    std = torch.tensor(META['std']).view(3, 1, 1)
+    return (x - mean) / std
+
+
+def _statistics(outputs, reference):
+    """(flipped, erased, erased area / image area, log aspect ratio of the erased regions) of every output"""
+    stats = []
+    for x in outputs:
+        erased = (x == 0).all(dim=0)
+        kept = ~erased
+        flipped = (x - reference.flip(-1)).abs()[:, kept].max() < (x - reference).abs()[:, kept].max()
+        if erased.any():
+            rows = erased.any(dim=1).nonzero(as_tuple=False).view(-1)
+            cols = erased.any(dim=0).nonzero(as_tuple=False).view(-1)
+            rh, rw = rows[-1] - rows[0] + 1, cols[-1] - cols[0] + 1
+            stats.append((bool(flipped), True, float(erased.sum()) / erased.numel(), math.log(float(rh) / float(rw))))
+        else:
+            stats.append((bool(flipped), False, None, None))
+    return stats
+
+
+def _histogram(values, bins):
+    counts, _ = np.histogram(values, bins=bins)
+    return counts / max(counts.sum(), 1)
+
+
+def check_augmentation(augmentation, batch_size=64, rounds=64, rate_tol=0.04, histogram_tol=0.08):
+    height, width = META['imageSize']
+    image = _fixed_image(height, width)
+    reference = _reference(image)
+
+    per_image = TrainTransform('person', META, augmentaion=augmentation)
+    to_uint8 = TrainTransform('person', META, augmentaion=augmentation, batch_augment=True)
+    batched = BatchTrainTransform(META, augmentaion=augmentation)
+
+    per_image_outputs, batched_outputs = [], []
+    for _ in range(rounds):
+        per_image_outputs.extend(per_image(image) for _ in range(batch_size))
+        batched_outputs.extend(batched(default_collate([to_uint8(image) for _ in range(batch_size)])).unbind(0))
+
+    results = [_statistics(outputs, reference) for outputs in (per_image_outputs, batched_outputs)]
+    for i, name in enumerate(('flip rate', 'erasing rate')):
+        rates = [np.mean([s[i] for s in stats]) for stats in results]
+        print('{0} {1}: {2:.3f} (per image) vs {3:.3f} (batched)'.format(augmentation, name, *rates))
+        assert abs(rates[0] - rates[1]) <= rate_tol, '{0} {1}s differ'.format(augmentation, name)
+
+    bins = {'area': np.linspace(0., 0.5, 11), 'log aspect ratio': np.linspace(math.log(0.3), -math.log(0.3), 11)}
+    for i, name in ((2, 'area'), (3, 'log aspect ratio')):
+        histograms = [_histogram([s[i] for s in stats if s[1]], bins[name]) for stats in results]
+        distance = 0.5 * np.abs(histograms[0] - histograms[1]).sum()
+        print('{0} {1} histograms: total variation {2:.3f}'.format(augmentation, name, distance))
+        assert distance <= histogram_tol, 'the {0} histograms of {1} differ'.format(name, augmentation)
+
+
+if __name__ == '__main__':
+    # python -m Dataset.batch_transforms_check RandomErasing Cutout
+    import sys
+
+    # the image-by-image erasing draws from random, the batched one (and the flips) from torch
+    random.seed(0)
+    torch.manual_seed(0)
+    for augmentation in sys.argv[1:] or ['RandomErasing', 'Cutout']:
+        check_augmentation(augmentation)
+    print('the batched augmentation matches the image-by-image one.')
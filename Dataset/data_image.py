@@ -1,49 +1,235 @@
 from __future__ import print_function, absolute_import
 
+import io
+import multiprocessing as mp
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
 from PIL import Image
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+
+
+class ImageReader(object):
+    """Opens images with bounded exponential-backoff retries on IOError.
+    The failures are counted in a shared value, so that the ones in the loader workers are visible to the trainer.
+    This relies on the workers getting the reader when they are started, either inherited by fork or pickled
+    by the start of a spawn/forkserver process (as DataLoader passes its dataset). A reader pickled otherwise,
+    e.g. put in a queue, cannot be pickled; a copy built anew in a process counts its failures apart.
+    After the last retry, the fallback image is substituted if given, otherwise the error is raised."""
+
+    def __init__(self, retries=5, backoff=0.1, fallback=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.fallback = fallback
+        self.failures = mp.Value('i', 0)
+
+    def __call__(self, open_fn, name):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return open_fn().convert('RGB')
+            except IOError as e:
+                error = e
+
+            if attempt < self.retries:
+                print("IOError incurred when reading '{0}'. Will redo in {1:.2f} s.".format(name, delay))
+                time.sleep(delay)
+                delay *= 2
+
+        with self.failures.get_lock():
+            self.failures.value += 1
 
+        if self.fallback is None:
+            raise error
 
-def read_image(img_path):
-    """Keep reading image until succeed.
-    This can avoid IOError incurred by heavy IO process."""
-    got_img = False
-    while not got_img:
-        try:
-            img = Image.open(img_path).convert('RGB')
-            got_img = True
-        except IOError:
-            print("IOError incurred when reading '{}'. Will redo. Don't worry. Just chill.".format(img_path))
-            pass
-    return img
+        print("failed to read '{0}', which is substituted by the fallback image.".format(name))
+        return self.fallback.copy()
+
+
+default_reader = ImageReader()
+
+
+def read_image(img_path, reader=None):
+    if reader is None:
+        reader = default_reader
+    return reader(lambda: Image.open(img_path), img_path)
 
 
 class ImageData(Dataset):
-    def __init__(self, dataset, transform):
+    """io_threads > 0: the images of a batch (all the indices a loader worker is given at once)
+    are read, decoded and transformed concurrently by a thread pool of the worker"""
+
+    def __init__(self, dataset, transform, reader=None, io_threads=0):
         self.dataset = dataset
         self.transform = transform
+        self.reader = default_reader if reader is None else reader
+        self.io_threads = io_threads
+        self._pid = None
 
-    def __getitem__(self, item):
+    @property
+    def read_failures(self):
+        return self.reader.failures.value
+
+    def _local(self):
+        """per-thread state of the current process, since the dataset is copied into the loader workers"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread_local = threading.local()
+            self._executor = None
+        return self._thread_local
+
+    def _map(self, fn, items):
+        if self.io_threads <= 0 or len(items) <= 1:
+            return [fn(i) for i in items]
+
+        self._local()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.io_threads)
+        return list(self._executor.map(fn, items))
+
+    def read(self, item):
+        img_path = self.dataset[item][0]
+        return read_image(img_path, self.reader)
+
+    def _load(self, item):
         if isinstance(item, (list, tuple)):
-            return [self[i] for i in item]
-        img, pid, camid = self.dataset[item]
-        img = read_image(img)
+            return [self._load(i) for i in item]
+        _, pid, camid = self.dataset[item]
+        img = self.read(item)
         if self.transform is not None:
             img = self.transform(img)
         return img, pid, camid
 
+    def __getitem__(self, item):
+        if isinstance(item, (list, tuple)):
+            return self._map(self._load, item)
+        return self._load(item)
+
+    def __getitems__(self, items):
+        return self._map(self._load, items)
+
     def __len__(self):
         return len(self.dataset)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state.pop('_thread_local', None)
+        state.pop('_executor', None)
+        return state
+
+
+class ShardedImageData(ImageData):
+    """ImageData reading the images from the shards of Dataset.shards instead of the small image files.
+    A record following the previous one read by the thread starts a read-ahead block serving the next ones,
+    so the sequential runs of Dataset.samplers.ShardShuffleSampler turn into big sequential reads,
+    while the other records are read by exactly their own bytes."""
+
+    def __init__(self, dataset, transform, shard_index, reader=None, io_threads=0, readahead=4):
+        super(ShardedImageData, self).__init__(dataset, transform, reader, io_threads)
+        self.shard_files = shard_index.shard_files
+        rows = shard_index.lookup([r[0] for r in dataset])
+        if (rows < 0).any():
+            raise ValueError('some images are not packed in the shards')
+        self.shard_ids = shard_index.shard_ids[rows]
+        self.offsets = shard_index.offsets[rows]
+        self.lengths = shard_index.lengths[rows]
+        self.readahead = readahead * 1024 * 1024
+
+    def read_bytes(self, item):
+        local = self._local()
+        if not hasattr(local, 'files'):
+            local.files = {}
+            local.block = (-1, 0, b'')
+            local.last_end = (-1, 0)
+
+        shard_id = int(self.shard_ids[item])
+        offset = int(self.offsets[item])
+        length = int(self.lengths[item])
+
+        block_shard, block_offset, block = local.block
+        if not (block_shard == shard_id and block_offset <= offset
+                and offset + length <= block_offset + len(block)):
+            f = local.files.get(shard_id)
+            if f is None:
+                f = local.files[shard_id] = open(self.shard_files[shard_id], 'rb')
+            f.seek(offset)
+            # a read-ahead block only when the record follows the previous one, otherwise (random or shuffled
+            # access) the block would be mostly discarded
+            sequential = local.last_end == (shard_id, offset)
+            block = f.read(max(length, self.readahead) if sequential else length)
+            block_offset = offset
+            local.block = (shard_id, block_offset, block)
+
+        local.last_end = (shard_id, offset + length)
+        start = offset - block_offset
+        return block[start: start + length]
+
+    def read(self, item):
+        return self.reader(lambda: Image.open(io.BytesIO(self.read_bytes(item))), self.dataset[item][0])
+
+
+class IndexedImageData(ImageData):
+    """ImageData whose samples also carry their indices, (img, pid, camid, index),
+    so that the repeated draws of an image in a batch can be recognized on the device"""
+
+    def _load(self, item):
+        if isinstance(item, (list, tuple)):
+            return [self._load(i) for i in item]
+        return super(IndexedImageData, self)._load(item) + (item, )
+
+
+class ShardedIndexedImageData(IndexedImageData, ShardedImageData):
+    pass
+
+
+class UniquePairBatchImageData(ImageData):
+    """Each item is a whole batch of index pairs (e.g. from BatchSampler(PosNegPairSampler(...))),
+    every distinct image of which is read and transformed only once.
+    Returns (imgs, pids, camids) of the unique images and the positions of side a and side b in them."""
+
+    def __getitem__(self, pairs):
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        unique_indices, inverse = np.unique(pairs.reshape(-1), return_inverse=True)
+        samples = self._map(self._load, unique_indices.tolist())
+        imgs, pids, camids = default_collate(samples)
+        inverse = torch.from_numpy(inverse.reshape(-1, 2))
+        return (imgs, pids, camids), inverse[:, 0].contiguous(), inverse[:, 1].contiguous()
+
+
+class ShardedUniquePairBatchImageData(UniquePairBatchImageData, ShardedImageData):
+    pass
+
+
+class IdentityBatchImageData(ImageData):
+    """Each item is a whole batch (indices, pids, camids) from Dataset.samplers.RandomIdentityBatchSampler.
+    Returns (imgs, pids, camids), the labels of which are taken from the sampler's plan as they are."""
+
+    def __getitem__(self, batch):
+        indices, pids, camids = batch
+        samples = self._map(self._load, indices)
+        imgs = default_collate([img for img, _, _ in samples])
+        return imgs, pids, camids
+
+
+class ShardedIdentityBatchImageData(IdentityBatchImageData, ShardedImageData):
+    pass
+
 
 class PreLoadedImageData(Dataset):
-    def __init__(self, dataset, transform):
+    def __init__(self, dataset, transform, source=None):
+        """source: an ImageData (e.g. ShardedImageData) to read the images from, by default the image files"""
         self.transform = transform
         self.dataset = []
 
         print('preloading images.....')
-        for img, pid, camid in dataset:
-            img = read_image(img)
+        for i, (img, pid, camid) in enumerate(dataset):
+            img = read_image(img) if source is None else source.read(i)
             img = self.transform.pre_process(img)
             self.dataset.append((img, pid, camid))
         print('done.')
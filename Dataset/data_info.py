@@ -6,9 +6,12 @@ import random
 import re
 import warnings
 from abc import abstractmethod
-from collections import defaultdict
 from os import path as osp
 
+import numpy as np
+
+from Dataset.manifest import MANIFEST_SUFFIX, cached_manifest, to_columns, to_records
+
 """Dataset classes"""
 
 ROOT = '../../data'
@@ -28,12 +31,13 @@ class __Dataset(object):
 
     def reduce_query(self):
         print('reduce the query set by remaining one image for each query id')
-        qpid2index = defaultdict(list)
-        for i, r in enumerate(self.query):
-            qpid2index[r[1]].append(i)
+        paths, pids, camids = to_columns(self.query)
 
-        keep_indices = [random.choice(indices) for _, indices in qpid2index.items()]
-        self.query = [self.query[i] for i in keep_indices]
+        # the first occurrence of each pid in a random permutation is a random choice among its images
+        perm = np.random.permutation(len(pids))
+        _, first = np.unique(pids[perm], return_index=True)
+        keep_indices = np.sort(perm[first])
+        self.query = to_records(paths[keep_indices], pids[keep_indices], camids[keep_indices])
 
     @abstractmethod
     def __init__(self):
@@ -45,40 +49,25 @@ class __Dataset(object):
 
     @staticmethod
     def _get_subpids_dataset(dataset, subpids_num):
-        pid_container = set()
-        pid2index = defaultdict(list)
-        for i, (_, pid, _) in enumerate(dataset):
-            pid_container.add(pid)
-            pid2index[pid].append(i)
+        paths, pids, camids = to_columns(dataset)
+        pid_container = np.unique(pids)
 
         if subpids_num > len(pid_container):
             raise ValueError
 
-        pids_keep = set(random.sample(pid_container, subpids_num))
-        pids_remove = pid_container - pids_keep
-        dataset_keep = []
-        dataset_remove = []
-        for pid in pids_keep:
-            indices_keep = pid2index[pid]
-            for i in indices_keep:
-                dataset_keep.append(dataset[i])
+        pids_keep = np.random.choice(pid_container, subpids_num, replace=False)
+        kept = np.isin(pids, pids_keep)
+        dataset_keep = to_records(paths[kept], pids[kept], camids[kept])
+        dataset_remove = to_records(paths[~kept], pids[~kept], camids[~kept])
 
-        for pid in pids_remove:
-            indices_remove = pid2index[pid]
-            for i in indices_remove:
-                dataset_remove.append(dataset[i])
-
-        return dataset_keep, dataset_remove, pids_keep
+        return dataset_keep, dataset_remove, set(pids_keep.tolist())
 
     @staticmethod
     def _get_dataset_of_pids(dataset, pids):
-        dataset_keep = []
-        dataset_remove = []
-        for record in dataset:
-            if record[1] in pids:
-                dataset_keep.append(record)
-            else:
-                dataset_remove.append(record)
+        paths, pids_, camids = to_columns(dataset)
+        kept = np.isin(pids_, np.array(list(pids), dtype=np.int64))
+        dataset_keep = to_records(paths[kept], pids_[kept], camids[kept])
+        dataset_remove = to_records(paths[~kept], pids_[~kept], camids[~kept])
 
         return dataset_keep, dataset_remove
 
@@ -99,29 +88,13 @@ class __Dataset(object):
 
         oriset = self.__getattribute__(name)
 
-        pid_containers = []
-
-        for dataset in (oriset, addset):
-            pid_container = set()
-            for _, pid, _ in dataset:
-                pid_container.add(pid)
-            pid_containers.append(pid_container)
-
-        pid_maps = []
-        new_id_cur = -1
-        for pid_container in pid_containers:
-            pid_map = dict()
-            for pid in pid_container:
-                new_id_cur += 1
-                pid_map[pid] = new_id_cur
-
-            pid_maps.append(pid_map)
-
         dataset_new = []
-        for dataset, pid_map in zip([oriset, addset], pid_maps):
-            for im_path, pid, pcamid in dataset:
-                pid = pid_map[pid]
-                dataset_new.append((im_path, pid, pcamid))
+        new_id_cur = 0
+        for dataset in (oriset, addset):
+            paths, pids, camids = to_columns(dataset)
+            pid_container, pids = np.unique(pids, return_inverse=True)
+            dataset_new += to_records(paths, pids + new_id_cur, camids)
+            new_id_cur += len(pid_container)
 
         self.__setattr__(name, dataset_new)
 
@@ -148,11 +121,8 @@ class __Dataset(object):
             raise ValueError
 
         dataset = self.__getattribute__(name)
-        pid_container = set()
-        for _, pid, _ in dataset:
-            pid_container.add(pid)
-
-        num_pids = len(pid_container)
+        _, pids, _ = to_columns(dataset)
+        num_pids = len(np.unique(pids))
 
         self.__setattr__('num_{0}_pids'.format(name), num_pids)
 
@@ -218,23 +188,14 @@ class CommonData(__Dataset):
         self.num_query_pids = num_query_pids
         self.num_gallery_pids = num_gallery_pids
 
-    def _process_dir(self, dir_path, relabel=False):
-        if relabel:
-            warnings.warn('relabel makes pid inconsistent with attributes data')
-
+    @staticmethod
+    def _parse_dir(dir_path):
         img_names = os.listdir(dir_path)
         img_paths = [os.path.join(dir_path, img_name) for img_name in img_names \
                      if img_name.endswith('jpg') or img_name.endswith('png')]
         pattern = re.compile(r'([-\d]+)_c([-\d]+)')
 
-        pid_container = set()
-        for img_path in img_paths:
-            pid, _ = map(int, pattern.search(img_path).groups())
-            if pid == -1: continue  # junk images are just ignored
-            pid_container.add(pid)
-        pid2label = {pid: label for label, pid in enumerate(pid_container)}
-
-        dataset = []
+        paths, pids, camids = [], [], []
         for img_path in img_paths:
             pid, camid = map(int, pattern.search(img_path).groups())
             if pid == -1:
@@ -242,10 +203,24 @@ class CommonData(__Dataset):
             # assert 0 <= pid <= 1501  # pid == 0 means background
             # assert 1 <= camid <= 6
             camid -= 1  # index starts from 0
-            if relabel:
-                pid = pid2label[pid]
-            dataset.append((img_path, pid, camid))
+            paths.append(img_path)
+            pids.append(pid)
+            camids.append(camid)
+
+        return paths, pids, camids
+
+    def _process_dir(self, dir_path, relabel=False):
+        if relabel:
+            warnings.warn('relabel makes pid inconsistent with attributes data')
+
+        paths, pids, camids = cached_manifest(dir_path.rstrip('/\\') + MANIFEST_SUFFIX, [dir_path],
+                                              lambda: self._parse_dir(dir_path))
+
+        pid_container, labels = np.unique(pids, return_inverse=True)
+        if relabel:
+            pids = labels
 
+        dataset = to_records(paths, pids, camids)
         num_pids = len(pid_container)
         num_imgs = len(dataset)
         return dataset, num_pids, num_imgs
@@ -306,28 +281,34 @@ class MSMT17(__Dataset):
         #self.images_dir = ''
         #self.num_cams = 15
 
-    def _process_dir(self, dir_path, list_path, relabel=False):
-        if relabel:
-            warnings.warn('relabel makes pids inconsistent with attributes data')
-
+    @staticmethod
+    def _parse_list(dir_path, list_path):
         with open(list_path, 'r') as txt:
             lines = txt.readlines()
-        dataset = []
-        pid_container = set()
+
+        paths, pids, camids = [], [], []
         for img_idx, img_info in enumerate(lines):
             img_path, pid = img_info.split(' ')
-            pid = int(pid)
-            camid = int(img_path.split('_')[2]) - 1
-            img_path = osp.join(dir_path, img_path)
-            dataset.append((img_path, pid, camid))
-            pid_container.add(pid)
-        pid2label = {pid: label for label, pid in enumerate(pid_container)}
+            paths.append(osp.join(dir_path, img_path))
+            pids.append(int(pid))
+            camids.append(int(img_path.split('_')[2]) - 1)
 
-        num_imgs = len(dataset)
-        num_pids = len(pid_container)
+        return paths, pids, camids
+
+    def _process_dir(self, dir_path, list_path, relabel=False):
+        if relabel:
+            warnings.warn('relabel makes pids inconsistent with attributes data')
+
+        paths, pids, camids = cached_manifest(list_path + MANIFEST_SUFFIX, [dir_path, list_path],
+                                              lambda: self._parse_list(dir_path, list_path))
 
+        pid_container, labels = np.unique(pids, return_inverse=True)
         if relabel:
-            dataset = [(img_path, pid2label[pid], camid) for img_path, pid, camid in dataset]
+            pids = labels
+
+        dataset = to_records(paths, pids, camids)
+        num_imgs = len(dataset)
+        num_pids = len(pid_container)
 
         return dataset, num_pids, num_imgs
 
@@ -339,7 +320,7 @@ def init_dataset(name, train_relabel, subpids_num=-1):
         dataset = CommonData(name, train_relabel)
 
     if subpids_num > 0:
-        dataset.subsample_test_set(subpids_num)
+        dataset.subsample_testset(subpids_num)
 
     return dataset
 
@@ -348,29 +329,18 @@ def combine_incompatible_trainsets(subsets):
     warnings.warn('combining multiple incompatibe train sets makes pids'
                   'inconsistent with corresponding attributes data')
 
-    camid_maps = []
-    camid_map_cur = 0
-    for subset in subsets:
-        cams = list(set([r[2] for r in subset]))
-        map_ = {cam: camid_map_cur + i for i, cam in enumerate(cams)}
-        camid_maps.append(map_)
-        camid_map_cur += len(cams)
-
-    pid_maps = []
+    combined_set = []
     pid_map_cur = 0
+    camid_map_cur = 0
     for subset in subsets:
-        pids = list(set([r[1] for r in subset]))
-        map_ = {pid: pid_map_cur + i for i, pid in enumerate(pids)}
-        pid_maps.append(map_)
-        pid_map_cur += len(pids)
-
-    combined_set = []
-    for subset, pid_map, camid_map in zip(subsets, pid_maps, camid_maps):
-        for record in subset:
-            record_new = (record[0], pid_map[record[1]], camid_map[record[2]])
-            combined_set.append(record_new)
-
-    num_pids = sum([len(m) for m in pid_maps])
+        paths, pids, camids = to_columns(subset)
+        pid_container, pids = np.unique(pids, return_inverse=True)
+        cam_container, camids = np.unique(camids, return_inverse=True)
+        combined_set += to_records(paths, pids + pid_map_cur, camids + camid_map_cur)
+        pid_map_cur += len(pid_container)
+        camid_map_cur += len(cam_container)
+
+    num_pids = pid_map_cur
     num_imgs = len(combined_set)
 
     return combined_set, num_pids, num_imgs
@@ -391,35 +361,26 @@ def combine_incompatibe_testsets(query_sets, gallery_sets, resample=True):
         query_sets = __resampe_subsets(query_sets)
         gallery_sets = __resampe_subsets(gallery_sets)
 
-    camid_maps = []
     camid_map_cur = 0
-    pid_maps = []
     pid_map_cur = 0
     combined_query_set = []
     combined_gallery_set = []
     for query_set, gallery_set in zip(query_sets, gallery_sets):
-        total_set = query_set + gallery_set
-
-        cams = list(set([r[2] for r in total_set]))
-        camid_map = {cam: camid_map_cur + i for i, cam in enumerate(cams)}
-        camid_maps.append(camid_map)
-        camid_map_cur += len(cams)
-
-        pids = list(set([r[1] for r in total_set]))
-        pid_map = {pid: pid_map_cur + i for i, pid in enumerate(pids)}
-        pid_maps.append(pid_map)
-        pid_map_cur += len(pids)
+        query_num = len(query_set)
+        paths, pids, camids = to_columns(query_set + gallery_set)
 
-        for record in query_set:
-            record_new = (record[0], pid_map[record[1]], camid_map[record[2]])
-            combined_query_set.append(record_new)
+        pid_container, pids = np.unique(pids, return_inverse=True)
+        cam_container, camids = np.unique(camids, return_inverse=True)
+        pids += pid_map_cur
+        camids += camid_map_cur
+        pid_map_cur += len(pid_container)
+        camid_map_cur += len(cam_container)
 
-        for record in gallery_set:
-            record_new = (record[0], pid_map[record[1]], camid_map[record[2]])
-            combined_gallery_set.append(record_new)
+        combined_query_set += to_records(paths[:query_num], pids[:query_num], camids[:query_num])
+        combined_gallery_set += to_records(paths[query_num:], pids[query_num:], camids[query_num:])
 
-    num_query_pids = len(set([r[1] for r in combined_query_set]))
-    num_gallery_pids = len(set([r[1] for r in combined_gallery_set]))
+    num_query_pids = len(np.unique(to_columns(combined_query_set)[1]))
+    num_gallery_pids = len(np.unique(to_columns(combined_gallery_set)[1]))
     num_query_imgs = len(combined_query_set)
     num_gallery_imgs = len(combined_gallery_set)
 
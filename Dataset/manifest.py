@@ -0,0 +1,73 @@
+# encoding: utf-8
+import os
+import warnings
+
+import numpy as np
+
+'''columnar caches (image paths, pids, camids) of parsed dataset directories'''
+
+MANIFEST_SUFFIX = '.manifest.npz'
+
+
+def _signature(sources):
+    """mtime & size of the files/directories which a manifest was parsed from"""
+    signature = []
+    for source in sources:
+        st = os.stat(source)
+        signature.extend([st.st_mtime_ns, st.st_size])
+    return np.array(signature, dtype=np.int64)
+
+
+def load_manifest(manifest_path, sources):
+    """return (paths, pids, camids) arrays, or None if the manifest is missing or out of date"""
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with np.load(manifest_path, allow_pickle=False) as data:
+            if not np.array_equal(data['signature'], _signature(sources)):
+                return None
+            return data['paths'], data['pids'], data['camids']
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def save_manifest(manifest_path, sources, paths, pids, camids):
+    tmp_path = manifest_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     signature=_signature(sources),
+                     paths=np.array(paths, dtype=np.str_),
+                     pids=np.array(pids, dtype=np.int64),
+                     camids=np.array(camids, dtype=np.int64))
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        warnings.warn('failed to write the manifest {0}: {1}'.format(manifest_path, e))
+
+
+def cached_manifest(manifest_path, sources, build):
+    """load the manifest if it is up to date, otherwise parse the sources by build() and cache the result.
+    build() should return the lists (paths, pids, camids)."""
+    manifest = load_manifest(manifest_path, sources)
+    if manifest is not None:
+        return manifest
+
+    paths, pids, camids = build()
+    save_manifest(manifest_path, sources, paths, pids, camids)
+    return (np.array(paths, dtype=np.str_),
+            np.array(pids, dtype=np.int64),
+            np.array(camids, dtype=np.int64))
+
+
+def to_columns(dataset):
+    """list of (path, pid, camid) records -> arrays of paths, pids and camids"""
+    if len(dataset) == 0:
+        return np.array([], dtype=np.str_), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    paths, pids, camids = zip(*dataset)
+    return np.array(paths, dtype=np.str_), np.array(pids, dtype=np.int64), np.array(camids, dtype=np.int64)
+
+
+def to_records(paths, pids, camids):
+    """arrays of paths, pids and camids -> list of (path, pid, camid) records"""
+    return list(zip(paths.tolist(), pids.tolist(), camids.tolist()))
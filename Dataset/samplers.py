@@ -1,11 +1,13 @@
 from __future__ import absolute_import
 
+import itertools
 from collections import defaultdict
 
+import numpy as np
 import torch
-from numpy.random import choice as randchoice
-from numpy.random import uniform as randuniform
-from torch.utils.data.sampler import Sampler
+from torch.utils.data.sampler import Sampler, BatchSampler
+
+from Utils.distributed import get_rank, get_world_size
 
 
 # class PosNegPairLearnableSampler(Sampler):
@@ -48,8 +50,36 @@ from torch.utils.data.sampler import Sampler
 #         return self.length
 
 
-class PosNegPairSampler(Sampler):
-    def __init__(self, data_source, pos_rate=0.5, sample_num_per_epoch=500*256):
+class ResumableSampler(object):
+    """Mixin of the samplers drawing from their own RandomState, the epochs of which can be resumed at any position.
+    The state at the start of the epoch and the number of consumed units (samples or batches) are saved,
+    and resuming redraws the epoch from that state and skips the consumed units.
+    The saved position does not depend on how far the loader has prefetched."""
+
+    def _init_rng(self, seed=None):
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self.rng = np.random.RandomState(seed)
+        self._epoch_state = None
+        self._skip = 0
+
+    def _start_epoch(self):
+        """call it at the start of __iter__, it returns the number of units to skip"""
+        self._epoch_state = self.rng.get_state()
+        skip, self._skip = self._skip, 0
+        return skip
+
+    def state_dict(self, consumed=0):
+        state = self.rng.get_state() if self._epoch_state is None else self._epoch_state
+        return {'rng': state, 'consumed': consumed}
+
+    def load_state_dict(self, state):
+        self.rng.set_state(state['rng'])
+        self._skip = state['consumed']
+
+
+class PosNegPairSampler(ResumableSampler, Sampler):
+    def __init__(self, data_source, pos_rate=0.5, sample_num_per_epoch=500*256, seed=None):
         super(PosNegPairSampler, self).__init__(data_source)
         self.data_source = data_source
         self.pos_rate = pos_rate
@@ -58,9 +88,13 @@ class PosNegPairSampler(Sampler):
             self.index_dic[pid].append(index)
         self.pids = list(self.index_dic.keys())
         self.length = sample_num_per_epoch
+        self._init_rng(seed)
 
     def __iter__(self):
+        skip = self._start_epoch()
         self.cur_idx = -1
+        for _ in range(skip):
+            next(self)
         return self
 
     def __next__(self):
@@ -68,16 +102,16 @@ class PosNegPairSampler(Sampler):
         if self.cur_idx >= self.length:
             raise StopIteration
 
-        if randuniform() < self.pos_rate:
+        if self.rng.uniform() < self.pos_rate:
             '''positive pair'''
-            pid = randchoice(self.pids)
+            pid = self.rng.choice(self.pids)
             candidates = self.index_dic[pid]
-            chosen = tuple(randchoice(candidates, size=2, replace=True))
+            chosen = tuple(self.rng.choice(candidates, size=2, replace=True))
 
         else:
             '''negative pair'''
-            pid_pair = tuple(randchoice(self.pids, size=2, replace=False))
-            chosen = tuple([randchoice(self.index_dic[pid]) for pid in pid_pair])
+            pid_pair = tuple(self.rng.choice(self.pids, size=2, replace=False))
+            chosen = tuple([self.rng.choice(self.index_dic[pid]) for pid in pid_pair])
 
         return chosen
 
@@ -87,27 +121,344 @@ class PosNegPairSampler(Sampler):
         return self.length
 
 
-class RandomIdentitySampler(Sampler):
-    def __init__(self, data_source, num_instances=4):
+class DistributedSampling(object):
+    """Mixin of the resumable samplers for the training of several processes (see Utils.distributed).
+    All the ranks draw the same sequence from the same seed, and each one keeps its share,
+    so the shares of a step never overlap and a saved position is valid on every rank."""
+
+    def _init_distributed(self, seed, rank=None, world_size=None):
+        if seed is None:
+            raise ValueError('the ranks should share the seed of the sampler')
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+
+
+class DistributedDraws(DistributedSampling):
+    """for the samplers drawing the units (samples) one by one:
+    each rank keeps the rank-th unit of every round of world_size draws"""
+
+    def __next__(self):
+        chosen = None
+        for r in range(self.world_size):
+            unit = super(DistributedDraws, self).__next__()
+            if r == self.rank:
+                chosen = unit
+        return chosen
+
+    next = __next__  # Python 2 compatibility
+
+    def __len__(self):
+        return super(DistributedDraws, self).__len__() // self.world_size
+
+
+class DistributedPosNegPairSampler(DistributedDraws, PosNegPairSampler):
+    """sample_num_per_epoch is the number of pairs of all the ranks"""
+
+    def __init__(self, data_source, pos_rate=0.5, sample_num_per_epoch=500*256, seed=0, rank=None, world_size=None):
+        super(DistributedPosNegPairSampler, self).__init__(data_source, pos_rate, sample_num_per_epoch, seed)
+        self._init_distributed(seed, rank, world_size)
+
+
+class HardPairMining(object):
+    """Mixin of the pair samplers, which draws hard pairs from a bank of training features:
+    negatives among the neg_candidates nearest samples of other identities,
+    positives as the farthest sample of the same identity.
+    Until the first update_bank(), or with probability 1 - hard_rate, pairs are drawn as before."""
+
+    def _init_mining(self, data_source, hard_rate=0.5, neg_candidates=10):
+        self.hard_rate = hard_rate
+        self.neg_candidates = neg_candidates
+        self.index_pids = np.array([r[1] for r in data_source], dtype=np.int64)
+        self.bank = None
+        self.hard_negatives = None
+        self.hard_positives = None
+
+    def update_bank(self, bank, chunk_size=1024):
+        """bank: [N, D] float16 features of the samples in data_source, L2-normalized"""
+        self.bank = bank
+        n = bank.size(0)
+        k = min(self.neg_candidates, n - 1)
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        feats = bank.to(device)
+        pids = torch.from_numpy(self.index_pids).to(device)
+
+        hard_negatives = []
+        hard_positives = []
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            sims = torch.mm(feats[start:end].float(), feats.float().t())
+            same = pids[start:end].unsqueeze(1) == pids.unsqueeze(0)
+
+            hard_negatives.append(sims.masked_fill(same, -float('inf')).topk(k, dim=1)[1].cpu())
+
+            # the sample itself (similarity 2 > any cosine) is the fallback of the identities with only one image
+            sims = sims.masked_fill(~same, float('inf'))
+            sims[torch.arange(end - start, device=device), torch.arange(start, end, device=device)] = 2.
+            hard_positives.append(sims.argmin(dim=1).cpu())
+
+        self.hard_negatives = torch.cat(hard_negatives, dim=0).numpy()
+        self.hard_positives = torch.cat(hard_positives, dim=0).numpy()
+
+    def mining_state_dict(self):
+        """the bank and the hard pairs mined from it, which a step checkpoint restores instead of mining again
+        from the model of the middle of the epoch"""
+        return {'bank': None if self.bank is None else self.bank.cpu(),
+                'hard_negatives': self.hard_negatives,
+                'hard_positives': self.hard_positives}
+
+    def load_mining_state_dict(self, state):
+        self.bank = state['bank']
+        self.hard_negatives = state['hard_negatives']
+        self.hard_positives = state['hard_positives']
+
+    def _use_hard(self):
+        return self.hard_negatives is not None and self.rng.uniform() < self.hard_rate
+
+    def _hard_pos_pair(self):
+        anchor = self.rng.randint(len(self.index_pids))
+        return anchor, int(self.hard_positives[anchor])
+
+    def _hard_neg_pair(self):
+        anchor = self.rng.randint(len(self.index_pids))
+        return anchor, int(self.hard_negatives[anchor, self.rng.randint(self.hard_negatives.shape[1])])
+
+
+class HardPosNegPairSampler(HardPairMining, PosNegPairSampler):
+    def __init__(self, data_source, pos_rate=0.5, sample_num_per_epoch=500*256, hard_rate=0.5, neg_candidates=10,
+                 seed=None):
+        super(HardPosNegPairSampler, self).__init__(data_source, pos_rate, sample_num_per_epoch, seed)
+        self._init_mining(data_source, hard_rate, neg_candidates)
+
+    def __next__(self):
+        if not self._use_hard():
+            return super(HardPosNegPairSampler, self).__next__()
+
+        self.cur_idx += 1
+        if self.cur_idx >= self.length:
+            raise StopIteration
+
+        if self.rng.uniform() < self.pos_rate:
+            return self._hard_pos_pair()
+        else:
+            return self._hard_neg_pair()
+
+    next = __next__  # Python 2 compatibility
+
+
+class DistributedHardPosNegPairSampler(DistributedDraws, HardPosNegPairSampler):
+    def __init__(self, data_source, pos_rate=0.5, sample_num_per_epoch=500*256, hard_rate=0.5, neg_candidates=10,
+                 seed=0, rank=None, world_size=None):
+        super(DistributedHardPosNegPairSampler, self).__init__(data_source, pos_rate, sample_num_per_epoch, hard_rate,
+                                                               neg_candidates, seed)
+        self._init_distributed(seed, rank, world_size)
+
+
+class RandomIdentitySampler(ResumableSampler, Sampler):
+    """P x K sampling: num_instances (K) images of each identity, ids_per_batch (P) identities per batch.
+    The plan of a whole epoch is drawn at once over the indices grouped by pid (a CSR layout).
+    Identities left over by the last complete batch are dropped, so every batch holds exactly P x K images."""
+
+    def __init__(self, data_source, num_instances=4, ids_per_batch=None, seed=None):
         super(RandomIdentitySampler, self).__init__(data_source)
         self.data_source = data_source
         self.num_instances = num_instances
-        self.index_dic = defaultdict(list)
-        for index, (_, pid, _) in enumerate(data_source):
-            self.index_dic[pid].append(index)
-        self.pids = list(self.index_dic.keys())
+        self.index_pids = np.array([r[1] for r in data_source], dtype=np.int64)
+        self.index_camids = np.array([r[2] for r in data_source], dtype=np.int64)
+
+        self.index_order = np.argsort(self.index_pids, kind='stable')
+        self.pids, self.starts, self.counts = np.unique(self.index_pids[self.index_order],
+                                                        return_index=True, return_counts=True)
         self.num_identities = len(self.pids)
+        self.groups = np.repeat(np.arange(self.num_identities), self.counts)
+
+        self.ids_per_batch = self.num_identities if ids_per_batch is None else ids_per_batch
+        if not 0 < self.ids_per_batch <= self.num_identities:
+            raise ValueError('ids_per_batch should be in [1, {0}]'.format(self.num_identities))
+        self.batch_num = self.num_identities // self.ids_per_batch
+        self._init_rng(seed)
+
+    def plan(self):
+        """indices of the epoch, in shape [batch_num, ids_per_batch * num_instances]"""
+        k = self.num_instances
+
+        # shuffle the indices within each identity by sorting on (identity, random key)
+        shuffled = self.index_order[np.lexsort((self.rng.rand(len(self.groups)), self.groups))]
+
+        chosen = self.rng.permutation(self.num_identities)[:self.batch_num * self.ids_per_batch]
+        starts = self.starts[chosen][:, None]
+        counts = self.counts[chosen][:, None]
+
+        # the first k of the shuffled indices, or k draws with replacement for the identities with fewer images
+        offsets = np.where(counts >= k,
+                           np.arange(k)[None, :],
+                           np.floor(self.rng.rand(len(chosen), k) * counts).astype(np.int64))
+
+        return shuffled[starts + offsets].reshape(self.batch_num, -1)
+
+    def labels(self, indices):
+        return self.index_pids[indices], self.index_camids[indices]
 
     def __iter__(self):
-        indices = torch.randperm(self.num_identities)
-        ret = []
-        for i in indices:
-            pid = self.pids[i]
-            t = self.index_dic[pid]
-            replace = False if len(t) >= self.num_instances else True
-            t = randchoice(t, size=self.num_instances, replace=replace)
-            ret.extend(t)
-        return iter(ret)
+        skip = self._start_epoch()
+        return iter(self.plan().reshape(-1)[skip:].tolist())
 
     def __len__(self):
-        return self.num_identities * self.num_instances
+        return self.batch_num * self.ids_per_batch * self.num_instances
+
+
+class RandomIdentityBatchSampler(RandomIdentitySampler):
+    """yields the P x K batches of RandomIdentitySampler,
+    as (indices, pids, camids) if with_labels (see Dataset.data_image.IdentityBatchImageData), otherwise indices"""
+
+    def __init__(self, data_source, num_instances=4, ids_per_batch=None, with_labels=True, seed=None):
+        super(RandomIdentityBatchSampler, self).__init__(data_source, num_instances, ids_per_batch, seed)
+        self.with_labels = with_labels
+
+    def __iter__(self):
+        skip = self._start_epoch()
+        return self._batches(self.plan()[skip:])
+
+    def _batches(self, plan):
+        pids, camids = self.labels(plan)
+        for indices, batch_pids, batch_camids in zip(plan.tolist(), pids, camids):
+            if self.with_labels:
+                yield indices, torch.from_numpy(batch_pids), torch.from_numpy(batch_camids)
+            else:
+                yield indices
+
+    def __len__(self):
+        return self.batch_num
+
+
+class DistributedRandomIdentityBatchSampler(DistributedSampling, RandomIdentityBatchSampler):
+    """the identities of every P x K batch are split among the ranks, each of which gets (P / world_size) x K images"""
+
+    def __init__(self, data_source, num_instances=4, ids_per_batch=None, with_labels=True, seed=0,
+                 rank=None, world_size=None):
+        super(DistributedRandomIdentityBatchSampler, self).__init__(data_source, num_instances, ids_per_batch,
+                                                                    with_labels, seed)
+        self._init_distributed(seed, rank, world_size)
+        if self.ids_per_batch % self.world_size != 0:
+            raise ValueError('ids_per_batch should be divisible by the number of processes')
+
+    def plan(self):
+        plan = super(DistributedRandomIdentityBatchSampler, self).plan()
+        plan = plan.reshape(self.batch_num, self.ids_per_batch, self.num_instances)
+        return plan[:, self.rank::self.world_size].reshape(self.batch_num, -1)
+
+
+class ShardShuffleSampler(ResumableSampler, Sampler):
+    """Visits the shards of a ShardedImageData in random order and each shard sequentially,
+    shuffling the indices through a buffer of buffer_size, so that the reads stay sequential within a window."""
+
+    def __init__(self, data_source, buffer_size=2048, seed=None):
+        super(ShardShuffleSampler, self).__init__(data_source)
+        self.buffer_size = max(buffer_size, 1)
+        self.shard_ids = data_source.shard_ids
+        self.offsets = data_source.offsets
+        self.length = len(self.shard_ids)
+        self._init_rng(seed)
+
+    def _sequence(self):
+        shard_num = int(self.shard_ids.max()) + 1 if self.length > 0 else 0
+        shard_rank = self.rng.permutation(shard_num)[self.shard_ids]
+        return np.lexsort((self.offsets, shard_rank))
+
+    def __iter__(self):
+        skip = self._start_epoch()
+        return itertools.islice(self._shuffle(), skip, None)
+
+    def _shuffle(self):
+        buffer = []
+        for i in self._sequence().tolist():
+            if len(buffer) < self.buffer_size:
+                buffer.append(i)
+                continue
+            j = self.rng.randint(self.buffer_size)
+            yield buffer[j]
+            buffer[j] = i
+
+        self.rng.shuffle(buffer)
+        for i in buffer:
+            yield i
+
+    def __len__(self):
+        return self.length
+
+
+class DistributedShardShuffleSampler(DistributedSampling, ShardShuffleSampler):
+    """each rank takes every world_size-th index of the shuffled sequence,
+    the indices left over by the last round of world_size dropped"""
+
+    def __init__(self, data_source, buffer_size=2048, seed=0, rank=None, world_size=None):
+        super(DistributedShardShuffleSampler, self).__init__(data_source, buffer_size, seed)
+        self._init_distributed(seed, rank, world_size)
+
+    def __iter__(self):
+        skip = self._start_epoch()
+        share = itertools.islice(self._shuffle(), self.rank, len(self) * self.world_size, self.world_size)
+        return itertools.islice(share, skip, None)
+
+    def __len__(self):
+        return self.length // self.world_size
+
+
+class ShuffleSampler(ResumableSampler, Sampler):
+    """a random permutation of the indices in each epoch, as RandomSampler"""
+
+    def __init__(self, data_source, seed=None):
+        super(ShuffleSampler, self).__init__(data_source)
+        self.length = len(data_source)
+        self._init_rng(seed)
+
+    def __iter__(self):
+        skip = self._start_epoch()
+        return iter(self.rng.permutation(self.length)[skip:].tolist())
+
+    def __len__(self):
+        return self.length
+
+
+class DistributedShuffleSampler(DistributedSampling, ShuffleSampler):
+    """each rank takes every world_size-th index of the permutation,
+    the indices left over by the last round of world_size dropped"""
+
+    def __init__(self, data_source, seed=0, rank=None, world_size=None):
+        super(DistributedShuffleSampler, self).__init__(data_source, seed)
+        self._init_distributed(seed, rank, world_size)
+
+    def __iter__(self):
+        skip = self._start_epoch()
+        share = self.rng.permutation(self.length)[self.rank:len(self) * self.world_size:self.world_size]
+        return iter(share[skip:].tolist())
+
+    def __len__(self):
+        return self.length // self.world_size
+
+
+def _get_resumable_sampler(loader):
+    """the ResumableSampler of a DataLoader, and the number of its units in a batch"""
+    if isinstance(loader.batch_sampler, ResumableSampler):
+        return loader.batch_sampler, 1
+
+    sampler = loader.sampler
+    if loader.batch_size is None:
+        if isinstance(sampler, BatchSampler):
+            return sampler.sampler, sampler.batch_size
+        return sampler, 1
+
+    return sampler, loader.batch_size
+
+
+def loader_sampler_state(loader, consumed_batches):
+    sampler, unit = _get_resumable_sampler(loader)
+    if not isinstance(sampler, ResumableSampler):
+        return None
+    return sampler.state_dict(consumed_batches * unit)
+
+
+def load_loader_sampler_state(loader, state):
+    sampler, _ = _get_resumable_sampler(loader)
+    if state is None or not isinstance(sampler, ResumableSampler):
+        return
+    sampler.load_state_dict(state)
@@ -0,0 +1,96 @@
+# encoding: utf-8
+import os
+from os import path as osp
+
+import numpy as np
+
+'''
+A dataset split packed into a few large shard files, so that images are read by big sequential reads
+instead of opening many small files. Each shard is the plain concatenation of the encoded image files;
+<name>.index.npz holds, for every image, its original path and the (shard, offset, length) of its bytes.
+'''
+
+SHARD_NAME = '{0}-{1:05d}.bin'
+INDEX_NAME = '{0}.index.npz'
+
+
+def pack_shards(paths, shards_dir, name, shard_size=256):
+    """write the image files into shards of about shard_size MB, and the offset index"""
+    if not osp.exists(shards_dir):
+        os.makedirs(shards_dir)
+
+    shard_bytes = shard_size * 1024 * 1024
+    shard_ids = np.zeros(len(paths), dtype=np.int64)
+    offsets = np.zeros(len(paths), dtype=np.int64)
+    lengths = np.zeros(len(paths), dtype=np.int64)
+
+    print('packing {0} images into shards of {1} under {2} ...'.format(len(paths), name, shards_dir))
+    shard_id = 0
+    shard = open(osp.join(shards_dir, SHARD_NAME.format(name, shard_id)), 'wb')
+    try:
+        for i, path in enumerate(paths):
+            if shard.tell() >= shard_bytes:
+                shard.close()
+                shard_id += 1
+                shard = open(osp.join(shards_dir, SHARD_NAME.format(name, shard_id)), 'wb')
+
+            with open(path, 'rb') as f:
+                content = f.read()
+            shard_ids[i] = shard_id
+            offsets[i] = shard.tell()
+            lengths[i] = len(content)
+            shard.write(content)
+    finally:
+        shard.close()
+
+    index_path = osp.join(shards_dir, INDEX_NAME.format(name))
+    with open(index_path + '.tmp', 'wb') as f:
+        np.savez(f,
+                 paths=np.array(paths, dtype=np.str_),
+                 shard_ids=shard_ids,
+                 offsets=offsets,
+                 lengths=lengths)
+    os.replace(index_path + '.tmp', index_path)
+    print('{0} shards written.'.format(shard_id + 1))
+
+
+class ShardIndex(object):
+    """locations of the images of a packed dataset split"""
+
+    def __init__(self, shards_dir, name):
+        with np.load(osp.join(shards_dir, INDEX_NAME.format(name)), allow_pickle=False) as data:
+            self.paths = data['paths']
+            self.shard_ids = data['shard_ids']
+            self.offsets = data['offsets']
+            self.lengths = data['lengths']
+
+        self.shard_files = [osp.join(shards_dir, SHARD_NAME.format(name, i))
+                            for i in range(int(self.shard_ids.max()) + 1 if len(self.shard_ids) > 0 else 0)]
+        self._order = np.argsort(self.paths)
+
+    def lookup(self, paths):
+        """rows of the given image paths in the index, -1 for the paths which are not packed"""
+        paths = np.asarray(paths, dtype=np.str_)
+        if len(self.paths) == 0:
+            return np.full(len(paths), -1, dtype=np.int64)
+
+        pos = np.searchsorted(self.paths, paths, sorter=self._order)
+        pos = np.minimum(pos, len(self.paths) - 1)
+        rows = self._order[pos]
+        rows[self.paths[rows] != paths] = -1
+        return rows
+
+    def valid(self):
+        return all(osp.exists(f) for f in self.shard_files)
+
+
+def open_shards(records, shards_dir, name, shard_size=256):
+    """index of the shards holding all the images of records, which are (re)packed if necessary"""
+    paths = [r[0] for r in records]
+    if osp.exists(osp.join(shards_dir, INDEX_NAME.format(name))):
+        index = ShardIndex(shards_dir, name)
+        if index.valid() and (index.lookup(paths) >= 0).all():
+            return index
+
+    pack_shards(paths, shards_dir, name, shard_size)
+    return ShardIndex(shards_dir, name)
@@ -1,10 +1,13 @@
 # encoding: utf-8
 import random
 
+import numpy as np
+import torch
 from PIL import Image
 from torchvision import transforms as T
 
 from Dataset.random_erasing import RandomErasing, Cutout
+from Utils.tensor_section_functions import tensor_cuda
 
 
 class Random2DTranslation(object):
@@ -64,14 +67,29 @@ def bbox_worse(x, imsize,  p):
     return x
 
 
+def to_uint8_tensor(x):
+    """PIL Image to a uint8 tensor in CHW order, without scaling and normalizing"""
+    x = torch.from_numpy(np.asarray(x, dtype=np.uint8).copy())
+    return x.permute(2, 0, 1).contiguous()
+
+
 class TrainTransform(object):
-    def __init__(self, data, meta, augmentaion=None):
+    def __init__(self, data, meta, augmentaion=None, batch_augment=False):
         self.data = data
         self.imageSize = meta['imageSize']
         self.mean = meta['mean']
         self.std = meta['std']
+        # flip, normalization and augmentation are left to Dataset.batch_transforms.BatchTrainTransform
+        self.batch_augment = batch_augment
+
+        self.resize = T.Resize(self.imageSize)
+        self.flip = T.RandomHorizontalFlip()
+        self.to_tensor = T.ToTensor()
+        self.normalize = T.Normalize(mean=self.mean, std=self.std)
 
-        if augmentaion == 'Cutout':
+        if batch_augment:
+            self.augment = lambda x: x
+        elif augmentaion == 'Cutout':
             print('incorporate Cutout to augment training data')
             self.augment = Cutout(probability=0.5, size=self.imageSize[1]//2, mean=[0.0, 0.0, 0.0])
         elif augmentaion == 'RandomErasing':
@@ -82,32 +100,35 @@ class TrainTransform(object):
 
     def __call__(self, x):
         if self.data == 'person':
-            x = T.Resize(self.imageSize)(x)
+            x = self.resize(x)
             #x = bbox_worse(x, (384, 128), 0.5)
         else:
             raise NotImplementedError
 
-        x = T.RandomHorizontalFlip()(x)
-        x = T.ToTensor()(x)
-        x = T.Normalize(mean=self.mean, std=self.std)(x)
+        if self.batch_augment:
+            return to_uint8_tensor(x)
+
+        x = self.flip(x)
+        x = self.to_tensor(x)
+        x = self.normalize(x)
         x = self.augment(x)
         return x
 
     def pre_process(self, x):
         if self.data == 'person':
-            x = T.Resize(self.imageSize)(x)
+            x = self.resize(x)
             # x = bbox_worse(x, (384, 128), 0.5)
         else:
             raise NotImplementedError
 
-        x = T.ToTensor()(x)
-        x = T.Normalize(mean=self.mean, std=self.std)(x)
+        x = self.to_tensor(x)
+        x = self.normalize(x)
 
         return x
 
     def post_process(self, x):
-        x = x.cuda()  # to limit the scope of influence of this post_processing.
-        x = T.RandomHorizontalFlip()(x)
+        x = tensor_cuda(x)  # to limit the scope of influence of this post_processing.
+        x = self.flip(x)
         x = self.augment(x)
         return x
 
@@ -120,22 +141,26 @@ class TestTransform(object):
         self.mean = meta['mean']
         self.std = meta['std']
 
+        self.resize = T.Resize(self.imageSize)
+        self.to_tensor = T.ToTensor()
+        self.normalize = T.Normalize(mean=self.mean, std=self.std)
+
     def __call__(self, x=None):
         if self.data == 'person':
-            x = T.Resize(self.imageSize)(x)
+            x = self.resize(x)
             #x = bbox_worse(x, (384, 128), 0.5)
         else:
             raise NotImplementedError
 
         if self.flip:
             x = T.functional.hflip(x)
-        x = T.ToTensor()(x)
-        x = T.Normalize(mean=self.mean, std=self.std)(x)
+        x = self.to_tensor(x)
+        x = self.normalize(x)
         return x
 
     def pre_process(self, x):
         if self.data == 'person':
-            x = T.Resize(self.imageSize)(x)
+            x = self.resize(x)
             # x = bbox_worse(x, (384, 128), 0.5)
         else:
             raise NotImplementedError
@@ -143,10 +168,10 @@ class TestTransform(object):
         if self.flip:
             x = T.functional.hflip(x)
 
-        x = T.ToTensor()(x)
-        x = T.Normalize(mean=self.mean, std=self.std)(x)
+        x = self.to_tensor(x)
+        x = self.normalize(x)
 
         return x
 
     def post_process(self, x):
-        return x.cuda()  # to limit the scope of influence of this post_processing.
+        return tensor_cuda(x)  # to limit the scope of influence of this post_processing.
@@ -22,6 +22,27 @@ class WConv2d(nn.Conv2d):
 
         # self.correct_params()
 
+    def forward(self, input_):
+        """With the weight [[P, Q], [Q, P]] kept by correct_params & correct_grads, out_a = P a + Q b and
+        out_b = P b + Q a come from two convolutions instead of four (one of 2 groups):
+        (out_a + out_b) / 2 = (P + Q) / 2 (a + b), (out_a - out_b) / 2 = (P - Q) / 2 (a - b).
+        Only the first half of the weight is read, and its gradient is mirrored by correct_grads."""
+        in_channels = self.in_channels // 2
+        out_channels = self.out_channels // 2
+        in_a, in_b = input_[:, :in_channels], input_[:, in_channels:]
+
+        weight_a = self.weight[:out_channels]
+        p, q = weight_a[:, :in_channels], weight_a[:, in_channels:]
+        weight = torch.cat(((p + q) / 2., (p - q) / 2.), dim=0)
+        bias = self.bias
+        if bias is not None:
+            bias = torch.cat((bias[:out_channels], torch.zeros_like(bias[:out_channels])), dim=0)
+
+        output_ = F.conv2d(torch.cat((in_a + in_b, in_a - in_b), dim=1), weight, bias,
+                           self.stride, self.padding, self.dilation, 2)
+        half_sum, half_diff = output_[:, :out_channels], output_[:, out_channels:]
+        return torch.cat((half_sum + half_diff, half_sum - half_diff), dim=1)
+
     def correct_params(self):
         weight_a = self.weight.data[:self.out_channels//2, :, :, :]
         p, q = torch.chunk(weight_a, 2, dim=1)
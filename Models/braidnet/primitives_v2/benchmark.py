@@ -0,0 +1,136 @@
+import copy
+import random
+import time
+
+import torch
+import torch.nn as nn
+
+from .blocks import BraidBlock
+from .subblocks import *
+from ..primitives import subblocks as subblocks_v1
+from ..primitives.blocks import BraidBlock as BraidBlockV1
+
+'''
+Equivalence (in float64) and CPU benchmark of the fused pair layers against the four separate products,
+combined out of place as before the fusion. The linear pair layers keep their four products and are only checked,
+for the in-place sum of WLinear and the products shared by the combines of its subclasses.
+run by: python -m Models.braidnet.primitives_v2.benchmark
+'''
+
+
+def _unfused_products(module, input_):
+    in_a, in_b = input_
+    return module.conv_p(in_a), module.conv_q(in_a), module.conv_p(in_b), module.conv_q(in_b)
+
+
+def _unfused_sum(module, input_):
+    p_a, q_a, p_b, q_b = _unfused_products(module, input_)
+    return p_a + q_b, p_b + q_a
+
+
+def _unfused(module):
+    """a copy of module whose pair layers compute the products separately, as before the fusion"""
+    module = copy.deepcopy(module)
+    for m in module.modules():
+        if type(m) in (WConv2d, WLinear):
+            m.forward = lambda input_, m=m: _unfused_sum(m, input_)
+        elif isinstance(m, WLinear):
+            m.pair_products = lambda input_, m=m: _unfused_products(m, input_)
+        elif isinstance(m, subblocks_v1.WConv2d):
+            m.forward = lambda input_, m=m: nn.Conv2d.forward(m, input_)
+    return module
+
+
+def _correct_grads(module):
+    for m in module.modules():
+        if hasattr(m, 'correct_grads'):
+            m.correct_grads()
+
+
+def _loss(outputs):
+    if isinstance(outputs, torch.Tensor):
+        outputs = [outputs]
+    generator = torch.Generator().manual_seed(0)
+    return sum((o * torch.randn(o.size(), generator=generator).to(o.dtype)).sum() for o in outputs)
+
+
+def _forward_backward(module, input_):
+    _loss(module(input_)).backward()
+    _correct_grads(module)
+
+
+def _assert_close(actual, expected, message):
+    # in float64 the rounding of the fused and the separate ops stays far below rtol, whatever the scale
+    assert torch.allclose(actual, expected, rtol=1e-6, atol=1e-9), '{0} differ by {1:.3e}'.format(
+        message, (actual - expected).abs().max().item())
+
+
+def check_equivalence(module, input_):
+    """in float64, on copies of module and input_"""
+    module = copy.deepcopy(module).double()
+    reference = _unfused(module)
+    name = type(module).__name__
+    if isinstance(input_, torch.Tensor):
+        inputs = [input_.detach().double().requires_grad_() for _ in range(2)]
+    else:
+        inputs = [[i.detach().double().requires_grad_() for i in input_] for _ in range(2)]
+
+    outputs = []
+    for m, i in zip((module, reference), inputs):
+        # SoftMin picks the order of its operands randomly
+        random.seed(0)
+        m.zero_grad()
+        output_ = m(i)
+        _loss(output_).backward()
+        _correct_grads(m)
+        outputs.append(output_ if isinstance(output_, (list, tuple)) else [output_])
+
+    for o, r in zip(*outputs):
+        _assert_close(o, r, 'outputs of {0}'.format(name))
+    for (param_name, p), r in zip(module.named_parameters(), reference.parameters()):
+        _assert_close(p.grad, r.grad, 'gradients of {0}.{1}'.format(name, param_name))
+    for i, r in zip(*[i if isinstance(i, (list, tuple)) else [i] for i in inputs]):
+        _assert_close(i.grad, r.grad, 'input gradients of {0}'.format(name))
+
+
+def benchmark(module, input_, repeat=20):
+    results = []
+    for m in (_unfused(module), module):
+        _forward_backward(m, input_)
+        start = time.time()
+        for _ in range(repeat):
+            m.zero_grad()
+            _forward_backward(m, input_)
+        results.append((time.time() - start) / repeat)
+    print('{0}: {1:.2f}ms -> {2:.2f}ms (x{3:.2f})'.format(type(module).__name__, results[0] * 1000.,
+                                                          results[1] * 1000., results[0] / results[1]))
+
+
+def main():
+    batch_size, in_features, out_features = 2048, 512, 512
+    linear_input = [torch.randn(batch_size, in_features) for _ in range(2)]
+    linears = [WLinear(in_features, out_features), MMLinear(in_features, out_features),
+               MinLinear(in_features, out_features), AndLinear(in_features, out_features),
+               MinBNLinear(in_features, out_features), Min2Linear(in_features, out_features),
+               SoftMinLinear(in_features, out_features)]
+
+    # the pair maps of the braid blocks of BraidNet
+    batch_size, channels, height, width = 64, 64, 32, 16
+    conv_input = [torch.randn(batch_size, channels, height, width) for _ in range(2)]
+    convs = [WConv2d(channels, channels), BraidBlock(channels, channels)]
+
+    block_v1 = BraidBlockV1(channels, channels)
+    block_v1.wconv.correct_params()
+    braid_input = torch.cat(conv_input, dim=1)
+
+    fused = [(m, conv_input) for m in convs] + [(block_v1, braid_input)]
+    for module, input_ in [(m, linear_input) for m in linears] + fused:
+        check_equivalence(module, input_)
+    print('the pair layers are equivalent to the separate products.')
+
+    for module, input_ in fused:
+        benchmark(module, input_)
+
+
+if __name__ == '__main__':
+    main()
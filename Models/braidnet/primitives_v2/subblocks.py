@@ -2,6 +2,7 @@ from random import random
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn import BatchNorm1d as BatchNorm1d
 from torch.nn import BatchNorm2d as BatchNorm2d
 
@@ -76,10 +77,25 @@ class WConv2d(nn.Module):
         self.conv_q = nn.Conv2d(in_channels, out_channels, kernel_size,
                                 stride, padding, dilation, groups, False)
 
+    def _conv(self, input_, weight, bias, groups=1):
+        return F.conv2d(input_, weight, bias, self.conv_p.stride, self.conv_p.padding, self.conv_p.dilation, groups)
+
     def forward(self, input_):
+        """out_a = P a + Q b and out_b = P b + Q a, by two convolutions instead of four:
+        (out_a + out_b) / 2 = (P + Q) / 2 (a + b), (out_a - out_b) / 2 = (P - Q) / 2 (a - b),
+        computed as one convolution of 2 groups"""
         in_a, in_b = input_
-        out_a = self.conv_p(in_a) + self.conv_q(in_b)
-        out_b = self.conv_p(in_b) + self.conv_q(in_a)
+        out_channels = self.conv_p.out_channels
+        p, q = self.conv_p.weight, self.conv_q.weight
+        weight = torch.cat(((p + q) / 2., (p - q) / 2.), dim=0)
+        bias = self.conv_p.bias
+        if bias is not None:
+            bias = torch.cat((bias, torch.zeros_like(bias)), dim=0)
+
+        output_ = self._conv(torch.cat((in_a + in_b, in_a - in_b), dim=1), weight, bias, groups=2)
+        half_sum, half_diff = output_[:, :out_channels], output_[:, out_channels:]
+        out_a = half_sum + half_diff
+        out_b = half_sum - half_diff
         return out_a, out_b
 
     def correct_params(self):
@@ -131,16 +147,20 @@ class WLinear(nn.Module):
         self.conv_q = nn.Linear(in_features, out_features, False)
 
     def forward(self, input_):
-        in_a, in_b = input_
-        out_a = self.conv_p(in_a) + self.conv_q(in_b)
-        out_b = self.conv_p(in_b) + self.conv_q(in_a)
+        p_a, q_a, p_b, q_b = self.pair_products(input_)
+        # in place, as p_a and p_b are fresh outputs not needed by the backward of the products
+        out_a = p_a.add_(q_b)
+        out_b = p_b.add_(q_a)
         return out_a, out_b
 
+    def pair_products(self, input_):
+        """p_a, q_a, p_b, q_b, shared by the combines of the subclasses"""
+        in_a, in_b = input_
+        return self.conv_p(in_a), self.conv_q(in_a), self.conv_p(in_b), self.conv_q(in_b)
+
     def half_forward(self, in_a):
         """this method is used in checking discriminant"""
-        out_a = self.conv_p(in_a)
-        out_b = self.conv_q(in_a)
-        return torch.cat((out_a, out_b), dim=1)
+        return torch.cat((self.conv_p(in_a), self.conv_q(in_a)), dim=-1)
 
     def correct_params(self):
         self.conv_p.weight.data /= 2.
@@ -154,12 +174,7 @@ class MMLinear(WLinear):
         # self.conv_q = nn.Linear(in_features, out_features, False)
 
     def forward(self, input_):
-        in_a, in_b = input_
-
-        p_a = self.conv_p(in_a)
-        q_b = self.conv_q(in_b)
-        p_b = self.conv_p(in_b)
-        q_a = self.conv_q(in_a)
+        p_a, q_a, p_b, q_b = self.pair_products(input_)
 
         out_a_max = torch.max(p_a, q_b)
         out_a_min = torch.min(p_a, q_b)
@@ -180,12 +195,7 @@ class MinLinear(WLinear):
         # self.conv_q = nn.Linear(in_features, out_features, False)
 
     def forward(self, input_):
-        in_a, in_b = input_
-
-        p_a = self.conv_p(in_a)
-        q_b = self.conv_q(in_b)
-        p_b = self.conv_p(in_b)
-        q_a = self.conv_q(in_a)
+        p_a, q_a, p_b, q_b = self.pair_products(input_)
 
         out_a = torch.min(p_a, q_b)
         out_b = torch.min(p_b, q_a)
@@ -193,13 +203,7 @@ class MinLinear(WLinear):
         return out_a, out_b
 
     def get_intermediate_vars(self, input_):
-        in_a, in_b = input_
-        p_a = self.conv_p(in_a)
-        q_b = self.conv_q(in_b)
-        p_b = self.conv_p(in_b)
-        q_a = self.conv_q(in_a)
-
-        return p_a, q_a, p_b, q_b
+        return self.pair_products(input_)
 
 
 class AndLinear(WLinear):
@@ -214,12 +218,7 @@ class AndLinear(WLinear):
         # self.conv_q = nn.Linear(in_features, out_features, False)
 
     def forward(self, input_):
-        in_a, in_b = input_
-
-        p_a = self.conv_p(in_a)
-        q_b = self.conv_q(in_b)
-        p_b = self.conv_p(in_b)
-        q_a = self.conv_q(in_a)
+        p_a, q_a, p_b, q_b = self.pair_products(input_)
 
         out_a = self.and_(p_a, q_b)
         out_b = self.and_(p_b, q_a)
@@ -246,12 +245,7 @@ class MinBNLinear(WLinear):
                                   track_running_stats=True)
 
     def forward(self, input_):
-        in_a, in_b = input_
-
-        p_a = self.conv_p(in_a)
-        q_b = self.conv_q(in_b)
-        p_b = self.conv_p(in_b)
-        q_a = self.conv_q(in_a)
+        p_a, q_a, p_b, q_b = self.pair_products(input_)
 
         p_a, p_b = self.wbn_p((p_a, p_b))
         q_a, q_b = self.wbn_q((q_a, q_b))
@@ -269,12 +263,7 @@ class Min2Linear(WLinear):
         # self.conv_q = nn.Linear(in_features, out_features, False)
 
     def forward(self, input_):
-        in_a, in_b = input_
-
-        p_a = self.conv_p(in_a)
-        q_b = self.conv_q(in_b)
-        p_b = self.conv_p(in_b)
-        q_a = self.conv_q(in_a)
+        p_a, q_a, p_b, q_b = self.pair_products(input_)
 
         out_a = Min2.apply(p_a, q_b)
         out_b = Min2.apply(p_b, q_a)
@@ -290,11 +279,7 @@ class SoftMinLinear(WLinear):
         self.softmin = SoftMin()
 
     def forward(self, input_):
-        in_a, in_b = input_
-        p_a = self.conv_p(in_a)
-        q_b = self.conv_q(in_b)
-        p_b = self.conv_p(in_b)
-        q_a = self.conv_q(in_a)
+        p_a, q_a, p_b, q_b = self.pair_products(input_)
 
         out_a = self.softmin(p_a, q_b)
         out_b = self.softmin(p_b, q_a)
@@ -1,8 +1,41 @@
-from torch.utils.data import DataLoader
+from PIL import Image
+from torch.utils.data import DataLoader, BatchSampler
+from torch.utils.data.dataloader import default_collate
 
 from Dataset import data_info
-from Dataset.data_image import ImageData, PreLoadedImageData
+from Dataset.batch_transforms import BatchAugmentCollate, BatchTrainTransform
+from Dataset.data_image import ImageData, PreLoadedImageData, UniquePairBatchImageData, IdentityBatchImageData, \
+    ShardedImageData, ShardedUniquePairBatchImageData, ShardedIdentityBatchImageData, ImageReader, \
+    IndexedImageData, ShardedIndexedImageData
+from Dataset.shards import open_shards
 from Dataset.transforms import TestTransform, TrainTransform
+from Utils.distributed import get_world_size
+
+
+def _shard_name(opt, split):
+    name = '+'.join(opt.dataset) if isinstance(opt.dataset, list) else opt.dataset
+    return '{0}_{1}'.format(name, split)
+
+
+def _image_reader(opt, model_meta):
+    fallback = Image.new('RGB', tuple(model_meta['imageSize'][::-1])) if opt.io_fallback else None
+    return ImageReader(retries=opt.io_retries, fallback=fallback)
+
+
+_DATA_CLASSES = {'single': (ImageData, ShardedImageData),
+                 'unique_pairs': (UniquePairBatchImageData, ShardedUniquePairBatchImageData),
+                 'identity_batch': (IdentityBatchImageData, ShardedIdentityBatchImageData),
+                 'indexed': (IndexedImageData, ShardedIndexedImageData)}
+
+
+def _image_data(opt, records, transform, split, kind='single', reader=None):
+    """ImageData of records, or ShardedImageData reading from the shards if opt.shards_dir is given"""
+    data_class, sharded_class = _DATA_CLASSES[kind]
+    if opt.shards_dir is None:
+        return data_class(records, transform, reader=reader, io_threads=opt.io_threads)
+
+    shard_index = open_shards(records, opt.shards_dir, _shard_name(opt, split), opt.shard_size)
+    return sharded_class(records, transform, shard_index, reader=reader, io_threads=opt.io_threads)
 
 
 def get_dataloaders(opt, model_meta):
@@ -30,11 +63,14 @@ def get_dataloaders(opt, model_meta):
 
     dataset.print_summary()
 
+    reader = _image_reader(opt, model_meta)
+
     pin_memory = not opt.srl
 
     if opt.check_discriminant or opt.check_element_discriminant or opt.check_pair_effect or opt.sort_pairs_by_scores:
         trainloader = DataLoader(
-            ImageData(dataset.train, TrainTransform(opt.datatype, model_meta, augmentaion=None)),
+            _image_data(opt, dataset.train, TrainTransform(opt.datatype, model_meta, augmentaion=None), 'train',
+                        reader=reader),
             batch_size=opt.train_batch, num_workers=opt.workers,
             pin_memory=pin_memory,
         )
@@ -42,7 +78,7 @@ def get_dataloaders(opt, model_meta):
         dataset.query.extend(dataset.gallery)
 
         queryloader = DataLoader(
-            ImageData(dataset.query, TestTransform(opt.datatype, model_meta)),
+            _image_data(opt, dataset.query, TestTransform(opt.datatype, model_meta), 'test', reader=reader),
             batch_size=opt.test_batch, num_workers=opt.workers,
             pin_memory=pin_memory
         )
@@ -53,22 +89,82 @@ def get_dataloaders(opt, model_meta):
                 'queryFliploader': None,
                 'galleryFliploader': None}
 
+    # the preloaded images for SRL have been normalized, so they are still augmented one by one
+    if opt.batch_augment and not (opt.train_mode == 'pair' and opt.srl):
+        print('training images are flipped, normalized and augmented batch by batch')
+        train_transform = TrainTransform(opt.datatype, model_meta, augmentaion=opt.augmentation, batch_augment=True)
+        train_collate_fn = BatchAugmentCollate(BatchTrainTransform(model_meta, augmentaion=opt.augmentation))
+    else:
+        train_transform = TrainTransform(opt.datatype, model_meta, augmentaion=opt.augmentation)
+        train_collate_fn = default_collate
+
+    if opt.shards_dir is not None:
+        print('images are read from the shards under {}'.format(opt.shards_dir))
+
+    # opt.train_batch is the batch of all the processes, which share the seed of the distributed samplers
+    world_size = get_world_size()
+    train_batch = opt.train_batch // world_size
+    if opt.distributed:
+        if train_batch * world_size != opt.train_batch:
+            raise ValueError('train_batch should be divisible by the number of processes')
+        print('each of the {0} processes takes {1} of the {2} samples in a batch'.format(world_size, train_batch,
+                                                                                       opt.train_batch))
+
     if opt.train_mode == 'normal':
+        train_data = _image_data(opt, dataset.train, train_transform, 'train', reader=reader)
+        if opt.shards_dir is not None:
+            from Dataset.samplers import ShardShuffleSampler, DistributedShardShuffleSampler
+            if opt.distributed:
+                sampler = DistributedShardShuffleSampler(train_data, buffer_size=opt.shuffle_buffer, seed=opt.seed)
+            else:
+                sampler = ShardShuffleSampler(train_data, buffer_size=opt.shuffle_buffer)
+        else:
+            from Dataset.samplers import ShuffleSampler, DistributedShuffleSampler
+            if opt.distributed:
+                sampler = DistributedShuffleSampler(train_data, seed=opt.seed)
+            else:
+                sampler = ShuffleSampler(train_data)
+
         trainloader = DataLoader(
-            ImageData(dataset.train, TrainTransform(opt.datatype, model_meta, augmentaion=opt.augmentation)),
-            batch_size=opt.train_batch, num_workers=opt.workers,
-            pin_memory=pin_memory, drop_last=True, shuffle=True
+            train_data,
+            sampler=sampler,
+            batch_size=train_batch, num_workers=opt.workers,
+            pin_memory=pin_memory, drop_last=True,
+            collate_fn=train_collate_fn
         )
 
     elif opt.train_mode == 'pair':
         if opt.srl:
             print('Sampler supports SRL!')
-            from SampleRateLearning.sampler import SampleRateBatchSampler #SampleRateSampler
-            batch_sampler = SampleRateBatchSampler(data_source=dataset.train,
-                                                   sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch,
-                                                   batch_size=opt.train_batch)
+            from SampleRateLearning.sampler import SampleRateBatchSampler, HardSampleRateBatchSampler, \
+                DistributedSampleRateBatchSampler, DistributedHardSampleRateBatchSampler #SampleRateSampler
+            if opt.distributed and opt.hard_mining:
+                batch_sampler = DistributedHardSampleRateBatchSampler(
+                    data_source=dataset.train,
+                    sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch,
+                    batch_size=opt.train_batch,
+                    hard_rate=opt.hard_rate,
+                    neg_candidates=opt.hard_neg_candidates,
+                    seed=opt.seed)
+            elif opt.distributed:
+                batch_sampler = DistributedSampleRateBatchSampler(
+                    data_source=dataset.train,
+                    sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch,
+                    batch_size=opt.train_batch,
+                    seed=opt.seed)
+            elif opt.hard_mining:
+                batch_sampler = HardSampleRateBatchSampler(data_source=dataset.train,
+                                                           sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch,
+                                                           batch_size=opt.train_batch,
+                                                           hard_rate=opt.hard_rate,
+                                                           neg_candidates=opt.hard_neg_candidates)
+            else:
+                batch_sampler = SampleRateBatchSampler(data_source=dataset.train,
+                                                       sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch,
+                                                       batch_size=opt.train_batch)
+            source = _image_data(opt, dataset.train, None, 'train', reader=reader)
             trainloader = DataLoader(
-                PreLoadedImageData(dataset.train, TrainTransform(opt.datatype, model_meta, augmentaion=opt.augmentation)),
+                PreLoadedImageData(dataset.train, train_transform, source=source),
                 batch_sampler=batch_sampler,
                 num_workers=0,
                 pin_memory=pin_memory,
@@ -76,56 +172,114 @@ def get_dataloaders(opt, model_meta):
             print('num_workers=0 in the training loader.')
 
         else:
-            from Dataset.samplers import PosNegPairSampler
-            sampler = PosNegPairSampler(data_source=dataset.train,
-                                        pos_rate=opt.pos_rate,
-                                        sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch)
+            from Dataset.samplers import PosNegPairSampler, HardPosNegPairSampler, DistributedPosNegPairSampler, \
+                DistributedHardPosNegPairSampler
+            if opt.distributed and opt.hard_mining:
+                sampler = DistributedHardPosNegPairSampler(
+                    data_source=dataset.train,
+                    pos_rate=opt.pos_rate,
+                    sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch,
+                    hard_rate=opt.hard_rate,
+                    neg_candidates=opt.hard_neg_candidates,
+                    seed=opt.seed)
+            elif opt.distributed:
+                sampler = DistributedPosNegPairSampler(data_source=dataset.train,
+                                                       pos_rate=opt.pos_rate,
+                                                       sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch,
+                                                       seed=opt.seed)
+            elif opt.hard_mining:
+                sampler = HardPosNegPairSampler(data_source=dataset.train,
+                                                pos_rate=opt.pos_rate,
+                                                sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch,
+                                                hard_rate=opt.hard_rate,
+                                                neg_candidates=opt.hard_neg_candidates)
+            else:
+                sampler = PosNegPairSampler(data_source=dataset.train,
+                                            pos_rate=opt.pos_rate,
+                                            sample_num_per_epoch=opt.iter_num_per_epoch * opt.train_batch)
 
-            trainloader = DataLoader(
-                ImageData(dataset.train, TrainTransform(opt.datatype, model_meta, augmentaion=opt.augmentation)),
-                sampler=sampler,
-                batch_size=opt.train_batch, num_workers=opt.workers,
-                pin_memory=pin_memory, drop_last=False
-            )
+            if opt.dedup_pairs:
+                print('each distinct image in a batch of pairs is loaded only once')
+                trainloader = DataLoader(
+                    _image_data(opt, dataset.train, train_transform, 'train', kind='unique_pairs', reader=reader),
+                    sampler=BatchSampler(sampler, batch_size=train_batch, drop_last=False),
+                    batch_size=None, num_workers=opt.workers,
+                    pin_memory=pin_memory,
+                    collate_fn=BatchAugmentCollate(train_collate_fn.transform, precollated=True)
+                    if opt.batch_augment else None
+                )
+
+            else:
+                # the sample indices let the trainer extract the repeated images of a batch once
+                kind = 'indexed' if opt.dedup_images else 'single'
+                trainloader = DataLoader(
+                    _image_data(opt, dataset.train, train_transform, 'train', kind=kind, reader=reader),
+                    sampler=sampler,
+                    batch_size=train_batch, num_workers=opt.workers,
+                    pin_memory=pin_memory, drop_last=False,
+                    collate_fn=train_collate_fn
+                )
 
     elif opt.train_mode in ['cross', 'ide_cross']:
-        from Dataset.samplers import RandomIdentitySampler
+        from Dataset.samplers import RandomIdentityBatchSampler, DistributedRandomIdentityBatchSampler
+        ids_per_batch = opt.ids_per_batch if opt.ids_per_batch > 0 else opt.train_batch // opt.num_instances
+        if ids_per_batch * opt.num_instances != opt.train_batch:
+            print('note: each batch consists of {0} identities x {1} images'.format(ids_per_batch, opt.num_instances))
+
+        if opt.distributed:
+            sampler = DistributedRandomIdentityBatchSampler(dataset.train, opt.num_instances, ids_per_batch,
+                                                            seed=opt.seed)
+        else:
+            sampler = RandomIdentityBatchSampler(dataset.train, opt.num_instances, ids_per_batch)
+
         trainloader = DataLoader(
-            ImageData(dataset.train, TrainTransform(opt.datatype, model_meta, augmentaion=opt.augmentation)),
-            sampler=RandomIdentitySampler(dataset.train, opt.num_instances),
-            batch_size=opt.train_batch, num_workers=opt.workers,
-            pin_memory=pin_memory, drop_last=True
+            _image_data(opt, dataset.train, train_transform, 'train', kind='identity_batch', reader=reader),
+            sampler=sampler,
+            batch_size=None, num_workers=opt.workers,
+            pin_memory=pin_memory,
+            collate_fn=BatchAugmentCollate(train_collate_fn.transform, precollated=True)
+            if opt.batch_augment else None
         )
 
     else:
         raise NotImplementedError
 
     queryloader = DataLoader(
-        ImageData(dataset.query, TestTransform(opt.datatype, model_meta)),
+        _image_data(opt, dataset.query, TestTransform(opt.datatype, model_meta), 'query', reader=reader),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory
     )
 
     galleryloader = DataLoader(
-        ImageData(dataset.gallery, TestTransform(opt.datatype, model_meta)),
+        _image_data(opt, dataset.gallery, TestTransform(opt.datatype, model_meta), 'gallery', reader=reader),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory
     )
 
     queryFliploader = DataLoader(
-        ImageData(dataset.query, TestTransform(opt.datatype, model_meta, True)),
+        _image_data(opt, dataset.query, TestTransform(opt.datatype, model_meta, True), 'query', reader=reader),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory
     )
 
     galleryFliploader = DataLoader(
-        ImageData(dataset.gallery, TestTransform(opt.datatype, model_meta, True)),
+        _image_data(opt, dataset.gallery, TestTransform(opt.datatype, model_meta, True), 'gallery', reader=reader),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory
     )
 
-    return {'trainloader': trainloader,
-            'queryloader': queryloader,
-            'galleryloader': galleryloader,
-            'queryFliploader': queryFliploader,
-            'galleryFliploader': galleryFliploader}
+    dataloaders = {'trainloader': trainloader,
+                   'queryloader': queryloader,
+                   'galleryloader': galleryloader,
+                   'queryFliploader': queryFliploader,
+                   'galleryFliploader': galleryFliploader}
+
+    if opt.hard_mining and opt.train_mode == 'pair':
+        # the training set in its order and without augmentation, to fill the feature bank of hard mining
+        dataloaders['bankloader'] = DataLoader(
+            _image_data(opt, dataset.train, TestTransform(opt.datatype, model_meta), 'train', reader=reader),
+            batch_size=opt.test_batch, num_workers=opt.workers,
+            pin_memory=pin_memory
+        )
+
+    return dataloaders
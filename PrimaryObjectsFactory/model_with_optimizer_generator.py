@@ -2,6 +2,7 @@ import torch
 from torch import nn
 
 from Utils.data_parallel import DataParallel
+from Utils.distributed import broadcast_states
 from Utils.serialization import parse_checkpoints
 
 __all__ = ['get_model_with_optimizer', ]
@@ -406,6 +407,11 @@ def get_model_with_optimizer(opt, id_num=1, naive=False):
         from WeightModification.centralization import convert_model as convert_model_wc
         model = convert_model_wc(model)
 
+    if opt.amp:
+        print('mixed precision, with the stable BN layers, soft min/max and Y heads kept in float32.')
+        from Utils.amp import keep_fp32
+        model = keep_fp32(model)
+
     print('reset the momentum in all the BN layers to {}'.format(opt.bn_momentum))
     for child in model.modules():
         if isinstance(child, torch.nn.modules.batchnorm._BatchNorm):
@@ -413,12 +419,17 @@ def get_model_with_optimizer(opt, id_num=1, naive=False):
 
     start_epoch = 0
     optimizer_state_dict = None
+    step_state = None
     if not opt.disable_resume:
-        start_epoch, state_dict, best_epoch, best_rank1, optimizer_state_dict = parse_checkpoints(opt.exp_dir)
+        start_epoch, state_dict, best_epoch, best_rank1, optimizer_state_dict, step_state \
+            = parse_checkpoints(opt.exp_dir)
         if best_epoch > 0:
             print('the highest current rank-1 score is {0:.1%}, which was achieved after epoch {1}'.format(best_rank1,
                                                                                                            best_epoch))
-        if start_epoch > 0:
+        if step_state is not None:
+            print('net comes to the state after step {0} of epoch {1}'.format(step_state['step'], start_epoch + 1))
+            model.load_state_dict(state_dict, True)
+        elif start_epoch > 0:
             print('net comes to the state after epoch {0}'.format(start_epoch))
             model.load_state_dict(state_dict, True)
 
@@ -426,7 +437,12 @@ def get_model_with_optimizer(opt, id_num=1, naive=False):
         print('no longer freeze pretrained params (if there are any pretrained params)')
         model.unlable_pretrained()
 
-    model = DataParallel(model).cuda()  # nn.DataParallel(model).cuda()
+    model = DataParallel(model)  # nn.DataParallel(model).cuda()
+    if torch.cuda.is_available():
+        model = model.cuda()
+    if opt.distributed:
+        print('the states of the model are broadcast from process 0.')
+        broadcast_states(model)
 
     # get optimizer
     optimizer = model.module.get_optimizer(optim=opt.optim,
@@ -437,7 +453,11 @@ def get_model_with_optimizer(opt, id_num=1, naive=False):
                                            gc_loc=opt.gc_loc)
 
     if optimizer_state_dict is not None:
-        print('optimizer comes to the state after epoch {0}'.format(start_epoch))
+        if step_state is not None:
+            print('optimizer comes to the state after step {0} of epoch {1}'.format(step_state['step'],
+                                                                                   start_epoch + 1))
+        else:
+            print('optimizer comes to the state after epoch {0}'.format(start_epoch))
         optimizer.load_state_dict(optimizer_state_dict)
 
-    return model, optimizer, start_epoch  # , best_rank1, best_epoch
+    return model, optimizer, start_epoch, step_state  # , best_rank1, best_epoch
@@ -12,7 +12,7 @@ def get_trainer(opt):
     data_loaders = get_dataloaders(opt, model.meta)
     _, train_ids, _ = zip(*data_loaders['trainloader'].dataset.dataset)
     train_id_num = len(set(train_ids))
-    model, optimizer, done_epoch = get_model_with_optimizer(opt, id_num=train_id_num)
+    model, optimizer, done_epoch, step_state = get_model_with_optimizer(opt, id_num=train_id_num)
 
     evaluator = get_evaluator(opt, model, **data_loaders)
 
@@ -57,7 +57,7 @@ def get_trainer(opt):
 
         from Agents.trainer import BraidPairTrainer
         reid_trainer = BraidPairTrainer(opt, data_loaders['trainloader'], evaluator, optimizer, lr_strategy, criterion,
-                                        opt.train_phase_num, done_epoch)
+                                        opt.train_phase_num, done_epoch, bank_loader=data_loaders.get('bankloader'))
 
     elif opt.train_mode == 'cross':
         if opt.loss == 'bce':
@@ -125,4 +125,7 @@ def get_trainer(opt):
             criterion.pos_rate = criterion.alpha.sigmoid()
             criterion.sampler.update(criterion.pos_rate)
 
+    # the rest states of an unfinished epoch, restored when the epoch is resumed
+    reid_trainer.step_state = step_state
+
     return reid_trainer
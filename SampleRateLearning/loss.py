@@ -2,6 +2,8 @@ from torch import nn
 import torch
 from torch.optim import SGD, Adam, AdamW
 from .sampler import SampleRateSampler, SampleRateBatchSampler
+from Utils.distributed import is_distributed, all_reduce_sum
+from Utils.tensor_section_functions import tensor_cuda
 
 
 class SRL_BCELoss(nn.Module):
@@ -11,7 +13,7 @@ class SRL_BCELoss(nn.Module):
 
         super(SRL_BCELoss, self).__init__()
 
-        self.alpha = nn.Parameter(torch.tensor(0.).cuda())
+        self.alpha = nn.Parameter(tensor_cuda(torch.tensor(0.)))
         self.pos_rate = self.alpha.sigmoid()
         self.sampler = sampler
         self.sampler.update(self.pos_rate)
@@ -77,7 +79,13 @@ class SRL_BCELoss(nn.Module):
             loss = losses.mean()
 
         # update pos_rate
-        grad = (neg_loss - pos_loss).detach()
+        if is_distributed():
+            # from the losses of all the processes, so that their pos_rates and samplers stay the same
+            sums = torch.stack((losses[is_pos].sum(), is_pos.sum(), losses[~is_pos].sum(), (~is_pos).sum()))
+            sums = all_reduce_sum(sums.detach().float())
+            grad = sums[2] / sums[3] - sums[0] / sums[1]
+        else:
+            grad = (neg_loss - pos_loss).detach()
         if not torch.isnan(grad):
             self.optimizer.zero_grad()
             self.pos_rate.backward(grad)
@@ -1,18 +1,15 @@
 from __future__ import absolute_import
 
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 
-from numpy.random import choice as randchoice
-from numpy.random import uniform as randuniform
 from numpy import clip
 from torch.utils.data.sampler import Sampler
 
-from queue import Queue
-from random import sample as randsample
+from Dataset.samplers import HardPairMining, ResumableSampler, DistributedSampling
 
 
-class SampleRateSampler(Sampler):
-    def __init__(self, data_source, sample_num_per_epoch=500*256):
+class SampleRateSampler(ResumableSampler, Sampler):
+    def __init__(self, data_source, sample_num_per_epoch=500*256, seed=None):
         super(SampleRateSampler, self).__init__(data_source)
         self.data_source = data_source
         # self.alpha = torch.nn.Parameter(torch.tensor(0.))
@@ -22,12 +19,16 @@ class SampleRateSampler(Sampler):
             self.index_dic[pid].append(index)
         self.pids = list(self.index_dic.keys())
         self.sample_num_per_epoch = sample_num_per_epoch
+        self._init_rng(seed)
 
     def update(self, pos_rate):
         self.pos_rate = pos_rate.cpu().item()
 
     def __iter__(self):
+        skip = self._start_epoch()
         self.cur_idx = -1
+        for _ in range(skip):
+            next(self)
         return self
 
     def __next__(self):
@@ -35,16 +36,16 @@ class SampleRateSampler(Sampler):
         if self.cur_idx >= self.sample_num_per_epoch:
             raise StopIteration
 
-        if randuniform() < self.pos_rate:
+        if self.rng.uniform() < self.pos_rate:
             '''positive pair'''
-            pid = randchoice(self.pids)
+            pid = self.rng.choice(self.pids)
             candidates = self.index_dic[pid]
-            chosen = tuple(randchoice(candidates, size=2, replace=True))
+            chosen = tuple(self.rng.choice(candidates, size=2, replace=True))
 
         else:
             '''negative pair'''
-            pid_pair = tuple(randchoice(self.pids, size=2, replace=False))
-            chosen = tuple([randchoice(self.index_dic[pid]) for pid in pid_pair])
+            pid_pair = tuple(self.rng.choice(self.pids, size=2, replace=False))
+            chosen = tuple([self.rng.choice(self.index_dic[pid]) for pid in pid_pair])
 
         return chosen
 
@@ -55,33 +56,58 @@ class SampleRateSampler(Sampler):
 
 
 class _HalfQueue(object):
+    """selects elements out of the ones not selected recently.
+    The selection pool is a list (with positions for O(1) removal), so that the selections are reproducible."""
+
     def __init__(self, elements: list, num=1):
         num_elements = len(elements)
-        max_recent_num = num_elements // 2
-        self.recent = Queue(maxsize=max_recent_num)
-        self.selection_pool = set(elements)
+        self.max_recent_num = num_elements // 2
+        self.recent = deque()
+        self.selection_pool = list(elements)
+        self.positions = {e: i for i, e in enumerate(self.selection_pool)}
         self.num = num
 
+    def _remove(self, element):
+        i = self.positions.pop(element)
+        last = self.selection_pool.pop()
+        if i < len(self.selection_pool):
+            self.selection_pool[i] = last
+            self.positions[last] = i
+
     def _update(self, new_element):
-        self.selection_pool.remove(new_element)
+        self._remove(new_element)
 
-        if self.recent.full():
-            old_element = self.recent.get()
-            self.selection_pool.add(old_element)
+        if 0 < self.max_recent_num <= len(self.recent):
+            old_element = self.recent.popleft()
+            self.positions[old_element] = len(self.selection_pool)
+            self.selection_pool.append(old_element)
 
-        self.recent.put(new_element)
+        self.recent.append(new_element)
 
-    def select(self):
-        res = randsample(self.selection_pool, self.num)
+    def select(self, rng):
+        res = [self.selection_pool[i] for i in rng.choice(len(self.selection_pool), self.num, replace=False)]
         for e in res:
             self._update(e)
 
         return res
 
+    def state_dict(self):
+        return {'recent': list(self.recent), 'selection_pool': list(self.selection_pool)}
+
+    def load_state_dict(self, state):
+        self.recent = deque(state['recent'])
+        self.selection_pool = list(state['selection_pool'])
+        self.positions = {e: i for i, e in enumerate(self.selection_pool)}
+
 
 class SampleRateBatchSampler(SampleRateSampler):
-    def __init__(self, data_source, sample_num_per_epoch=500*256, batch_size=1):
-        super(SampleRateBatchSampler, self).__init__(data_source, sample_num_per_epoch)
+    """As the batches depend on pos_rate, which is updated after every step, an epoch can not be redrawn on resuming.
+    Instead, the states before the recent batches are kept, and the one before the first unconsumed batch is saved."""
+
+    history_len = 64
+
+    def __init__(self, data_source, sample_num_per_epoch=500*256, batch_size=1, seed=None):
+        super(SampleRateBatchSampler, self).__init__(data_source, sample_num_per_epoch, seed)
 
         self.batch_size = batch_size
 
@@ -89,15 +115,41 @@ class SampleRateBatchSampler(SampleRateSampler):
         self.neg_agent = _HalfQueue(self.pids, 2)
 
         self.length = (self.sample_num_per_epoch + self.batch_size - 1) // self.batch_size
+        self.history = OrderedDict()
+
+    def _snapshot(self):
+        return {'rng': self.rng.get_state(),
+                'pos_agent': self.pos_agent.state_dict(),
+                'neg_agent': self.neg_agent.state_dict()}
+
+    def state_dict(self, consumed=0):
+        snapshot = self.history.get(consumed)
+        if snapshot is None:
+            snapshot = self._snapshot()
+        return {'snapshot': snapshot, 'consumed': consumed}
+
+    def load_state_dict(self, state):
+        snapshot = state['snapshot']
+        self.rng.set_state(snapshot['rng'])
+        self.pos_agent.load_state_dict(snapshot['pos_agent'])
+        self.neg_agent.load_state_dict(snapshot['neg_agent'])
+        self._skip = state['consumed']
+
+    def __iter__(self):
+        # no redrawing, the state has been restored right at the first unconsumed batch
+        skip, self._skip = self._skip, 0
+        self.cur_idx = skip - 1
+        self.history.clear()
+        return self
 
     def _get_pos_sample(self):
-        pid = self.pos_agent.select()[0]
-        chosen = tuple(randchoice(self.index_dic[pid], size=2, replace=True))
+        pid = self.pos_agent.select(self.rng)[0]
+        chosen = tuple(self.rng.choice(self.index_dic[pid], size=2, replace=True))
         return chosen
 
     def _get_neg_sample(self):
-        pid_pair = self.neg_agent.select()
-        chosen = tuple([randchoice(self.index_dic[pid]) for pid in pid_pair])
+        pid_pair = self.neg_agent.select(self.rng)
+        chosen = tuple([self.rng.choice(self.index_dic[pid]) for pid in pid_pair])
         return chosen
 
     def __next__(self):
@@ -105,6 +157,10 @@ class SampleRateBatchSampler(SampleRateSampler):
         if self.cur_idx >= self.length:
             raise StopIteration
 
+        self.history[self.cur_idx] = self._snapshot()
+        if len(self.history) > self.history_len:
+            self.history.popitem(last=False)
+
         # pos_num = binomial(self.batch_size, self.pos_rate)
 
         pos_num = round(self.batch_size * self.pos_rate)
@@ -118,4 +174,47 @@ class SampleRateBatchSampler(SampleRateSampler):
         return batch
 
     def __len__(self):
-        return self.length
\ No newline at end of file
+        return self.length
+
+class HardSampleRateBatchSampler(HardPairMining, SampleRateBatchSampler):
+    def __init__(self, data_source, sample_num_per_epoch=500*256, batch_size=1, hard_rate=0.5, neg_candidates=10,
+                 seed=None):
+        super(HardSampleRateBatchSampler, self).__init__(data_source, sample_num_per_epoch, batch_size, seed)
+        self._init_mining(data_source, hard_rate, neg_candidates)
+
+    def _get_pos_sample(self):
+        if self._use_hard():
+            return self._hard_pos_pair()
+        return super(HardSampleRateBatchSampler, self)._get_pos_sample()
+
+    def _get_neg_sample(self):
+        if self._use_hard():
+            return self._hard_neg_pair()
+        return super(HardSampleRateBatchSampler, self)._get_neg_sample()
+
+
+class DistributedBatches(DistributedSampling):
+    """for the samplers drawing whole batches: each rank keeps every world_size-th pair of a batch from its rank on.
+    pos_rate is the same on all the ranks, as SRL_BCELoss all-reduces its gradient."""
+
+    def __next__(self):
+        batch = super(DistributedBatches, self).__next__()
+        return batch[self.rank::self.world_size]
+
+    next = __next__  # Python 2 compatibility
+
+
+class DistributedSampleRateBatchSampler(DistributedBatches, SampleRateBatchSampler):
+    """batch_size is the number of pairs of all the ranks"""
+
+    def __init__(self, data_source, sample_num_per_epoch=500*256, batch_size=1, seed=0, rank=None, world_size=None):
+        super(DistributedSampleRateBatchSampler, self).__init__(data_source, sample_num_per_epoch, batch_size, seed)
+        self._init_distributed(seed, rank, world_size)
+
+
+class DistributedHardSampleRateBatchSampler(DistributedBatches, HardSampleRateBatchSampler):
+    def __init__(self, data_source, sample_num_per_epoch=500*256, batch_size=1, hard_rate=0.5, neg_candidates=10,
+                 seed=0, rank=None, world_size=None):
+        super(DistributedHardSampleRateBatchSampler, self).__init__(data_source, sample_num_per_epoch, batch_size,
+                                                                    hard_rate, neg_candidates, seed)
+        self._init_distributed(seed, rank, world_size)
@@ -13,6 +13,7 @@ import torch
 from torch.nn.modules.batchnorm import _BatchNorm as origin_BN
 from warnings import warn
 from SampleRateLearning.stable_batchnorm import global_variables as batch_labels
+from SampleRateLearning.stable_batchnorm import class_stats
 
 
 class _BatchNorm(origin_BN):
@@ -41,42 +42,22 @@ class _BatchNorm(origin_BN):
 
         sz = input.size()
         if self.training:
-            if input.dim() == 4:
-                reduced_dim = (0, 2, 3)
-            elif input.dim() == 2:
-                reduced_dim = (0, )
-            else:
-                raise NotImplementedError
-
             self.num_batches_tracked += 1
             correction_factor = 1. - (1. - self.momentum) ** self.num_batches_tracked
 
             data = input.detach()
-            if input.size(0) == batch_labels.batch_size:
-                indices = batch_labels.indices
-            else:
-                indices = batch_labels.braid_indices
-
-            means = []
-            for group in indices:
-                if len(group) == 0:
-                    warn('There is no sample of at least one class in current batch, which is incompatible with SRL.')
-                    continue
-                samples = data[group]
-                mean = torch.mean(samples, dim=reduced_dim, keepdim=False)
-                means.append(mean)
-
-            di_mean = sum(means) / len(means)
+            labels = batch_labels.sample_labels(input)
+            present = batch_labels.present_classes()
+            if not batch_labels.all_classes_present():
+                warn('There is no sample of at least one class in current batch, which is incompatible with SRL.')
+
+            means = class_stats.class_means(data, labels, batch_labels.classes_num)
+            di_mean = class_stats.present_mean(means, present)
             self.running_mean = (1 - self.momentum) * self.running_mean + self.momentum * di_mean
 
-            MAEs = []
             data = (data - self.expand(self.running_mean.detach()/correction_factor, sz))
-            for group in indices:
-                samples = data[group]
-                MAE = samples.abs().mean(dim=reduced_dim, keepdim=False)
-                MAEs.append(MAE)
-
-            di_MAE = sum(MAEs) / len(MAEs)
+            MAEs = class_stats.class_means(data.abs(), labels, batch_labels.classes_num)
+            di_MAE = class_stats.present_mean(MAEs, present)
             # Note: the running_var is running_MAE indeed, for convenience of external calling, it has not been renamed.
             self.running_var = (1 - self.momentum) * self.running_var + self.momentum * di_MAE
 
@@ -15,6 +15,7 @@ vars via total running_mean,
 import torch
 from torch.nn.modules.batchnorm import _BatchNorm as origin_BN
 from SampleRateLearning.stable_batchnorm import global_variables as batch_labels
+from SampleRateLearning.stable_batchnorm import class_stats
 
 
 class _BatchNorm(origin_BN):
@@ -45,40 +46,23 @@ class _BatchNorm(origin_BN):
 
         sz = input.size()
         if self.training:
-            if input.dim() == 4:
-                reduced_dim = (0, 2, 3)
-            elif input.dim() == 2:
-                reduced_dim = (0, )
-            else:
-                raise NotImplementedError
-
             data = input.detach()
-            if input.size(0) == batch_labels.batch_size:
-                indices = batch_labels.indices
-            else:
-                indices = batch_labels.braid_indices
+            labels = batch_labels.sample_labels(input)
 
-            if len(indices) != self.num_classes:
+            if batch_labels.classes_num != self.num_classes:
                 raise ValueError
 
-            for c, group in enumerate(indices):
-                if len(group) == 0:
-                    continue
-                self.num_batches_tracked[c] += 1
-                samples = data[group]
-                mean = torch.mean(samples, dim=reduced_dim, keepdim=False)
-                self.running_cls_means[:, c] = (1 - self.momentum) * self.running_cls_means[:, c] + self.momentum * mean
+            present = batch_labels.present_classes(self.num_classes)
+            self.num_batches_tracked += present.long()
+            means = class_stats.class_means(data, labels, self.num_classes)
+            class_stats.update_running(self.running_cls_means, means, present, self.momentum)
 
             correction_factors = (1. - (1. - self.momentum) ** self.num_batches_tracked)
             self.running_mean = (self.running_cls_means / correction_factors).mean(dim=1, keepdim=False)
             data = data - self.expand(self.running_mean, sz)
 
-            for c, group in enumerate(indices):
-                if len(group) == 0:
-                    continue
-                samples = data[group]
-                var = samples.square().mean(dim=reduced_dim, keepdim=False)
-                self.running_cls_vars[:, c] = (1 - self.momentum) * self.running_cls_vars[:, c] + self.momentum * var
+            vars = class_stats.class_means(data.square(), labels, self.num_classes)
+            class_stats.update_running(self.running_cls_vars, vars, present, self.momentum)
 
             # Note: the running_var is running_std indeed, for convenience of external calling, it has not been renamed.
             self.running_var = (self.running_cls_vars / correction_factors).mean(dim=1, keepdim=False)
@@ -16,6 +16,7 @@ stpds via total running_mean,
 import torch
 from torch.nn.modules.batchnorm import _BatchNorm as origin_BN
 from SampleRateLearning.stable_batchnorm import global_variables as batch_labels
+from SampleRateLearning.stable_batchnorm import class_stats
 
 
 class _BatchNorm(origin_BN):
@@ -57,21 +58,15 @@ class _BatchNorm(origin_BN):
             else:
                 raise NotImplementedError
 
-            if input.size(0) == batch_labels.batch_size:
-                indices = batch_labels.indices
-            else:
-                indices = batch_labels.braid_indices
+            labels = batch_labels.sample_labels(input)
 
-            if len(indices) != self.num_classes:
+            if batch_labels.classes_num != self.num_classes:
                 raise ValueError
 
-            for c, group in enumerate(indices):
-                if len(group) == 0:
-                    continue
-                self.num_batches_tracked[c] += 1
-                samples = instance_means[group]
-                mean = torch.mean(samples, dim=0, keepdim=False)
-                self.running_cls_means[:, c] = (1 - self.momentum) * self.running_cls_means[:, c] + self.momentum * mean
+            present = batch_labels.present_classes(self.num_classes)
+            self.num_batches_tracked += present.long()
+            means = class_stats.class_means(instance_means, labels, self.num_classes)
+            class_stats.update_running(self.running_cls_means, means, present, self.momentum)
 
             correction_factors = (1. - (1. - self.momentum) ** self.num_batches_tracked)
             self.running_mean = (self.running_cls_means / correction_factors).mean(dim=1, keepdim=False)
@@ -83,12 +78,8 @@ class _BatchNorm(origin_BN):
             elif input.dim() == 2:
                 instance_stpds = data
 
-            for c, group in enumerate(indices):
-                if len(group) == 0:
-                    continue
-                samples = instance_stpds[group]
-                stpd = samples.mean(dim=0, keepdim=False)
-                self.running_cls_stpds[:, c] = (1 - self.momentum) * self.running_cls_stpds[:, c] + self.momentum * stpd
+            stpds = class_stats.class_means(instance_stpds, labels, self.num_classes)
+            class_stats.update_running(self.running_cls_stpds, stpds, present, self.momentum)
 
             # Note: the running_var is running_stpd indeed, for convenience of external calling, it has not been renamed.
             self.running_var = (self.running_cls_stpds / correction_factors).mean(dim=1, keepdim=False)
@@ -2,6 +2,7 @@ import torch
 from torch.nn.modules.batchnorm import _BatchNorm as origin_BN
 from warnings import warn
 from SampleRateLearning.stable_batchnorm import global_variables as batch_labels
+from SampleRateLearning.stable_batchnorm import class_stats
 
 '''average stds but not vars of all classes, .../max(eps, std)'''
 
@@ -38,34 +39,15 @@ class _BatchNorm(origin_BN):
 
         sz = input.size()
         if self.training:
-            means = []
-            stds = []
-            if input.dim() == 4:
-                reduced_dim = (0, 2, 3)
-            elif input.dim() == 2:
-                reduced_dim = (0, )
-            else:
-                raise NotImplementedError
-
             data = input.detach()
-            if input.size(0) == batch_labels.batch_size:
-                indices = batch_labels.indices
-            else:
-                indices = batch_labels.braid_indices
-
-            for group in indices:
-                if len(group) == 0:
-                    warn('There is no sample of at least one class in current batch, which is incompatible with SRL.')
-                    continue
-                samples = data[group]
-                mean = torch.mean(samples, dim=reduced_dim, keepdim=False)
-                std = torch.std(samples, dim=reduced_dim, keepdim=False, unbiased=False)
-
-                means.append(mean)
-                stds.append(std)
-
-            di_mean = sum(means) / len(means)
-            di_std = sum(stds) / len(stds)
+            labels = batch_labels.sample_labels(input)
+            present = batch_labels.present_classes()
+            if not batch_labels.all_classes_present():
+                warn('There is no sample of at least one class in current batch, which is incompatible with SRL.')
+
+            means, vars = class_stats.class_moments(data, labels, batch_labels.classes_num)
+            di_mean = class_stats.present_mean(means, present)
+            di_std = class_stats.present_mean(vars.sqrt(), present)
 
             if self.track_running_stats:
                 self.running_mean = (1 - exponential_average_factor) * self.running_mean + exponential_average_factor * di_mean
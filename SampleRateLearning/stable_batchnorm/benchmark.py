@@ -0,0 +1,167 @@
+# encoding: utf-8
+import copy
+import importlib
+import time
+import warnings
+from contextlib import contextmanager
+
+import torch
+
+from SampleRateLearning.stable_batchnorm import class_stats
+from SampleRateLearning.stable_batchnorm import global_variables as batch_labels
+
+'''
+Equivalence and CPU speed of the class-wise statistics against the former loops over the groups of samples
+of each class, for every stable BN layer grouping its samples by labels. The reference loops below are those
+of the layers before the statistics were vectorized, each skipping the classes absent from the batch.
+The second loop of variants 8-11 (the stds around the running mean) did not skip them: the std of an empty group
+is NaN, which poisoned running_var. These variants now average over the present classes, as their first loop,
+so the check expects the loops skipping them, and finite buffers after a batch missing a class.
+run by: python -m SampleRateLearning.stable_batchnorm.benchmark
+'''
+
+LABELED_VARIANTS = (1, 2, 3, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 19, 21, 22, 24, 27, 28, 29, 30, 31, 34)
+
+
+def _groups(labels, num_classes):
+    return [torch.nonzero(labels == c, as_tuple=False).view(-1) for c in range(num_classes)]
+
+
+def _reduced_dim(data):
+    return (0, 2, 3) if data.dim() == 4 else (0, )
+
+
+def _class_means_loop(data, labels, num_classes):
+    stats = data.new_zeros(num_classes, data.size(1))
+    for c, group in enumerate(_groups(labels, num_classes)):
+        if len(group) > 0:
+            stats[c] = data[group].mean(dim=_reduced_dim(data))
+    return stats
+
+
+def _class_moments_loop(data, labels, num_classes):
+    means = _class_means_loop(data, labels, num_classes)
+    variances = data.new_zeros(num_classes, data.size(1))
+    for c, group in enumerate(_groups(labels, num_classes)):
+        if len(group) > 0:
+            variances[c] = torch.var(data[group], dim=_reduced_dim(data), unbiased=False)
+    return means, variances
+
+
+def _class_maxes_loop(data, labels, num_classes):
+    stats = data.new_zeros(num_classes, data.size(1))
+    for c, group in enumerate(_groups(labels, num_classes)):
+        if len(group) > 0:
+            maxes = data[group]
+            for dim in reversed(_reduced_dim(data)):
+                maxes, _ = maxes.max(dim, False)
+            stats[c] = maxes
+    return stats
+
+
+def _class_nonzero_rms_loop(data, labels, num_classes):
+    stats = data.new_zeros(num_classes, data.size(1))
+    for c, group in enumerate(_groups(labels, num_classes)):
+        if len(group) == 0:
+            continue
+        for i, channel in enumerate(data[group].split(1, dim=1)):
+            channel = channel[channel.nonzero(as_tuple=True)]
+            if len(channel) > 0:
+                stats[c, i] = channel.square().mean().sqrt()
+    return stats
+
+
+def _present_mean_loop(stats, present):
+    present_stats = [stats[c] for c in range(len(present)) if present[c]]
+    return sum(present_stats) / len(present_stats)
+
+
+def _update_running_loop(running, stats, present, momentum):
+    for c in range(len(present)):
+        if present[c]:
+            m = momentum[c] if isinstance(momentum, torch.Tensor) else momentum
+            running[:, c] = (1 - m) * running[:, c] + m * stats[c]
+
+
+LOOPS = {'class_means': _class_means_loop, 'class_moments': _class_moments_loop, 'class_maxes': _class_maxes_loop,
+         'class_nonzero_rms': _class_nonzero_rms_loop, 'present_mean': _present_mean_loop,
+         'update_running': _update_running_loop}
+
+
+@contextmanager
+def loops():
+    """the layers compute their statistics by the former loops over the groups of each class"""
+    vectorized = {name: getattr(class_stats, name) for name in LOOPS}
+    for name, fun in LOOPS.items():
+        setattr(class_stats, name, fun)
+    try:
+        yield
+    finally:
+        for name, fun in vectorized.items():
+            setattr(class_stats, name, fun)
+
+
+def _layers(n, num_features):
+    module = importlib.import_module('SampleRateLearning.stable_batchnorm.batchnorm{0}'.format(n))
+    return [module.BatchNorm2d(num_features).train(), module.BatchNorm1d(num_features).train()]
+
+
+def _input(layer, batch_size, num_features, height, width):
+    if layer.__class__.__name__ == 'BatchNorm2d':
+        return torch.randn(batch_size, num_features, height, width)
+    return torch.randn(batch_size, num_features)
+
+
+def check_equivalence(n, batch_size=32, num_features=16, height=8, width=4, steps=4):
+    torch.manual_seed(n)
+    for layer in _layers(n, num_features):
+        reference = copy.deepcopy(layer)
+        name = 'batchnorm{0}.{1}'.format(n, type(layer).__name__)
+        for step in range(steps):
+            x = _input(layer, batch_size, num_features, height, width)
+            # the last batch misses a class
+            labels = torch.zeros(batch_size, dtype=torch.long) if step == steps - 1 \
+                else torch.randint(batch_labels.classes_num, (batch_size, ))
+            with batch_labels.LabelScope(labels), warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                output_ = layer(x)
+                with loops():
+                    expected = reference(x)
+            assert torch.allclose(output_, expected, rtol=1e-4, atol=1e-5), 'outputs of {0} differ'.format(name)
+        for (key, b), r in zip(layer.state_dict().items(), reference.state_dict().values()):
+            assert torch.isfinite(b.float()).all(), '{0}.{1} is not finite'.format(name, key)
+            assert torch.allclose(b.float(), r.float(), rtol=1e-4, atol=1e-5), '{0}.{1} differs'.format(name, key)
+
+
+def _time(layer, x, repeat):
+    layer(x)
+    start = time.time()
+    for _ in range(repeat):
+        layer(x)
+    return (time.time() - start) / repeat
+
+
+def benchmark(n, batch_size=128, num_features=256, height=16, width=8, repeat=20):
+    layer = _layers(n, num_features)[0]
+    x = _input(layer, batch_size, num_features, height, width)
+    labels = torch.randint(batch_labels.classes_num, (batch_size, ))
+    with batch_labels.LabelScope(labels), torch.no_grad():
+        with loops():
+            loop_time = _time(copy.deepcopy(layer), x, repeat)
+        vectorized_time = _time(layer, x, repeat)
+    print('batchnorm{0}: {1:.2f}ms -> {2:.2f}ms (x{3:.2f})'.format(n, loop_time * 1000., vectorized_time * 1000.,
+                                                                  loop_time / vectorized_time))
+
+
+def main():
+    batch_labels.classes_num = 2
+    for n in LABELED_VARIANTS:
+        check_equivalence(n)
+    print('the class-wise statistics are equivalent to the former loops.')
+
+    for n in LABELED_VARIANTS:
+        benchmark(n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# encoding: utf-8
+import torch
+
+'''
+Class-wise statistics of the stable BN layers, computed for all the classes at once from the per-sample labels
+(see global_variables.sample_labels) by index_add_/scatter_reduce, instead of a loop over the groups of samples.
+The statistics are [num_classes, F], 0 for the classes absent from the batch, and the running buffers
+[F, num_classes] are updated for the present classes only, as the former per-class loops did.
+'''
+
+
+def _per_sample(stats, data):
+    """stats ([N, F]) broadcastable to data ([N, F] or [N, F, H, W])"""
+    if data.dim() == 4:
+        return stats.unsqueeze(2).unsqueeze(3)
+    return stats
+
+
+def _instance_reduce(data, reduce='mean'):
+    if data.dim() == 4:
+        if reduce == 'mean':
+            return data.mean(dim=(2, 3))
+        elif reduce == 'sum':
+            return data.sum(dim=(2, 3))
+        elif reduce == 'max':
+            return data.flatten(2).max(dim=2)[0]
+        raise NotImplementedError
+    elif data.dim() == 2:
+        return data
+    raise NotImplementedError
+
+
+def class_counts(labels, num_classes):
+    """unlike bincount, index_add_ does not synchronize CUDA labels to the host for the size of the result"""
+    return labels.new_zeros(num_classes).index_add_(0, labels, torch.ones_like(labels))
+
+
+def present_classes(labels, num_classes):
+    """[num_classes] bool, whether each class has samples in the batch"""
+    return torch.zeros(num_classes, dtype=torch.bool, device=labels.device).index_fill_(0, labels, True)
+
+
+def class_sums(values, labels, num_classes):
+    """[num_classes, F] sums of values ([N, F]) over the samples of each class"""
+    return values.new_zeros((num_classes, ) + values.size()[1:]).index_add_(0, labels, values)
+
+
+def class_means(data, labels, num_classes):
+    """[num_classes, F] means of data ([N, F] or [N, F, H, W]) over the samples (and positions) of each class,
+    i.e. data[group].mean(dim=(0, 2, 3)) of each group"""
+    counts = class_counts(labels, num_classes).clamp(min=1).unsqueeze(1).to(data.dtype)
+    return class_sums(_instance_reduce(data), labels, num_classes) / counts
+
+
+def class_moments(data, labels, num_classes):
+    """class means and biased variances, i.e. (mean, var(unbiased=False)) of data[group] over (0, 2, 3)"""
+    means = class_means(data, labels, num_classes)
+    centered = data - _per_sample(means[labels], data)
+    return means, class_means(centered.square(), labels, num_classes)
+
+
+def class_maxes(data, labels, num_classes):
+    """[num_classes, F] maxes of data over the samples (and positions) of each class"""
+    data = _instance_reduce(data, 'max')
+    maxes = data.new_zeros(num_classes, data.size(1))
+    index = labels.unsqueeze(1).expand_as(data)
+    return maxes.scatter_reduce_(0, index, data, reduce='amax', include_self=False)
+
+
+def class_nonzero_rms(data, labels, num_classes):
+    """[num_classes, F] root mean squares of the nonzero elements of each channel over the samples of each class,
+    0 if there is none"""
+    squares = class_sums(_instance_reduce(data.square(), 'sum'), labels, num_classes)
+    nonzeros = class_sums(_instance_reduce((data != 0).to(data.dtype), 'sum'), labels, num_classes)
+    return (squares / nonzeros.clamp(min=1)).sqrt()
+
+
+def present_mean(stats, present):
+    """the mean of stats ([num_classes, F]) over the present classes"""
+    weights = present.to(stats.dtype).unsqueeze(1)
+    return (stats * weights).sum(dim=0) / weights.sum()
+
+
+def update_running(running, stats, present, momentum):
+    """in place, the moving averages running ([F, num_classes]) of the present classes towards stats,
+    momentum being a float or a [num_classes] tensor"""
+    updated = (1. - momentum) * running + momentum * stats.t()
+    running.copy_(torch.where(present, updated, running))
@@ -1,29 +1,101 @@
 # encoding: utf-8
+import threading
+
 import torch
+
+from SampleRateLearning.stable_batchnorm import class_stats
+
+'''
+The per-sample class labels of the stable BN layers, carried through the forward pass instead of module globals:
+the trainer calls the model with labels=..., Utils.data_parallel.DataParallel scatters them along with the inputs,
+and each replica runs under the slice of its own samples (thread-local, as the replicas run in threads).
+A layer matches the labels to its input, which holds either the samples themselves (e.g. the pairs),
+or the bi structure [a; b] of them, i.e. the labels twice.
+What is derived from the labels (the labels of the bi structure, the present classes) is computed once per scope
+and shared by all the layers.
+'''
+
 classes_num = 0
-indices = [[]]
-braid_indices = [[]]
-batch_size = None
-
-
-def parse_target(target):
-    """each element of target ranges from 0. to (classes_num-1)"""
-    global classes_num, indices, braid_indices, batch_size
-
-    if isinstance(target, list):
-        pass
-    elif isinstance(target, torch.Tensor):
-        target = target.view(-1).numpy().tolist()
-    else:
-        raise TypeError
-
-    indices = [[] for _ in range(classes_num)]
-    for i, e in enumerate(target):
-        indices[int(e)].append(i)
-
-    batch_size = len(target)
-    braid_indices = []
-    for sub_indices in indices:
-        braid_sub_indices = sub_indices + [i + batch_size for i in sub_indices]
-        braid_indices.append(braid_sub_indices)
+_context = threading.local()
+
+
+def _get_scope():
+    return getattr(_context, 'scope', None)
+
+
+def get_labels():
+    scope = _get_scope()
+    return None if scope is None else scope.labels
+
+
+class LabelScope(object):
+    """with LabelScope(labels): the forward passes of this thread see labels ([N], from 0 to classes_num-1)"""
+    def __init__(self, labels):
+        if labels is not None:
+            labels = labels.view(-1).long()
+        self.labels = labels
+        self.cache = {}
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = _get_scope()
+        _context.scope = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _context.scope = self.previous
+
+    def cached(self, key, compute):
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+
+def labeled_call(module, *inputs, labels=None, **kwargs):
+    with LabelScope(labels):
+        return module(*inputs, **kwargs)
+
+
+class LabeledModule(torch.nn.Module):
+    """a replica of DataParallel, run under the labels scattered to it"""
+    def __init__(self, module):
+        super(LabeledModule, self).__init__()
+        self.module = module
+
+    def forward(self, *inputs, **kwargs):
+        return labeled_call(self.module, *inputs, **kwargs)
+
+
+def _labeled_scope():
+    scope = _get_scope()
+    if scope is None or scope.labels is None:
+        raise RuntimeError('the stable BN layers need the labels of the samples, call the model with labels=...')
+    return scope
+
+
+def sample_labels(input):
+    """the labels of the samples of input"""
+    scope = _labeled_scope()
+    labels = scope.labels
+    if input.size(0) == labels.size(0):
+        return labels
+    elif input.size(0) == 2 * labels.size(0):
+        return scope.cached('bi_labels', lambda: torch.cat((labels, labels)))
+    raise ValueError('{0} samples do not match {1} labels'.format(input.size(0), labels.size(0)))
+
+
+def present_classes(num_classes=None):
+    """[num_classes] bool, whether each class has samples in the batch (the same for its bi structure)"""
+    if num_classes is None:
+        num_classes = classes_num
+    scope = _labeled_scope()
+    return scope.cached(('present', num_classes),
+                        lambda: class_stats.present_classes(scope.labels, num_classes))
+
+
+def all_classes_present(num_classes=None):
+    """a synchronization to the host, once per batch rather than per layer"""
+    if num_classes is None:
+        num_classes = classes_num
+    return _labeled_scope().cached(('all_present', num_classes), lambda: bool(present_classes(num_classes).all()))
 
@@ -9,6 +9,7 @@ from .tensor_section_functions import tensor_size, tensor_memory, tensor_cuda, t
 
 GPUS = [int(i) for i in os.environ['CUDA_VISIBLE_DEVICES'].split(',') if i]
 GPU_NUM = len(GPUS)
+CPU_BATCHSIZE = 64  # without gpus, e.g. in the distributed training on cpus
 
 
 def get_free_memory_size():
@@ -103,6 +104,9 @@ def get_max_equal_batchsize(fun, *samples):
 
 def get_optimized_batchsize(fun, *samples):
     '''I am not sure that the returned batchsize can make the computaion faster'''
+    if not cuda.is_available():
+        return CPU_BATCHSIZE
+
     max_batchsize = get_max_equal_batchsize(fun, *samples)
     per_gpu_max_batchsize = max(max_batchsize // GPU_NUM, 1)
     per_gpu_opti_batchsize = 2 ** max(int(math.log2(per_gpu_max_batchsize) - 0.5), 0)
@@ -0,0 +1,143 @@
+# encoding: utf-8
+import time
+from contextlib import ExitStack
+
+import torch
+
+from Utils.tensor_section_functions import tensor_float
+
+'''
+Automatic mixed precision: float16 autocast with a GradScaler on CUDA, bfloat16 autocast on CPU.
+The layers whose statistics or exponentials are unsafe in half precision (the stable BN variants, the soft min/max
+and the Y heads combining the two braids) are kept in float32 by keep_fp32.
+The min/max braid combines themselves are exact in any precision, so only their BN and the heads are promoted.
+'''
+
+FP32_MODULES = ('SoftMin', 'SoftMax',
+                'SumY', 'MaxY', 'SquareY', 'SumSquareY', 'MeanSquareY', 'MinY', 'MinMaxY', 'SquareMaxY')
+FP32_PACKAGES = ('SampleRateLearning.stable_batchnorm', )
+
+
+def _device_type(device):
+    return torch.device(device).type
+
+
+def autocast(device, enabled=True):
+    device_type = _device_type(device)
+    dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype, enabled=enabled)
+
+
+def get_grad_scaler(device, enabled=True):
+    """a pass-through scaler when disabled or on CPU, where bfloat16 has the range of float32"""
+    return torch.cuda.amp.GradScaler(enabled=enabled and _device_type(device) == 'cuda')
+
+
+def _to_float(data):
+    if isinstance(data, torch.Tensor):
+        return data.float() if data.is_floating_point() else data
+    elif isinstance(data, (list, tuple)):
+        return type(data)(_to_float(d) for d in data)
+    elif isinstance(data, dict):
+        return {k: _to_float(v) for k, v in data.items()}
+    return data
+
+
+def fp32_call(fun):
+    """fun run in float32 even inside an autocast region"""
+    def wrapper(*args, **kwargs):
+        with ExitStack() as stack:
+            for device_type in ('cuda', 'cpu') if torch.cuda.is_available() else ('cpu', ):
+                stack.enter_context(torch.autocast(device_type=device_type, enabled=False))
+            return fun(*_to_float(args), **_to_float(kwargs))
+    return wrapper
+
+
+_fp32_classes = {}
+
+
+def _fp32_class(cls, method='forward'):
+    if (cls, method) not in _fp32_classes:
+        _fp32_classes[(cls, method)] = type(cls.__name__, (cls, ), {method: fp32_call(getattr(cls, method)),
+                                                                    '__module__': cls.__module__,
+                                                                    'fp32': True})
+    return _fp32_classes[(cls, method)]
+
+
+def _needs_fp32(module):
+    cls = type(module)
+    if getattr(cls, 'fp32', False):
+        return False
+    return cls.__name__ in FP32_MODULES or cls.__module__.startswith(FP32_PACKAGES)
+
+
+def keep_fp32(model):
+    """in place, the modules needing float32 get a subclass whose forward disables autocast.
+    Their parameters and state_dict are unchanged, and the class survives the replication of DataParallel."""
+    count = 0
+    for m in model.modules():
+        if _needs_fp32(m):
+            m.__class__ = _fp32_class(type(m))
+            count += 1
+    print('{0} layers are kept in float32 under autocast.'.format(count))
+    return model
+
+
+def fp32_criterion(criterion):
+    """in place, the criterion (or each of a list) computes the loss from float32 scores outside autocast,
+    as BCELoss refuses half inputs and the SRL sampling rates are updated inside the call"""
+    if isinstance(criterion, (list, tuple)):
+        for c in criterion:
+            fp32_criterion(c)
+    elif not getattr(type(criterion), 'fp32', False):
+        method = 'forward' if isinstance(criterion, torch.nn.Module) else '__call__'
+        criterion.__class__ = _fp32_class(type(criterion), method)
+    return criterion
+
+
+def _outputs(model, inputs, device, amp, **kwargs):
+    with autocast(device, amp):
+        output_ = tensor_float(model(*inputs, **kwargs))
+    return output_ if isinstance(output_, list) else [output_]
+
+
+def compare_precisions(model, inputs, device, repeat=10, **kwargs):
+    """time per forward and backward of model(*inputs, **kwargs) in float32 and with autocast, the max relative
+    deviation of the outputs (in eval mode) and the ratio of them having the same signs"""
+    model.eval()
+    with torch.no_grad():
+        outputs = [_outputs(model, inputs, device, amp, **kwargs) for amp in (False, True)]
+    deviation = max(((o - r).abs().max() / r.abs().max().clamp(min=1e-12)).item() for r, o in zip(*outputs))
+    agreement = min(((o > 0) == (r > 0)).float().mean().item() for r, o in zip(*outputs))
+
+    model.train()
+    times = []
+    for amp in (False, True):
+        start = time.time()
+        for _ in range(repeat):
+            model.zero_grad()
+            sum(o.sum() for o in _outputs(model, inputs, device, amp, **kwargs)).backward()
+        if _device_type(device) == 'cuda':
+            torch.cuda.synchronize()
+        times.append((time.time() - start) / repeat)
+    return times[0], times[1], deviation, agreement
+
+
+if __name__ == '__main__':
+    # python -m Utils.amp braidmgn braidosnet
+    import sys
+
+    from config import opt
+    from PrimaryObjectsFactory.model_with_optimizer_generator import get_model_with_optimizer
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    batch_size = 16 if device == 'cuda' else 4
+    ims = [torch.randn(batch_size, 3, 256, 128, device=device) for _ in range(2)]
+    for model_name in sys.argv[1:] or ['braidmgn']:
+        opt.model_name = model_name
+        net = get_model_with_optimizer(opt, naive=True).to(device)
+        fp32_time, amp_time, deviation, agreement = compare_precisions(keep_fp32(net), ims, device, mode='normal')
+        print('{0}: {1:.1f} -> {2:.1f} pairs/s (x{3:.2f}), max relative deviation of scores {4:.2e}, '
+              'same decisions on {5:.2%} of the pairs'
+              .format(model_name, batch_size / fp32_time, batch_size / amp_time, fp32_time / amp_time,
+                      deviation, agreement))
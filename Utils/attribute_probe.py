@@ -0,0 +1,87 @@
+# encoding: utf-8
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import sklearn
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import confusion_matrix
+from sklearn.svm import LinearSVC
+
+'''
+Linear probes of attribute classes on a feature matrix, fitted in parallel.
+The standardized float32 features are put in shared memory once, and every worker process maps them
+instead of receiving a copy with each task.
+'''
+
+_features = None
+_shm = None
+
+# the logistic loss of SGDClassifier is named 'log' before sklearn 1.1, which removes the name in 1.3
+_SKLEARN_VERSION = tuple(int(v) for v in re.match(r'(\d+)\.(\d+)', sklearn.__version__).groups())
+_LOG_LOSS = 'log_loss' if _SKLEARN_VERSION >= (1, 1) else 'log'
+
+
+def _attach(shm_name, shape):
+    global _features, _shm
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    _features = np.ndarray(shape, dtype=np.float32, buffer=_shm.buf)
+
+
+def _get_model(solver):
+    if solver == 'linearsvc':
+        return LinearSVC(dual=False, max_iter=10000)
+    elif solver == 'sgd':
+        return SGDClassifier(loss=_LOG_LOSS, max_iter=1000, tol=1e-4)
+    else:
+        raise NotImplementedError
+
+
+def _probe(task):
+    name, hitted, split_border, solver = task
+    features_train = _features[:split_border]
+    features_test = _features[split_border:]
+    hitted_train = hitted[:split_border]
+    hitted_test = hitted[split_border:]
+
+    start = time.time()
+    model = _get_model(solver)
+    model.fit(features_train, hitted_train)
+    prediction = model.predict(features_test)
+    fit_time = time.time() - start
+
+    cm = confusion_matrix(y_pred=prediction, y_true=hitted_test, labels=[0, 1])
+    accuracy = float(cm[1, 1] + cm[0, 0]) / float(cm.sum())
+    precision_pos = float(cm[1, 1]) / float(cm[1, 1] + cm[1, 0])
+    precision_neg = float(cm[0, 0]) / float(cm[0, 0] + cm[0, 1])
+
+    return {'name': name,
+            'accuracy': accuracy,
+            'worst_precision': min(precision_pos, precision_neg),
+            'confusion_matrix': cm.tolist(),
+            'fit_time': fit_time}
+
+
+def probe_attributes(features, tasks, split_border, solver='linearsvc', workers=0):
+    """features: standardized [N, D]; tasks: list of (name, hitted [N] of 0/1).
+    The first split_border samples are for fitting and the rest for testing.
+    Returns the results in the order of tasks."""
+    features = np.ascontiguousarray(features, dtype=np.float32)
+    if workers <= 0:
+        workers = os.cpu_count()
+
+    shm = shared_memory.SharedMemory(create=True, size=max(features.nbytes, 1))
+    try:
+        np.ndarray(features.shape, dtype=np.float32, buffer=shm.buf)[...] = features
+        tasks = [(name, np.asarray(hitted, dtype=np.int64), split_border, solver) for name, hitted in tasks]
+        with ProcessPoolExecutor(max_workers=min(workers, max(len(tasks), 1)),
+                                 initializer=_attach, initargs=(shm.name, features.shape)) as executor:
+            results = list(executor.map(_probe, tasks))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return results
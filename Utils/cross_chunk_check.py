@@ -0,0 +1,78 @@
+# encoding: utf-8
+import copy
+
+import torch
+
+from Agents.trainer import BraidCrossTrainer
+from Utils.data_parallel import DataParallel
+
+'''
+Agreement of the chunked comparison of the cross-mode pairs (opt.cross_chunk) with the unchunked one, both with
+the frozen BN statistics of the metric: the losses, and the gradients of the features and of the parameters,
+with and without a pair budget (opt.cross_pair_budget).
+run by: python -m Utils.cross_chunk_check braidmgn
+'''
+
+
+def _comparer(model, opt, pids):
+    """a BraidCrossTrainer reduced to the comparison of the features"""
+    trainer = BraidCrossTrainer.__new__(BraidCrossTrainer)
+    trainer.opt = copy.copy(opt)
+    trainer.model = model
+    trainer.device = pids.device
+    trainer.target = pids
+    trainer.metric_pairs = None
+    return trainer
+
+
+def _loss_and_grads(trainer, features, weights, chunk, budget):
+    trainer.opt.cross_chunk = chunk
+    trainer.opt.cross_pair_budget = budget
+    features = [f.detach().requires_grad_() for f in features]
+    trainer.model.zero_grad()
+    # the same random negatives within the budget
+    torch.manual_seed(0)
+    score_mat = trainer._compare_feature(features if len(features) > 1 else features[0])
+    loss = (score_mat * weights.view(weights.size() + (1, ) * (score_mat.dim() - 2))).sum()
+    loss.backward()
+    grads = [f.grad for f in features] + [p.grad.clone() for p in trainer.model.parameters() if p.grad is not None]
+    return loss.item(), grads
+
+
+def check_chunking(model, opt, ims, pids, chunk=7, budget=40):
+    model.train()
+    with torch.no_grad():
+        features = model(ims, mode='extract')
+    features = list(features) if isinstance(features, (list, tuple)) else [features]
+    trainer = _comparer(model, opt, pids)
+    n = ims.size(0)
+    pairs_num = n * (n + 1) // 2
+    weights = torch.randn(n, n, device=ims.device)
+
+    for pair_budget in (0, budget):
+        # a single chunk of all the pairs is the unchunked comparison
+        loss, grads = _loss_and_grads(trainer, features, weights, pairs_num, pair_budget)
+        chunked_loss, chunked_grads = _loss_and_grads(trainer, features, weights, chunk, pair_budget)
+        name = 'chunks of {0} pairs{1}'.format(chunk, ', budget of {0} pairs'.format(pair_budget)
+                                                if pair_budget > 0 else '')
+        assert abs(loss - chunked_loss) <= 1e-4 * max(abs(loss), 1.), 'the losses differ by {0}'.format(name)
+        assert len(grads) == len(chunked_grads), 'the parameters having gradients differ by {0}'.format(name)
+        for g, c in zip(grads, chunked_grads):
+            assert torch.allclose(g, c, rtol=1e-3, atol=1e-5), 'the gradients differ by {0}'.format(name)
+        print('{0}: the loss and the gradients agree with the unchunked comparison.'.format(name))
+
+
+if __name__ == '__main__':
+    # python -m Utils.cross_chunk_check braidmgn
+    import sys
+
+    from config import opt
+    from PrimaryObjectsFactory.model_with_optimizer_generator import get_model_with_optimizer
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    ims = torch.randn(12, 3, 256, 128, device=device)
+    pids = torch.arange(4, device=device).repeat_interleave(3)
+    for model_name in sys.argv[1:] or ['braidmgn']:
+        opt.model_name = model_name
+        net = DataParallel(get_model_with_optimizer(opt, naive=True)).to(device)
+        check_chunking(net, opt, ims, pids)
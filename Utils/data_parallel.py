@@ -6,6 +6,8 @@ from torch.nn.parallel.parallel_apply import parallel_apply
 from torch.nn.parallel.replicate import replicate
 from torch.nn.parallel.scatter_gather import scatter_kwargs, gather
 
+from SampleRateLearning.stable_batchnorm.global_variables import labeled_call, LabeledModule
+
 
 class DataParallel(Module):
 
@@ -33,12 +35,13 @@ class DataParallel(Module):
             self.module.cuda(device_ids[0])
 
     def forward(self, *inputs, **kwargs):
+        """the per-sample labels=... of the stable BN layers are scattered like the inputs"""
         if not self.device_ids:
-            return self.module(*inputs, **kwargs)
+            return labeled_call(self.module, *inputs, **kwargs)
         inputs, kwargs = self.scatter(inputs, kwargs, self.device_ids)
         if len(self.device_ids) == 1:
-            return self.module(*inputs[0], **kwargs[0])
-        replicas = self.replicate(self.module, self.device_ids[:len(inputs)])
+            return labeled_call(self.module, *inputs[0], **kwargs[0])
+        replicas = [LabeledModule(r) for r in self.replicate(self.module, self.device_ids[:len(inputs)])]
         outputs = self.parallel_apply(replicas, inputs, kwargs)
         return self.gather(outputs, self.output_device)
 
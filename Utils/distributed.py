@@ -0,0 +1,272 @@
+# encoding: utf-8
+import os
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+'''
+Multi-process training, one process per GPU (or per CPU with the gloo backend), launched by torchrun:
+    torchrun --nproc_per_node=4 main_reid.py train --distributed=True --gpus=[0,1,2,3] ...
+Each process sees only its own GPU, draws its share of every batch from the distributed samplers
+(which draw the same sequence on all the ranks from a shared seed), and the gradients are averaged by
+bucketed all-reduces after backward. DistributedDataParallel is not used, as its reducer does not allow
+the several forwards of one backward in phase-two training (the extraction, then the metric).
+In cross mode, the features of all the ranks are gathered differentiably, so that the score matrix and the loss
+are those of the whole batch, as in a single process.
+Only rank 0 prints, writes the summaries and saves the checkpoints.
+Check it locally by: torchrun --nproc_per_node=2 -m Utils.distributed
+'''
+
+BUCKET_SIZE = 25 * 1024 * 1024  # bytes per all-reduce
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend=None):
+    """the process group of torchrun (the env:// rendezvous), nccl on GPUs and gloo on CPUs by default"""
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl' and not torch.cuda.is_available():
+        raise ValueError('the nccl backend requires a GPU for every process, use gloo on CPUs')
+    dist.init_process_group(backend=backend)
+    print('process {0} of {1} ({2})'.format(get_rank(), get_world_size(), backend))
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def main_process_only(func):
+    """func is skipped on the ranks other than 0"""
+    def wrapper(*args, **kwargs):
+        if is_main_process():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _comm_device(tensor):
+    """nccl communicates CUDA tensors only"""
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda')
+    return tensor.device
+
+
+def all_reduce_sum(tensor):
+    """in place"""
+    if not is_distributed():
+        return tensor
+    device = _comm_device(tensor)
+    if device == tensor.device:
+        dist.all_reduce(tensor)
+    else:
+        reduced = tensor.to(device)
+        dist.all_reduce(reduced)
+        tensor.copy_(reduced)
+    return tensor
+
+
+def all_reduce_mean(tensor):
+    """in place"""
+    if not is_distributed():
+        return tensor
+    return all_reduce_sum(tensor).div_(get_world_size())
+
+
+def all_gather_cat(data, dim=0):
+    """the tensors (or nested lists/dicts of them) of all the ranks concatenated along dim in the order of the ranks,
+    their sizes along dim may differ"""
+    if not is_distributed():
+        return data
+    if isinstance(data, (list, tuple)):
+        return [all_gather_cat(d, dim) for d in data]
+    elif isinstance(data, dict):
+        return {k: all_gather_cat(v, dim) for k, v in data.items()}
+
+    device = _comm_device(data)
+    tensor = data.to(device).transpose(0, dim).contiguous()
+    size = torch.tensor([tensor.size(0)], device=device)
+    sizes = [torch.zeros_like(size) for _ in range(get_world_size())]
+    dist.all_gather(sizes, size)
+    sizes = [int(s.item()) for s in sizes]
+
+    padded = tensor.new_zeros((max(sizes), ) + tensor.size()[1:])
+    padded[:tensor.size(0)] = tensor
+    gathered = [torch.zeros_like(padded) for _ in sizes]
+    dist.all_gather(gathered, padded)
+    gathered = torch.cat([g[:s] for g, s in zip(gathered, sizes)], dim=0)
+    return gathered.transpose(0, dim).contiguous().to(data.device)
+
+
+class _AllGatherCat(torch.autograd.Function):
+    """all_gather_cat along dim 0, whose backward sums the gradients of the gathered tensor over the ranks
+    and keeps the rows of the rank, as each rank computes its own loss from the whole gathered tensor"""
+
+    @staticmethod
+    def forward(ctx, tensor):
+        sizes = all_gather_cat(torch.tensor([tensor.size(0)], device=tensor.device)).tolist()
+        ctx.start = sum(sizes[:get_rank()])
+        ctx.size = tensor.size(0)
+        return all_gather_cat(tensor)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = all_reduce_sum(grad.contiguous().clone())
+        return grad[ctx.start:ctx.start + ctx.size]
+
+
+def all_gather_cat_with_grad(data):
+    """all_gather_cat along dim 0 of the tensors (or lists of them) of the ranks, differentiable.
+    After average_gradients, the gradients are those of the mean of the losses of the ranks."""
+    if not is_distributed():
+        return data
+    if isinstance(data, (list, tuple)):
+        return [all_gather_cat_with_grad(d) for d in data]
+    return _AllGatherCat.apply(data)
+
+
+def all_gather_object(obj):
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def shard_range(num):
+    """[start, end) of the rank in num items split into contiguous shards"""
+    rank = get_rank()
+    world_size = get_world_size()
+    return num * rank // world_size, num * (rank + 1) // world_size
+
+
+def _broadcast(tensors):
+    if not is_distributed():
+        return
+    for tensor in tensors:
+        device = _comm_device(tensor)
+        if device == tensor.device:
+            dist.broadcast(tensor, 0)
+        else:
+            broadcast = tensor.to(device)
+            dist.broadcast(broadcast, 0)
+            tensor.data.copy_(broadcast)
+
+
+def broadcast_states(model):
+    """the parameters and the buffers of rank 0 to all the ranks"""
+    with torch.no_grad():
+        _broadcast(list(model.parameters()) + list(model.buffers()))
+
+
+def broadcast_buffers(model):
+    """the BN statistics of rank 0, e.g. before the evaluation, which is sharded among the ranks"""
+    with torch.no_grad():
+        _broadcast(list(model.buffers()))
+
+
+def _buckets(tensors, bucket_size):
+    buckets = {}
+    for t in tensors:
+        key = (t.device, t.dtype)
+        if key not in buckets or buckets[key][-1][1] + t.numel() * t.element_size() > bucket_size:
+            buckets.setdefault(key, []).append([[], 0])
+        bucket = buckets[key][-1]
+        bucket[0].append(t)
+        bucket[1] += t.numel() * t.element_size()
+    return [tensors for key_buckets in buckets.values() for tensors, _ in key_buckets]
+
+
+def average_gradients(model, bucket_size=BUCKET_SIZE):
+    """all-reduces the gradients by buckets of flattened tensors.
+    The ranks run the same code, so the parameters having gradients are the same on all of them."""
+    if not is_distributed():
+        return
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    for bucket in _buckets(grads, bucket_size):
+        flat = _flatten_dense_tensors(bucket)
+        all_reduce_mean(flat)
+        for g, f in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+            g.copy_(f)
+
+
+if __name__ == '__main__':
+    # torchrun --nproc_per_node=2 -m Utils.distributed
+    import numpy as np
+
+    from Dataset.samplers import PosNegPairSampler, DistributedPosNegPairSampler, RandomIdentityBatchSampler, \
+        DistributedRandomIdentityBatchSampler, ShuffleSampler, DistributedShuffleSampler
+
+    init_distributed('gloo')
+    rank = get_rank()
+    world_size = get_world_size()
+
+    # the averaged gradients of different batches equal the gradient of the whole batch
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU(), torch.nn.Linear(16, 1))
+    inputs = torch.randn(world_size * 4, 8)
+    model(inputs).mean().backward()
+    expected = [p.grad.clone() for p in model.parameters()]
+    model.zero_grad()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(rank)  # restored by the broadcast from rank 0
+    broadcast_states(model)
+    model(inputs[rank * 4:(rank + 1) * 4]).mean().backward()
+    average_gradients(model)
+    for p, e in zip(model.parameters(), expected):
+        assert torch.allclose(p.grad, e, atol=1e-6), 'the averaged gradients differ'
+
+    gathered = all_gather_cat(torch.full((rank + 1, 2), float(rank)))
+    assert gathered.size(0) == world_size * (world_size + 1) // 2
+
+    # a loss of the gathered outputs of all the ranks has the gradients of the whole batch in a single process
+    pair_loss = lambda outputs: (outputs @ outputs.t()).tanh().mean()
+    model.zero_grad()
+    pair_loss(model(inputs)).backward()
+    expected = [p.grad.clone() for p in model.parameters()]
+    model.zero_grad()
+    pair_loss(all_gather_cat_with_grad(model(inputs[rank * 4:(rank + 1) * 4]))).backward()
+    average_gradients(model)
+    for p, e in zip(model.parameters(), expected):
+        assert torch.allclose(p.grad, e, atol=1e-6), 'the gradients through the gathered outputs differ'
+
+    # the shares of the ranks make up the draws of a single process
+    data_source = [(None, i % 10, 0) for i in range(200)]
+    shares = all_gather_object(list(DistributedPosNegPairSampler(data_source, sample_num_per_epoch=64, seed=1)))
+    single = list(PosNegPairSampler(data_source, sample_num_per_epoch=64, seed=1))
+    assert [shares[i % world_size][i // world_size] for i in range(len(single))] == single
+
+    shares = all_gather_object([b for b, _, _ in DistributedRandomIdentityBatchSampler(data_source, 4, 2 * world_size,
+                                                                                      seed=1)])
+    single = [b for b, _, _ in RandomIdentityBatchSampler(data_source, 4, 2 * world_size, seed=1)]
+    for k, batch in enumerate(single):
+        assert sorted(batch) == sorted(np.concatenate([s[k] for s in shares]).tolist())
+
+    shares = all_gather_object(list(DistributedShuffleSampler(data_source, seed=1)))
+    single = list(ShuffleSampler(data_source, seed=1))
+    assert [shares[i % world_size][i // world_size] for i in range(len(shares[0]) * world_size)] == \
+        single[:len(shares[0]) * world_size]
+
+    if is_main_process():
+        print('the distributed helpers and samplers are consistent over {0} processes.'.format(world_size))
+    dist.destroy_process_group()
@@ -0,0 +1,122 @@
+# encoding: utf-8
+import os
+import time
+
+import numpy as np
+
+'''
+Features of a whole dataloader gathered into one array: the batches are copied into a preallocated buffer,
+the samples of id 0 are dropped by a mask, and the kept ones are shuffled by a single permutation gather.
+'''
+
+
+def _standardize(features, chunk_size=4096):
+    """in place, the same as sklearn.preprocessing.scale (zero mean, unit variance, constant columns kept at 0)"""
+    mean = np.zeros(features.shape[1])
+    square = np.zeros(features.shape[1])
+    for start in range(0, len(features), chunk_size):
+        chunk = features[start:start + chunk_size].astype(np.float64)
+        mean += chunk.sum(axis=0)
+        square += (chunk * chunk).sum(axis=0)
+    mean /= max(len(features), 1)
+    std = np.sqrt(np.maximum(square / max(len(features), 1) - mean * mean, 0.))
+    std[std == 0.] = 1.
+
+    for start in range(0, len(features), chunk_size):
+        features[start:start + chunk_size] = (features[start:start + chunk_size] - mean) / std
+
+
+def collect_features(extract, dataloader, sample_num, norm=True, sub_num=-1, memmap_path=None, chunk_size=4096):
+    """extract(data) -> [B, D] features of the batches (data, identity, _) of dataloader, which has sample_num samples.
+    Returns (features [n, D] float32, ids [n] of str, rows [n]), rows being the positions of the kept samples
+    in the dataloader. If memmap_path is given, the features are written to that .npy file and returned memory-mapped."""
+    buffer = None
+    identities = np.empty(sample_num, dtype=np.int64)
+    cur = 0
+    for data, identity, _ in dataloader:
+        features_ = np.asarray(extract(data), dtype=np.float32)
+        if buffer is None:
+            shape = (sample_num, features_.shape[1])
+            if memmap_path is None:
+                buffer = np.empty(shape, dtype=np.float32)
+            else:
+                buffer = np.lib.format.open_memmap(memmap_path + '.raw.npy', mode='w+', dtype=np.float32, shape=shape)
+        end = cur + len(features_)
+        buffer[cur:end] = features_
+        identities[cur:end] = np.asarray(identity)
+        cur = end
+
+    rows = np.flatnonzero(identities[:cur] != 0)
+    rows = np.random.permutation(rows)
+    if sub_num >= 0:
+        rows = rows[:sub_num]
+    ids = identities[rows].astype(np.str_).tolist()
+
+    if buffer is None:
+        return np.empty((0, 0), dtype=np.float32), ids, rows
+
+    if memmap_path is None:
+        features = buffer[rows]
+    else:
+        features = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=np.float32,
+                                             shape=(len(rows), buffer.shape[1]))
+        for start in range(0, len(rows), chunk_size):
+            # read the raw rows of a chunk in the file order
+            chunk = rows[start:start + chunk_size]
+            order = np.argsort(chunk)
+            features[start + order] = buffer[chunk[order]]
+        del buffer
+        os.remove(memmap_path + '.raw.npy')
+
+    if norm:
+        _standardize(features, chunk_size)
+
+    return features, ids, rows
+
+
+def _collect_features_lists(extract, dataloader, sub_num=-1):
+    """the former implementation through Python lists, for the benchmark"""
+    features = []
+    ids = []
+    for data, identity, _ in dataloader:
+        features_ = np.asarray(extract(data)).tolist()
+        ids_ = [str(i) for i in np.asarray(identity).tolist()]
+        for id_, feature_ in zip(ids_, features_):
+            if id_ == '0':
+                continue
+            features.append(feature_)
+            ids.append(id_)
+
+    indices = np.random.permutation(len(ids)).tolist()
+    if sub_num >= 0:
+        indices = indices[:sub_num]
+    features = np.array([features[i] for i in indices])
+    ids = [ids[i] for i in indices]
+    return features, ids
+
+
+if __name__ == '__main__':
+    # a synthetic loader of 2048-d features, of the size of Market-1501's test set
+    sample_num, dim, batch_size = 19732, 2048, 256
+    rng = np.random.RandomState(0)
+    features_all = rng.randn(sample_num, dim).astype(np.float32)
+    identities_all = rng.randint(0, 750, size=sample_num)
+    loader = [(features_all[s:s + batch_size], identities_all[s:s + batch_size], None)
+              for s in range(0, sample_num, batch_size)]
+
+    start = time.time()
+    features_old, ids_old = _collect_features_lists(lambda d: d, loader)
+    print('lists: {0:.2f}s'.format(time.time() - start))
+
+    start = time.time()
+    features_new, ids_new, _ = collect_features(lambda d: d, loader, sample_num, norm=False)
+    print('arrays: {0:.2f}s'.format(time.time() - start))
+
+    start = time.time()
+    features_map, _, _ = collect_features(lambda d: d, loader, sample_num, norm=False, memmap_path='features.npy')
+    print('arrays (memmap): {0:.2f}s'.format(time.time() - start))
+    del features_map
+    os.remove('features.npy')
+
+    assert features_old.shape == features_new.shape and len(ids_old) == len(ids_new)
+    assert sorted(ids_old) == sorted(ids_new)
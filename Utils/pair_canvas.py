@@ -0,0 +1,113 @@
+# encoding: utf-8
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+'''
+Figures of the pairs with the highest and lowest scores of each feature (see _Trainer.sort_pairs_by_scores).
+The pairs are selected by topk in the main process, and the figures are rendered by a pool of processes,
+each of which keeps the thumbnails it has already read.
+'''
+
+HEAD = 32
+WIDTH = 32
+HEIGHT = 64
+MARGIN = 10
+BLOCK = 36
+PAIRS_NUM = 16
+LEFT = (WIDTH + MARGIN) * 2 + BLOCK
+TOTAL_WIDTH = LEFT * 2
+TOTAL_HEIGHT = (HEIGHT + MARGIN) * PAIRS_NUM + HEAD
+
+FONT_PATH = 'utils/ubuntu-font-family-0.83/Ubuntu-B.ttf'
+GREEN = (0, 255, 0)
+RED = (255, 0, 0)
+
+
+def select_pairs(scores, num, largest=True, distinct=False, k=1024):
+    """flat indices of num pairs of scores ([N, N]) in descending (largest) or ascending order.
+    If distinct, a pair is skipped if one of its images is already selected or its score equals the last selected one.
+    Only the top-k scores are sorted, and k grows until enough pairs are found."""
+    n = scores.size(1)
+    scores = scores.reshape(-1)
+    total = scores.numel()
+    k = min(max(k, num), total)
+    while True:
+        values, indices = scores.topk(k, largest=largest, sorted=True)
+        if not distinct:
+            return indices[:num].tolist()
+
+        selected = []
+        used_indices = set()
+        pre_score = None
+        for s, index in zip(values.tolist(), indices.tolist()):
+            i, j = divmod(index, n)
+            if i in used_indices or j in used_indices or s == pre_score:
+                continue
+            pre_score = s
+            used_indices.add(i)
+            used_indices.add(j)
+            selected.append(index)
+            if len(selected) >= num:
+                return selected
+
+        if k == total:
+            return selected
+        k = min(k * 8, total)
+
+
+_ims_path = None
+_fonts = None
+_thumbnails = {}
+
+
+def _init_worker(ims_path):
+    global _ims_path, _fonts
+    _ims_path = ims_path
+    _fonts = (ImageFont.truetype(FONT_PATH, 10), ImageFont.truetype(FONT_PATH, 7), ImageFont.truetype(FONT_PATH, 9))
+
+
+def _thumbnail(i):
+    if i not in _thumbnails:
+        with Image.open(_ims_path[i]) as im:
+            _thumbnails[i] = im.convert('RGB').resize((WIDTH, HEIGHT))
+    return _thumbnails[i].copy()
+
+
+def _render(task):
+    """task: (weight, rows, save_path), rows: (x, y_row, i, j, score, (pa, qa, pb, qb), ties, color)"""
+    weight, rows, save_path = task
+    font1, font2, font3 = _fonts
+
+    canvas = Image.new('RGB', (TOTAL_WIDTH, TOTAL_HEIGHT))
+    draw = ImageDraw.Draw(canvas)
+    draw.text((10, 10), '{:.3f}'.format(weight), (255, 255, 255))
+
+    for x, row, i, j, s, (pa, qa, pb, qb), ties, color in rows:
+        top = HEAD + (HEIGHT + MARGIN) * row
+        im_i = _thumbnail(i)
+        im_j = _thumbnail(j)
+
+        draw_a = ImageDraw.Draw(im_i)
+        draw_b = ImageDraw.Draw(im_j)
+        draw_a.text((2, 10), '{:.3f}'.format(pa), color, font=font3)
+        draw_a.text((2, 40), '{:.3f}'.format(qa), color, font=font3)
+        draw_b.text((2, 10), '{:.3f}'.format(pb), color, font=font3)
+        draw_b.text((2, 40), '{:.3f}'.format(qb), color, font=font3)
+
+        canvas.paste(im_i, (x, top))
+        canvas.paste(im_j, (x + WIDTH + MARGIN, top))
+        draw.text((x + (WIDTH + MARGIN) * 2, top), '{:.3f}'.format(s), color, font=font1)
+        draw.text((x, top + HEIGHT + 1), ties, color, font=font2)
+
+    canvas.save(save_path, 'PNG')
+    return save_path
+
+
+def render_pair_canvases(tasks, ims_path, workers=0):
+    if workers <= 0:
+        workers = os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(ims_path,)) as executor:
+        for k, save_path in enumerate(executor.map(_render, tasks)):
+            print('{0}/{1}'.format(k + 1, len(tasks)))
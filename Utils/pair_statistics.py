@@ -0,0 +1,82 @@
+# encoding: utf-8
+import numpy as np
+
+'''
+Streaming statistics of pair scores grouped by the attribute classes ("words") of the two images.
+Scores are fed tile by tile as the lower triangle of the symmetric score matrix, so the memory is O(tile + N * words)
+instead of O(N^2): for every image i and word w, the counts, sums and sums of squares of the scores of i with the
+images having w are accumulated by bincount, separately for positive (same id) and negative pairs;
+the statistics of a pair of words (w1, w2) are then the sums over the images having w1.
+'''
+
+
+class AttributePairStatistics(object):
+    def __init__(self, ids, attributes):
+        """ids: [N] identities; attributes: {key: [N] class labels}"""
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.num = len(self.ids)
+
+        self.keys = []
+        memberships = []
+        self.word_num = 0
+        for key, labels in attributes.items():
+            classes, inverse = np.unique(np.asarray(labels), return_inverse=True)
+            self.keys.append((key, classes.tolist()))
+            memberships.append(inverse + self.word_num)
+            self.word_num += len(classes)
+        # the global word indices of every image, one per attribute key: [N, K]
+        self.memberships = np.stack(memberships, axis=1)
+
+        shape = (2, self.num, self.word_num)  # neg / pos
+        self.counts = np.zeros(shape)
+        self.sums = np.zeros(shape)
+        self.squares = np.zeros(shape)
+
+    def update(self, i, j, scores):
+        """i, j, scores: [P] pairs of the lower triangle (i >= j), each one standing for (i, j) and (j, i)"""
+        scores = np.asarray(scores, dtype=np.float64)
+        off_diagonal = i != j
+        rows = np.concatenate((i, j[off_diagonal]))
+        cols = np.concatenate((j, i[off_diagonal]))
+        scores = np.concatenate((scores, scores[off_diagonal]))
+        squares = scores * scores
+
+        is_pos = (self.ids[rows] == self.ids[cols]).astype(np.int64)
+        base = (is_pos * self.num + rows) * self.word_num
+        size = self.counts.size
+        for k in range(self.memberships.shape[1]):
+            index = base + self.memberships[cols, k]
+            self.counts += np.bincount(index, minlength=size).reshape(self.counts.shape)
+            self.sums += np.bincount(index, weights=scores, minlength=size).reshape(self.sums.shape)
+            self.squares += np.bincount(index, weights=squares, minlength=size).reshape(self.squares.shape)
+
+    def _per_word_pair(self, stats):
+        """[N, W] per image -> [W, W] per word pair, summed over the images having the first word"""
+        one_hot = np.zeros((self.num, self.word_num))
+        for k in range(self.memberships.shape[1]):
+            one_hot[np.arange(self.num), self.memberships[:, k]] = 1.
+        return one_hot.T.dot(stats)
+
+    def effects(self):
+        """the standardized mean scores of the positive and negative pairs of every word pair,
+        shrunk by num / (num + 1): (pos_effects, neg_effects), both [W, W]"""
+        # every image has exactly one word of the first attribute key, so its words cover all the pairs
+        key_0 = len(self.keys[0][1])
+        word_nums = np.bincount(self.memberships.ravel(), minlength=self.word_num)
+
+        effects = []
+        for label in (1, 0):
+            total_count = self.counts[label][:, :key_0].sum()
+            total_sum = self.sums[label][:, :key_0].sum()
+            total_square = self.squares[label][:, :key_0].sum()
+            mean = total_sum / total_count
+            std = np.sqrt(max(total_square / total_count - mean * mean, 0.))
+
+            counts = self._per_word_pair(self.counts[label])
+            sums = self._per_word_pair(self.sums[label])
+            num = np.minimum(word_nums[:, None], counts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                effect = (sums / counts - mean) / std * num / (num + 1)
+            effects.append(np.where(num > 0, effect, 0.))
+
+        return effects[0], effects[1]
@@ -0,0 +1,114 @@
+# encoding: utf-8
+import queue
+import threading
+
+import torch
+from torch import Tensor
+
+'''overlap fetching and host-to-device copying of the next batch with the computation of the current one'''
+
+
+def _on_device(data, device):
+    """device may lack an index, e.g. cuda for the current gpu"""
+    return data.device.type == device.type and (device.index is None or data.device.index == device.index)
+
+
+def _to_device(data, device, pin):
+    """only the cpu tensors are pinned and copied asynchronously, those already on a gpu (e.g. the preloaded SRL
+    images, moved by their transform) are moved synchronously, or left as they are if already on device"""
+    if isinstance(data, Tensor):
+        if _on_device(data, device):
+            return data
+        if data.device.type != 'cpu':
+            return data.to(device)
+        if pin and not data.is_pinned():
+            data = data.pin_memory()
+        return data.to(device, non_blocking=pin)
+    elif isinstance(data, (list, tuple)):
+        return [_to_device(d, device, pin) for d in data]
+    elif isinstance(data, dict):
+        return {k: _to_device(v, device, pin) for k, v in data.items()}
+    else:
+        return data
+
+
+def _record_stream(data, stream):
+    if isinstance(data, Tensor):
+        data.record_stream(stream)
+    elif isinstance(data, (list, tuple)):
+        for d in data:
+            _record_stream(d, stream)
+    elif isinstance(data, dict):
+        for v in data.values():
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher(object):
+    """Wraps a DataLoader and yields its batches already on device.
+    On CUDA, the cpu tensors of the next batch are pinned and copied on a side stream while the current step runs;
+    otherwise, a background thread fetches and moves up to `depth` batches ahead.
+    Other attributes (dataset, sampler, batch_sampler, ...) are those of the wrapped loader."""
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, item):
+        if item == 'loader':
+            raise AttributeError(item)
+        return getattr(self.loader, item)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return _to_device(batch, self.device, pin=True)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            _record_stream(batch, current_stream)
+            next_batch = preload()
+            yield batch
+
+    def _thread_iter(self):
+        buffer = queue.Queue(maxsize=self.depth)
+        end = object()
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    buffer.put(_to_device(batch, self.device, pin=False))
+                buffer.put(end)
+            except Exception as e:
+                buffer.put(e)
+
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+
+        while True:
+            batch = buffer.get()
+            if batch is end:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+        worker.join()
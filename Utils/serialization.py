@@ -1,15 +1,19 @@
 # encoding: utf-8
 import os
 import os.path as osp
+import random
 import re
 import sys
 
 import numpy as np
 import torch
 
+from Utils.distributed import main_process_only
+
 PREFIX_MODEL = 'model_checkpoint'
 PREFIX_OPTIMIZER = 'optimizer_checkpoint'
 BEST_MODEL_NAME = 'model_best.pth.tar'
+STEP_CHECKPOINT_NAME = 'step_checkpoint.pth.tar'
 CHECKPOINT_DIR = 'checkpoints'
 
 
@@ -52,6 +56,7 @@ class Logger(object):
             self.file.close()
 
 
+@main_process_only
 def save_checkpoint(state, exp_dir, epoch, prefix: str, eval_step=10):
     save_dir = osp.join(exp_dir, CHECKPOINT_DIR)
     os.makedirs(save_dir, exist_ok=True)
@@ -67,6 +72,7 @@ def save_checkpoint(state, exp_dir, epoch, prefix: str, eval_step=10):
     torch.save(state, fpath)
 
 
+@main_process_only
 def save_current_status(model, optimizer, exp_dir, epoch, eval_step):
     model_state_dict = model.module.state_dict()
     optimizer_state_dict = optimizer.state_dict()
@@ -80,6 +86,48 @@ def save_current_status(model, optimizer, exp_dir, epoch, eval_step):
                     prefix=PREFIX_OPTIMIZER, eval_step=eval_step)
 
 
+def get_rng_states():
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            'numpy': np.random.get_state(),
+            'random': random.getstate()}
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    if states['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['random'])
+
+
+@main_process_only
+def save_step_status(model, optimizer, exp_dir, epoch, step, **extra_states):
+    """a checkpoint in the middle of epoch, after step batches of it.
+    extra_states: e.g. the states of the sampler, the SRL criterion and the RNGs"""
+    save_dir = osp.join(exp_dir, CHECKPOINT_DIR)
+    os.makedirs(save_dir, exist_ok=True)
+    fpath = osp.join(save_dir, STEP_CHECKPOINT_NAME)
+
+    state = {'model': model.module.state_dict(),
+             'optimizer': optimizer.state_dict(),
+             'epoch': epoch,
+             'step': step}
+    state.update(extra_states)
+
+    # written aside first, so that a preemption during saving leaves the previous checkpoint intact
+    torch.save(state, fpath + '.tmp')
+    os.replace(fpath + '.tmp', fpath)
+
+
+@main_process_only
+def remove_step_status(exp_dir):
+    fpath = osp.join(exp_dir, CHECKPOINT_DIR, STEP_CHECKPOINT_NAME)
+    if os.path.exists(fpath):
+        os.remove(fpath)
+
+
+@main_process_only
 def save_best_model(model, exp_dir, epoch, rank1):
     save_dir = osp.join(exp_dir, CHECKPOINT_DIR)
     os.makedirs(save_dir, exist_ok=True)
@@ -114,6 +162,8 @@ def parse_checkpoints(exp_dir):
     files = [f for f in files if '.pth.tar' in f]
     if BEST_MODEL_NAME in files:
         files.remove(BEST_MODEL_NAME)
+    if STEP_CHECKPOINT_NAME in files:
+        files.remove(STEP_CHECKPOINT_NAME)
     pattern = re.compile(r'(?<=^{0}_ep)\d+'.format(PREFIX_MODEL))  # look for numbers
     epochs = [pattern.findall(f) for f in files]
     epochs = [int(e[0]) for e in epochs if len(e) > 0]
@@ -141,6 +191,17 @@ def parse_checkpoints(exp_dir):
         if os.path.exists(optimizer_state_dict_path):
             optimizer_state_dict = torch.load(optimizer_state_dict_path)['state_dict']
 
-    return start_epoch, state_dict, best_epoch, best_rank1, optimizer_state_dict
+    # a step checkpoint in the epoch after the last finished one resumes that epoch at its exact iteration
+    step_state = None
+    step_file_path = osp.join(load_dir, STEP_CHECKPOINT_NAME)
+    if os.path.exists(step_file_path):
+        step_state = torch.load(step_file_path)
+        if step_state['epoch'] == start_epoch + 1:
+            state_dict = step_state.pop('model')
+            optimizer_state_dict = step_state.pop('optimizer')
+        else:
+            step_state = None
+
+    return start_epoch, state_dict, best_epoch, best_rank1, optimizer_state_dict, step_state
 
 
@@ -9,6 +9,7 @@ import numpy as np
 import torch
 
 from config import opt
+from Utils.distributed import init_distributed, get_local_rank, get_rank, is_main_process
 from Utils.serialization import Logger
 
 
@@ -22,15 +23,27 @@ def _random_seed(seed):
 
 def prepare_running(**kwargs):
     opt.parse_(kwargs)
-    os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([str(i) for i in opt.gpus])
-
-    if not torch.cuda.is_available():
+    if opt.distributed:
+        # every process sees its own gpu only (none when there are more processes than gpus, e.g. on cpus)
+        local_rank = get_local_rank()
+        gpus = opt.gpus[local_rank:local_rank + 1]
+    else:
+        gpus = opt.gpus
+    os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([str(i) for i in gpus])
+
+    if opt.distributed:
+        init_distributed(opt.dist_backend)
+    elif not torch.cuda.is_available():
         raise NotImplementedError('This project must be implemented with CUDA!')
 
-    sys.stdout = Logger(os.path.join(opt.exp_dir, 'log_train.txt'))
+    if is_main_process():
+        sys.stdout = Logger(os.path.join(opt.exp_dir, 'log_train.txt'))
+    else:
+        sys.stdout = open(os.devnull, 'w')
     print('current commit hash: {}'.format(subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()))
     opt.print_()
-    _random_seed(opt.seed)
+    # the ranks differ in augmentation and dropout, the model is broadcast from rank 0 and the samplers share opt.seed
+    _random_seed(opt.seed + get_rank())
     torch.backends.cudnn.benchmark = True
 
     torch.autograd.set_detect_anomaly(True)
@@ -11,10 +11,24 @@ from tensorboardX import SummaryWriter
 import torch
 from os.path import join as pjoin
 from SampleRateLearning.loss import SRL_BCELoss
+from Utils.distributed import is_main_process
+
+
+class _NullWriter(object):
+    """for the processes other than 0 in the distributed training"""
+
+    def __getattr__(self, item):
+        return lambda *args, **kwargs: None
 
 
 class SummaryWriters(object):
     def __init__(self, opt):
+        self.enabled = is_main_process()
+        if not self.enabled:
+            self.summary_writer = self.max_summary_writer = self.min_summary_writer = self.avg_summary_writer = \
+                self.pos_summary_writer = self.neg_summary_writer = _NullWriter()
+            return
+
         self.summary_writer = SummaryWriter(pjoin(opt.exp_dir, 'tensorboard_log/common'))
         self.max_summary_writer = SummaryWriter(pjoin(opt.exp_dir, 'tensorboard_log/max'))
         self.min_summary_writer = SummaryWriter(pjoin(opt.exp_dir, 'tensorboard_log/min'))
@@ -24,6 +38,9 @@ class SummaryWriters(object):
             self.neg_summary_writer = SummaryWriter(pjoin(opt.exp_dir, 'tensorboard_log/neg'))
 
     def record(self, model, criterion, optimizer, loss=None, global_step=0):
+        if not self.enabled:
+            return
+
         cur_lr = optimizer.param_groups[0]['lr']
         self.summary_writer.add_scalar('lr', cur_lr, global_step)
 
@@ -97,8 +97,9 @@ def tensor_cpu(data):
 
 
 def tensor_cuda(data):
+    """on the (current) gpu, or left on the cpu if there is none"""
     if isinstance(data, Tensor):
-        return data.cuda()
+        return data.cuda() if torch.cuda.is_available() else data
     elif isinstance(data, (list, tuple)):
         return [tensor_cuda(d) for d in data]
     elif isinstance(data, dict):
@@ -118,6 +119,17 @@ def tensor_float(data):
         raise TypeError('type {0} is not supported'.format(type(data)))
 
 
+def tensor_detach(data):
+    if isinstance(data, Tensor):
+        return data.detach()
+    elif isinstance(data, (list, tuple)):
+        return [tensor_detach(d) for d in data]
+    elif isinstance(data, dict):
+        return {k: tensor_detach(v) for k, v in data.items()}
+    else:
+        raise TypeError('type {0} is not supported'.format(type(data)))
+
+
 def tensor_repeat(data, dim, num, interleave=False):
     if isinstance(data, Tensor):
         if not interleave:
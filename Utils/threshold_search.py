@@ -0,0 +1,85 @@
+# encoding: utf-8
+import numpy as np
+
+'''
+1-D linear classifiers (thresholds) for every feature column at once.
+A linear classifier of a scalar feature is a threshold t and a direction, i.e. positive iff x > t (or x < t).
+The score of a classifier is its worst per-class recall, min(TP / P, TN / N),
+which is what check_element_discriminant_best reports as "the worst precision".
+'''
+
+
+def worst_class_recall(features, hitted, thresholds, directions):
+    """features: [n, F], hitted: [n] of 0/1, thresholds & directions (+1/-1): [F] -> scores: [F]"""
+    hitted = np.asarray(hitted).astype(bool)
+    pos_num = hitted.sum()
+    neg_num = len(hitted) - pos_num
+
+    predictions = (features - thresholds[None, :]) * directions[None, :] > 0
+    tp = predictions[hitted].sum(axis=0)
+    tn = (~predictions[~hitted]).sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.minimum(tp / float(pos_num), tn / float(neg_num))
+
+
+class ThresholdSearch(object):
+    """Sorts the training features once; fit() then finds, for every feature,
+    the threshold and direction maximizing the worst class recall on them, by cumulative sums over the sorted columns.
+    Columns are processed by chunk_size at a time to bound the memory."""
+
+    def __init__(self, features, chunk_size=256):
+        self.features = np.asarray(features)
+        self.order = np.argsort(self.features, axis=0, kind='stable')
+        self.sorted = np.take_along_axis(self.features, self.order, axis=0)
+        self.chunk_size = chunk_size
+
+        n = self.sorted.shape[0]
+        # a threshold can only be placed between two different values
+        self.splittable = np.ones((n + 1, self.sorted.shape[1]), dtype=bool)
+        self.splittable[1:n] = self.sorted[1:] > self.sorted[:-1]
+
+    def fit(self, hitted):
+        hitted = np.asarray(hitted).astype(np.int64)
+        n, feature_num = self.sorted.shape
+        pos_num = float(hitted.sum())
+        neg_num = float(n - pos_num)
+
+        thresholds = np.empty(feature_num)
+        directions = np.empty(feature_num)
+        j = np.arange(n + 1)[:, None]
+        for start in range(0, feature_num, self.chunk_size):
+            end = min(start + self.chunk_size, feature_num)
+            hitted_sorted = hitted[self.order[:, start:end]]
+
+            # positives among the first j samples of each sorted column
+            cum_pos = np.zeros((n + 1, end - start))
+            np.cumsum(hitted_sorted, axis=0, out=cum_pos[1:])
+            cum_neg = j - cum_pos
+
+            # direction +1: the samples from j on are predicted positive; -1: the first j samples are
+            scores_up = np.minimum((pos_num - cum_pos) / pos_num, cum_neg / neg_num)
+            scores_down = np.minimum(cum_pos / pos_num, (neg_num - cum_neg) / neg_num)
+
+            splittable = self.splittable[:, start:end]
+            scores_up[~splittable] = -1.
+            scores_down[~splittable] = -1.
+
+            best_up = scores_up.argmax(axis=0)
+            best_down = scores_down.argmax(axis=0)
+            cols = np.arange(end - start)
+            up = scores_up[best_up, cols] >= scores_down[best_down, cols]
+            best = np.where(up, best_up, best_down)
+
+            thresholds[start:end] = self._threshold(best, start, end)
+            directions[start:end] = np.where(up, 1., -1.)
+
+        return thresholds, directions
+
+    def _threshold(self, splits, start, end):
+        """midpoints between the sorted values before and after the splits"""
+        n = self.sorted.shape[0]
+        cols = np.arange(start, end)
+        lower = np.where(splits > 0, self.sorted[np.maximum(splits - 1, 0), cols], -np.inf)
+        upper = np.where(splits < n, self.sorted[np.minimum(splits, n - 1), cols], np.inf)
+        return np.where(np.isinf(lower), upper - 1., np.where(np.isinf(upper), lower + 1., (lower + upper) / 2.))
@@ -1,7 +1,66 @@
 import math
 import torch
 from torch.optim.optimizer import Optimizer
-from .Centralization import centralized_gradient
+from .Centralization import centralized_gradient, centralized_gradients
+from .MultiTensor import params_with_grad, by_step, foreach_copy_, use_foreach
+
+
+def _adam_foreach(optimizer, group, name, decoupled_weight_decay=False):
+    """the step of the loops of Adam (or AdamW) on the params of group, by multi-tensor ops"""
+    params = params_with_grad(group, name)
+    if len(params) == 0:
+        return
+    amsgrad = group['amsgrad']
+    beta1, beta2 = group['betas']
+    if decoupled_weight_decay:
+        # Perform weight decay step
+        torch._foreach_mul_(params, 1 - group['lr'] * group['weight_decay'])
+
+    for p in params:
+        state = optimizer.state[p]
+        # State initialization
+        if len(state) == 0:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            if amsgrad:
+                state['max_exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+        state['step'] += 1
+
+    for step, step_params in by_step(params, optimizer.state):
+        states = [optimizer.state[p] for p in step_params]
+        exp_avgs = [state['exp_avg'] for state in states]
+        exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2 = 1 - beta2 ** step
+
+        grads = [p.grad for p in step_params]
+        if not decoupled_weight_decay and group['weight_decay'] != 0:
+            grads = torch._foreach_add(grads, step_params, alpha=group['weight_decay'])
+        if optimizer.gc_loc:
+            centralized_gradients(grads, use_gc=optimizer.use_gc, gc_conv_only=optimizer.gc_conv_only)
+
+        # Decay the first and second moment running average coefficient
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        if amsgrad:
+            max_exp_avg_sqs = [state['max_exp_avg_sq'] for state in states]
+            foreach_copy_(max_exp_avg_sqs, torch._foreach_maximum(max_exp_avg_sqs, exp_avg_sqs))
+            denom = torch._foreach_sqrt(max_exp_avg_sqs)
+        else:
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_div_(denom, math.sqrt(bias_correction2))
+        torch._foreach_add_(denom, group['eps'])
+
+        step_size = group['lr'] / bias_correction1
+        #GC operation
+        G_grad = torch._foreach_div(exp_avgs, denom)
+        if not optimizer.gc_loc:
+            centralized_gradients(G_grad, use_gc=optimizer.use_gc, gc_conv_only=optimizer.gc_conv_only)
+
+        torch._foreach_add_(step_params, G_grad, alpha=-step_size)
 
 
 class Adam(Optimizer):
@@ -21,6 +80,8 @@ class Adam(Optimizer):
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
             (default: False)
+        foreach (bool, optional): updates each group by multi-tensor ops rather than
+            a loop over its parameters, None for the groups of CUDA params only (default: None)
 
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
@@ -29,7 +90,7 @@ class Adam(Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False,use_gc=False, gc_conv_only=False,gc_loc=False):
+                 weight_decay=0, amsgrad=False,use_gc=False, gc_conv_only=False,gc_loc=False, foreach=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -43,6 +104,7 @@ class Adam(Optimizer):
         defaults = dict(lr=lr, betas=betas, eps=eps,
                         weight_decay=weight_decay, amsgrad=amsgrad)
         super(Adam, self).__init__(params, defaults)
+        self.foreach = foreach
         self.gc_loc=gc_loc
         self.use_gc=use_gc
         self.gc_conv_only=gc_conv_only
@@ -66,6 +128,9 @@ class Adam(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
+            if use_foreach(self.foreach, group):
+                _adam_foreach(self, group, 'Adam')
+                continue
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -141,6 +206,8 @@ class AdamW(Optimizer):
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
             (default: False)
+        foreach (bool, optional): updates each group by multi-tensor ops rather than
+            a loop over its parameters, None for the groups of CUDA params only (default: None)
 
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
@@ -151,7 +218,7 @@ class AdamW(Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=1e-2, amsgrad=False,use_gc=False, gc_conv_only=False,gc_loc=True):
+                 weight_decay=1e-2, amsgrad=False,use_gc=False, gc_conv_only=False,gc_loc=True, foreach=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -165,6 +232,7 @@ class AdamW(Optimizer):
         defaults = dict(lr=lr, betas=betas, eps=eps,
                         weight_decay=weight_decay, amsgrad=amsgrad)
         super(AdamW, self).__init__(params, defaults)
+        self.foreach = foreach
         self.gc_loc=gc_loc
         self.use_gc=use_gc
         self.gc_conv_only=gc_conv_only
@@ -188,6 +256,9 @@ class AdamW(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
+            if use_foreach(self.foreach, group):
+                _adam_foreach(self, group, 'AdamW', decoupled_weight_decay=True)
+                continue
             for p in group['params']:
                 if p.grad is None:
                     continue
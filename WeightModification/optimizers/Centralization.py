@@ -13,3 +13,15 @@ def centralized_gradient(x,use_gc=True,gc_conv_only=False):
             x.add_(-x.mean(dim = tuple(range(1,len(list(x.size())))), keepdim = True))
     return x                   
 
+
+def centralized_gradients(xs, use_gc=True, gc_conv_only=False):
+    """in place, centralized_gradient of each of xs, the means subtracted by one multi-tensor op.
+    The means are reduced tensor by tensor, as stacking the same-shaped ones would copy them all."""
+    if not use_gc:
+        return xs
+    min_dim = 3 if gc_conv_only else 1
+    centered = [x for x in xs if x.dim() > min_dim]
+    if len(centered) > 0:
+        means = [x.mean(dim=tuple(range(1, x.dim())), keepdim=True) for x in centered]
+        torch._foreach_sub_(centered, means)
+    return xs
@@ -4,9 +4,12 @@ from torch.optim import Optimizer
 import torch
 import warnings
 
+from .MultiTensor import foreach_copy_, use_foreach
+
 class Lookahead(Optimizer):
-    def __init__(self, optimizer, k=5, alpha=0.5):
+    def __init__(self, optimizer, k=5, alpha=0.5, foreach=None):
         self.optimizer = optimizer
+        self.foreach = foreach
         self.k = k
         self.alpha = alpha
         self.param_groups = self.optimizer.param_groups
@@ -16,6 +19,9 @@ class Lookahead(Optimizer):
             group["counter"] = 0
     
     def update(self, group):
+        if use_foreach(self.foreach, group):
+            self._update_foreach(group)
+            return
         for fast in group["params"]:
             param_state = self.state[fast]
             if "slow_param" not in param_state:
@@ -24,6 +30,21 @@ class Lookahead(Optimizer):
             slow = param_state["slow_param"]
             slow += (fast.data - slow) * self.alpha
             fast.data.copy_(slow)
+
+    def _update_foreach(self, group):
+        fasts = [fast.data for fast in group["params"]]
+        if len(fasts) == 0:
+            return
+        for fast in group["params"]:
+            param_state = self.state[fast]
+            if "slow_param" not in param_state:
+                param_state["slow_param"] = torch.zeros_like(fast.data)
+                param_state["slow_param"].copy_(fast.data)
+        slows = [self.state[fast]["slow_param"] for fast in group["params"]]
+        diffs = torch._foreach_sub(fasts, slows)
+        torch._foreach_mul_(diffs, self.alpha)
+        torch._foreach_add_(slows, diffs)
+        foreach_copy_(fasts, slows)
     
     def update_lookahead(self):
         for group in self.param_groups:
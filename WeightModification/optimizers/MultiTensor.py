@@ -0,0 +1,88 @@
+# encoding: utf-8
+from collections import OrderedDict
+
+import torch
+
+from .Centralization import centralized_gradients
+
+'''
+Helpers of the multi-tensor (torch._foreach_*) steps of the optimizers, which update all the parameters of a group
+by a few kernels instead of a Python loop over them. The states keep the per-parameter layout of the loops,
+so the state_dicts of either are interchangeable.
+'''
+
+
+def use_foreach(foreach, group):
+    """foreach if given, otherwise whether all the params of the group are CUDA tensors, as torch.optim decides:
+    on CPU the multi-tensor ops are a loop of their own, slower than that of the optimizers"""
+    if foreach is not None:
+        return foreach
+    return all(p.is_cuda for p in group['params'])
+
+
+def params_with_grad(group, name):
+    params = [p for p in group['params'] if p.grad is not None]
+    for p in params:
+        if p.grad.is_sparse:
+            raise RuntimeError('{0} does not support sparse gradients'.format(name))
+    return params
+
+
+def by_step(params, state):
+    """(step, params) of the params split by the steps of their states, as the bias corrections depend on it.
+    There is one split but for the params added or left without gradients along the way."""
+    steps = OrderedDict()
+    for p in params:
+        steps.setdefault(state[p]['step'], []).append(p)
+    return steps.items()
+
+
+def foreach_copy_(dst, src):
+    """in place, dst[i].copy_(src[i]) of each i"""
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst, src)
+    else:
+        torch._foreach_zero_(dst)
+        torch._foreach_add_(dst, src)
+
+
+def fp32_moments(optimizer, group, name, init_state=None):
+    """the moving averages of the loops of the RAdam variants (in float32, with the GC of gc_loc) updated by
+    multi-tensor ops, yielding (step, params, fp32 params, exp_avgs, exp_avg_sqs) of the params split by their steps.
+    init_state(p, state) adds the entries of the variant to the new states."""
+    params = params_with_grad(group, name)
+    for p in params:
+        state = optimizer.state[p]
+        if len(state) == 0:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(p.data, dtype=torch.float)
+            state['exp_avg_sq'] = torch.zeros_like(p.data, dtype=torch.float)
+            if init_state is not None:
+                init_state(p, state)
+        else:
+            state['exp_avg'] = state['exp_avg'].float()
+            state['exp_avg_sq'] = state['exp_avg_sq'].float()
+        state['step'] += 1
+
+    beta1, beta2 = group['betas']
+    for step, step_params in by_step(params, optimizer.state):
+        states = [optimizer.state[p] for p in step_params]
+        exp_avgs = [state['exp_avg'] for state in states]
+        exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+        grads = [p.grad.data.float() for p in step_params]
+        if optimizer.gc_loc:
+            centralized_gradients(grads, use_gc=optimizer.use_gc, gc_conv_only=optimizer.gc_conv_only)
+
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        yield step, step_params, [p.data.float() for p in step_params], exp_avgs, exp_avg_sqs
+
+
+def update_fp32(params, params_fp32, updates, alpha):
+    """in place, params_fp32 += alpha * updates, copied to the params which are not float32 themselves"""
+    torch._foreach_add_(params_fp32, updates, alpha=alpha)
+    copies = [(p.data, p_fp32) for p, p_fp32 in zip(params, params_fp32) if p.dtype != p_fp32.dtype]
+    if len(copies) > 0:
+        foreach_copy_([p for p, _ in copies], [p_fp32 for _, p_fp32 in copies])
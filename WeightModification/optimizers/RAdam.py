@@ -1,12 +1,14 @@
 import math
 import torch
 from torch.optim.optimizer import Optimizer
-from .Centralization import centralized_gradient
+from .Centralization import centralized_gradient, centralized_gradients
+from .MultiTensor import fp32_moments, update_fp32, use_foreach
 
 
 class RAdam(Optimizer):
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, degenerated_to_sgd=True,use_gc=False, gc_conv_only=False,gc_loc=False):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, degenerated_to_sgd=True,use_gc=False, gc_conv_only=False,gc_loc=False,
+                 foreach=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -17,6 +19,7 @@ class RAdam(Optimizer):
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
 
         self.degenerated_to_sgd = degenerated_to_sgd
+        self.foreach = foreach
         self.gc_loc=gc_loc
         self.use_gc=use_gc
         self.gc_conv_only=gc_conv_only
@@ -39,6 +42,9 @@ class RAdam(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            if use_foreach(self.foreach, group):
+                self._step_foreach(group)
+                continue
 
             for p in group['params']:
                 if p.grad is None:
@@ -106,9 +112,51 @@ class RAdam(Optimizer):
                 p.data.copy_(p_data_fp32)
         return loss
 
+    def _step_foreach(self, group):
+        beta1, beta2 = group['betas']
+        for step, params, params_fp32, exp_avgs, exp_avg_sqs in fp32_moments(self, group, 'RAdam'):
+            buffered = group['buffer'][int(step % 10)]
+            if step == buffered[0]:
+                N_sma, step_size = buffered[1], buffered[2]
+            else:
+                buffered[0] = step
+                beta2_t = beta2 ** step
+                N_sma_max = 2 / (1 - beta2) - 1
+                N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+                buffered[1] = N_sma
+
+                # more conservative since it's an approximated value
+                if N_sma >= 5:
+                    step_size = math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma
+                                          * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+                elif self.degenerated_to_sgd:
+                    step_size = 1.0 / (1 - beta1 ** step)
+                else:
+                    step_size = -1
+                buffered[2] = step_size
+
+            if N_sma >= 5:
+                denom = torch._foreach_sqrt(exp_avg_sqs)
+                torch._foreach_add_(denom, group['eps'])
+                G_grad = torch._foreach_div(exp_avgs, denom)
+            elif step_size > 0:
+                # the moving averages themselves, modified in place below as by the loop
+                G_grad = exp_avgs
+            else:
+                # no update, G_grad being undefined in the loop
+                continue
+
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(G_grad, params_fp32, alpha=group['weight_decay'])
+            #GC operation
+            if self.gc_loc == False:
+                centralized_gradients(G_grad, use_gc=self.use_gc, gc_conv_only=self.gc_conv_only)
+            update_fp32(params, params_fp32, G_grad, -step_size * group['lr'])
+
 class PlainRAdam(Optimizer):
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, degenerated_to_sgd=True,use_gc=False, gc_conv_only=False,gc_loc=False):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, degenerated_to_sgd=True,use_gc=False, gc_conv_only=False,gc_loc=False,
+                 foreach=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -119,6 +167,7 @@ class PlainRAdam(Optimizer):
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
                     
         self.degenerated_to_sgd = degenerated_to_sgd
+        self.foreach = foreach
         self.gc_loc=gc_loc
         self.use_gc = use_gc
         self.gc_conv_only=gc_conv_only
@@ -136,6 +185,9 @@ class PlainRAdam(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            if use_foreach(self.foreach, group):
+                self._step_foreach(group)
+                continue
 
             for p in group['params']:
                 if p.grad is None:
@@ -193,4 +245,32 @@ class PlainRAdam(Optimizer):
                 p_data_fp32.add_( G_grad, alpha=-step_size * group['lr'])                   
                     #p_data_fp32.addcdiv_(-step_size, exp_avg, denom)
                 p.data.copy_(p_data_fp32)
-        return loss
\ No newline at end of file
+        return loss
+
+    def _step_foreach(self, group):
+        beta1, beta2 = group['betas']
+        for step, params, params_fp32, exp_avgs, exp_avg_sqs in fp32_moments(self, group, 'RAdam'):
+            beta2_t = beta2 ** step
+            N_sma_max = 2 / (1 - beta2) - 1
+            N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+
+            # more conservative since it's an approximated value
+            if N_sma >= 5:
+                step_size = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma
+                                                    * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+                denom = torch._foreach_sqrt(exp_avg_sqs)
+                torch._foreach_add_(denom, group['eps'])
+                G_grad = torch._foreach_div(exp_avgs, denom)
+            elif self.degenerated_to_sgd:
+                step_size = group['lr'] / (1 - beta1 ** step)
+                G_grad = exp_avgs
+            else:
+                # no update, G_grad being undefined in the loop
+                continue
+
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(G_grad, [p.data for p in params], alpha=group['weight_decay'])
+            if self.gc_loc == False:
+                centralized_gradients(G_grad, use_gc=self.use_gc, gc_conv_only=self.gc_conv_only)
+            # the learning rate applied twice, as by the loop
+            update_fp32(params, params_fp32, G_grad, -step_size * group['lr'])
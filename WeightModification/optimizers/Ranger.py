@@ -1,7 +1,8 @@
 import math
 import torch
 from torch.optim.optimizer import Optimizer
-from .Centralization import centralized_gradient
+from .Centralization import centralized_gradient, centralized_gradients
+from .MultiTensor import fp32_moments, update_fp32, foreach_copy_, use_foreach
 
 
 class Ranger(Optimizer):
@@ -10,7 +11,9 @@ class Ranger(Optimizer):
                  alpha=0.5, k=6, N_sma_threshhold=5,           # Ranger options
                  betas=(.95, 0.999), eps=1e-5, weight_decay=0,  # Adam options
                  # Gradient centralization on or off, applied to conv layers only or conv + fc layers
-                 use_gc=False, gc_conv_only=False,gc_loc=False
+                 use_gc=False, gc_conv_only=False,gc_loc=False,
+                 # multi-tensor ops rather than a loop over the parameters of each group, None for CUDA params only
+                 foreach=None
                  ):
 
         # parameter checks
@@ -48,6 +51,7 @@ class Ranger(Optimizer):
         self.gc_loc=gc_loc
         self.use_gc = use_gc
         self.gc_conv_only=gc_conv_only
+        self.foreach = foreach
         # level of gradient centralization
         #self.gc_gradient_threshold = 3 if gc_conv_only else 1
 
@@ -72,6 +76,9 @@ class Ranger(Optimizer):
 
         # Evaluate averages and grad, update param tensors
         for group in self.param_groups:
+            if use_foreach(self.foreach, group):
+                self._step_foreach(group)
+                continue
 
             for p in group['params']:
                 if p.grad is None:
@@ -170,4 +177,55 @@ class Ranger(Optimizer):
                     # copy interpolated weights to RAdam param tensor
                     p.data.copy_(slow_p)
 
-        return loss
\ No newline at end of file
+        return loss
+
+    @staticmethod
+    def _init_slow_buffer(p, state):
+        # look ahead weight storage now in state dict
+        state['slow_buffer'] = torch.empty_like(p.data)
+        state['slow_buffer'].copy_(p.data)
+
+    def _step_foreach(self, group):
+        beta1, beta2 = group['betas']
+        for step, params, params_fp32, exp_avgs, exp_avg_sqs in fp32_moments(self, group, 'Ranger optimizer',
+                                                                              self._init_slow_buffer):
+            buffered = self.radam_buffer[int(step % 10)]
+            if step == buffered[0]:
+                N_sma, step_size = buffered[1], buffered[2]
+            else:
+                buffered[0] = step
+                beta2_t = beta2 ** step
+                N_sma_max = 2 / (1 - beta2) - 1
+                N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+                buffered[1] = N_sma
+                if N_sma > self.N_sma_threshhold:
+                    step_size = math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (
+                        N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+                else:
+                    step_size = 1.0 / (1 - beta1 ** step)
+                buffered[2] = step_size
+
+            # apply lr
+            if N_sma > self.N_sma_threshhold:
+                denom = torch._foreach_sqrt(exp_avg_sqs)
+                torch._foreach_add_(denom, group['eps'])
+                G_grad = torch._foreach_div(exp_avgs, denom)
+            else:
+                # the moving averages themselves, modified in place below as by the loop
+                G_grad = exp_avgs
+
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(G_grad, params_fp32, alpha=group['weight_decay'])
+            #GC operation
+            if self.gc_loc == False:
+                centralized_gradients(G_grad, use_gc=self.use_gc, gc_conv_only=self.gc_conv_only)
+            update_fp32(params, params_fp32, G_grad, -step_size * group['lr'])
+
+            # integrated look ahead, the params of a split sharing their step
+            if step % group['k'] == 0:
+                slow_ps = [self.state[p]['slow_buffer'] for p in params]
+                fast_ps = [p.data for p in params]
+                # (fast weights - slow weights) * alpha
+                torch._foreach_add_(slow_ps, torch._foreach_sub(fast_ps, slow_ps), alpha=self.alpha)
+                # copy interpolated weights to RAdam param tensor
+                foreach_copy_(fast_ps, slow_ps)
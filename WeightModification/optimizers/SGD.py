@@ -1,7 +1,8 @@
 import torch
 from torch.optim.optimizer import Optimizer, required
 
-from .Centralization import centralized_gradient
+from .Centralization import centralized_gradient, centralized_gradients
+from .MultiTensor import params_with_grad, use_foreach
 
 class SGD(Optimizer):
     r"""Implements stochastic gradient descent (optionally with momentum).
@@ -17,6 +18,8 @@ class SGD(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         dampening (float, optional): dampening for momentum (default: 0)
         nesterov (bool, optional): enables Nesterov momentum (default: False)
+        foreach (bool, optional): updates each group by multi-tensor ops rather than
+            a loop over its parameters, None for the groups of CUDA params only (default: None)
 
     Example:
         >>> optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
@@ -54,7 +57,7 @@ class SGD(Optimizer):
     """
 
     def __init__(self, params, lr=required, momentum=0, dampening=0,
-                 weight_decay=0, nesterov=False, use_gc=False, gc_conv_only=False):
+                 weight_decay=0, nesterov=False, use_gc=False, gc_conv_only=False, foreach=None):
         if lr is not required and lr < 0.0:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if momentum < 0.0:
@@ -67,6 +70,8 @@ class SGD(Optimizer):
         if nesterov and (momentum <= 0 or dampening != 0):
             raise ValueError("Nesterov momentum requires a momentum and zero dampening")
         super(SGD, self).__init__(params, defaults)
+        # not a default of the groups, which would change their state_dict
+        self.foreach = foreach
 
     def __setstate__(self, state):
         super(SGD, self).__setstate__(state)
@@ -87,6 +92,9 @@ class SGD(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
+            if use_foreach(self.foreach, group):
+                self._step_foreach(group)
+                continue
             weight_decay = group['weight_decay']
             momentum = group['momentum']
             dampening = group['dampening']
@@ -118,3 +126,39 @@ class SGD(Optimizer):
                 p.add_(d_p, alpha=-group['lr'])
 
         return loss
+
+    def _step_foreach(self, group):
+        weight_decay = group['weight_decay']
+        momentum = group['momentum']
+        dampening = group['dampening']
+        nesterov = group['nesterov']
+
+        params = params_with_grad(group, 'SGD')
+        if len(params) == 0:
+            return
+        d_p_list = [p.grad for p in params]
+        if weight_decay != 0:
+            d_p_list = torch._foreach_add(d_p_list, params, alpha=weight_decay)
+
+        #GC operation
+        centralized_gradients(d_p_list, use_gc=group['use_gc'], gc_conv_only=group['gc_conv_only'])
+
+        if momentum != 0:
+            bufs, updated_bufs, updated_d_p_list = [], [], []
+            for p, d_p in zip(params, d_p_list):
+                param_state = self.state[p]
+                if 'momentum_buffer' not in param_state:
+                    param_state['momentum_buffer'] = torch.clone(d_p).detach()
+                else:
+                    updated_bufs.append(param_state['momentum_buffer'])
+                    updated_d_p_list.append(d_p)
+                bufs.append(param_state['momentum_buffer'])
+            if len(updated_bufs) > 0:
+                torch._foreach_mul_(updated_bufs, momentum)
+                torch._foreach_add_(updated_bufs, updated_d_p_list, alpha=1 - dampening)
+            if nesterov:
+                d_p_list = torch._foreach_add(d_p_list, bufs, alpha=momentum)
+            else:
+                d_p_list = bufs
+
+        torch._foreach_add_(params, d_p_list, alpha=-group['lr'])
@@ -0,0 +1,159 @@
+# encoding: utf-8
+import copy
+import math
+import time
+from collections import OrderedDict
+
+import torch
+
+from WeightModification.optimizers import SGD, Adam, AdamW, RAdam, PlainRAdam, Ranger
+from WeightModification.optimizers.Lookahead import Lookahead
+
+'''
+Equivalence and speed of the multi-tensor steps of the optimizers against their former loops over the parameters,
+including the GC before (gc_loc) or after the moments, and the resumption of either from the state_dict of the other.
+run by: python -m WeightModification.optimizers.benchmark braidmgn braidosnet
+'''
+
+OPTIMIZERS = OrderedDict([
+    ('SGD', lambda params, foreach: SGD(params, lr=0.1, momentum=0.9, weight_decay=5e-4, use_gc=True,
+                                       foreach=foreach)),
+    ('SGD nesterov, gc of convs', lambda params, foreach: SGD(params, lr=0.1, momentum=0.9, weight_decay=5e-4,
+                                                              nesterov=True, use_gc=True, gc_conv_only=True,
+                                                              foreach=foreach)),
+    ('Adam', lambda params, foreach: Adam(params, lr=1e-3, weight_decay=5e-4, use_gc=True, gc_loc=False,
+                                         foreach=foreach)),
+    ('Adam amsgrad, gc_loc', lambda params, foreach: Adam(params, lr=1e-3, weight_decay=5e-4, amsgrad=True,
+                                                          use_gc=True, gc_loc=True, foreach=foreach)),
+    ('AdamW', lambda params, foreach: AdamW(params, lr=1e-3, weight_decay=5e-4, use_gc=True, gc_loc=False,
+                                           foreach=foreach)),
+    ('AdamW gc_loc', lambda params, foreach: AdamW(params, lr=1e-3, weight_decay=5e-4, use_gc=True, gc_loc=True,
+                                                  foreach=foreach)),
+    ('RAdam', lambda params, foreach: RAdam(params, lr=1e-3, weight_decay=5e-4, use_gc=True, gc_loc=False,
+                                           foreach=foreach)),
+    ('RAdam gc_loc', lambda params, foreach: RAdam(params, lr=1e-3, weight_decay=5e-4, use_gc=True, gc_loc=True,
+                                                  foreach=foreach)),
+    ('PlainRAdam', lambda params, foreach: PlainRAdam(params, lr=1e-3, weight_decay=5e-4, use_gc=True,
+                                                     foreach=foreach)),
+    ('Ranger', lambda params, foreach: Ranger(params, lr=1e-3, k=3, weight_decay=5e-4, use_gc=True,
+                                             foreach=foreach)),
+    ('Lookahead(SGD)', lambda params, foreach: Lookahead(SGD(params, lr=0.1, momentum=0.9, use_gc=True,
+                                                             foreach=foreach), k=3, foreach=foreach)),
+])
+
+# convolutions, BN and fc layers, several of each shape
+SHAPES = [(64, 3, 7, 7)] + [(64, 64, 3, 3)] * 6 + [(256, 64, 1, 1)] * 4 + [(64, )] * 24 + [(256, )] * 8 + \
+         [(512, 256)] * 3 + [(512, )] * 3 + [(1, 512)]
+
+
+def _params(shapes):
+    return [torch.randn(shape).requires_grad_() for shape in shapes]
+
+
+def _set_grads(params, grads):
+    for p, g in zip(params, grads):
+        p.grad = None if g is None else g.clone()
+
+
+def _assert_close(a, b, name):
+    if isinstance(a, torch.Tensor):
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-6), '{0} differs'.format(name)
+    elif isinstance(a, dict):
+        assert sorted(a.keys(), key=str) == sorted(b.keys(), key=str), 'the keys of {0} differ'.format(name)
+        for k in a:
+            _assert_close(a[k], b[k], '{0}.{1}'.format(name, k))
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b), 'the lengths of {0} differ'.format(name)
+        for i, (x, y) in enumerate(zip(a, b)):
+            _assert_close(x, y, '{0}[{1}]'.format(name, i))
+    elif isinstance(a, float):
+        assert math.isclose(a, b, rel_tol=1e-6), '{0} differs'.format(name)
+    else:
+        assert a == b, '{0} differs'.format(name)
+
+
+def _state(optimizer):
+    """the state_dict, but the slow params of Lookahead, which are keyed by the ids of the params, in their order"""
+    if isinstance(optimizer, Lookahead):
+        return [optimizer.optimizer.state_dict(),
+                [optimizer.state[p]['slow_param'] for group in optimizer.param_groups for p in group['params']]]
+    return optimizer.state_dict()
+
+
+def _step(optimizers, params_list, grads):
+    for optimizer, params in zip(optimizers, params_list):
+        _set_grads(params, grads)
+        optimizer.step()
+
+
+def check_equivalence(name, steps=8):
+    """steps enough for the RAdam variants to leave their SGD warmup, the last param without gradients"""
+    torch.manual_seed(0)
+    factory = OPTIMIZERS[name]
+    params = _params(SHAPES)
+    reference = [p.detach().clone().requires_grad_() for p in params]
+    optimizers = [factory(params, True), factory(reference, False)]
+    for step in range(steps):
+        grads = [torch.randn_like(p) for p in params[:-1]] + [None]
+        _step(optimizers, (params, reference), grads)
+        _assert_close(params, reference, '{0} params at step {1}'.format(name, step))
+    _assert_close(_state(optimizers[0]), _state(optimizers[1]), '{0} state_dict'.format(name))
+    if isinstance(optimizers[0], Lookahead):
+        return
+
+    # each resumes from the state_dict of the other
+    resumed = [factory(params, True), factory(reference, False)]
+    resumed[0].load_state_dict(copy.deepcopy(optimizers[1].state_dict()))
+    resumed[1].load_state_dict(copy.deepcopy(optimizers[0].state_dict()))
+    grads = [torch.randn_like(p) for p in params]
+    _step(resumed, (params, reference), grads)
+    _assert_close(params, reference, '{0} params after resuming'.format(name))
+
+
+def _time(optimizer, params, grads, repeat):
+    _set_grads(params, grads)
+    optimizer.step()
+    if params[0].is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        optimizer.step()
+    if params[0].is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat
+
+
+def benchmark(name, params, repeat=20):
+    """time per step of the loop and of the multi-tensor ops on copies of params"""
+    grads = [torch.randn_like(p) for p in params]
+    times = []
+    for foreach in (False, True):
+        copies = [p.detach().clone().requires_grad_() for p in params]
+        times.append(_time(OPTIMIZERS[name](copies, foreach), copies, grads, repeat))
+    print('{0}: {1:.2f}ms -> {2:.2f}ms (x{3:.2f})'.format(name, times[0] * 1000., times[1] * 1000.,
+                                                         times[0] / times[1]))
+
+
+def main():
+    import sys
+
+    from config import opt
+    from PrimaryObjectsFactory.model_with_optimizer_generator import get_model_with_optimizer
+
+    for name in OPTIMIZERS:
+        check_equivalence(name)
+    print('the multi-tensor steps are equivalent to the loops.')
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    for model_name in sys.argv[1:] or ['braidmgn']:
+        opt.model_name = model_name
+        net = get_model_with_optimizer(opt, naive=True).to(device)
+        params = [p for p in net.parameters() if p.requires_grad]
+        print('{0}: {1} parameter tensors of {2} shapes'.format(model_name, len(params),
+                                                                len(set(p.size() for p in params))))
+        for name in OPTIMIZERS:
+            benchmark(name, params)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,15 +7,31 @@ from pprint import pprint
 class DefaultConfig(object):
     seed = 0
     gpus = [0, 1]
+    distributed = False  # one process per gpu (or cpu), launched by torchrun, see Utils/distributed.py
+    dist_backend = None  # nccl on gpus and gloo on cpus if None
 
     # Dataset options
     dataset = 'market1501'
     datatype = 'person'
     augmentation = None  # 'Cutout' or 'RandomErasing' or None
+    batch_augment = False  # flip, normalize and augment training images batch by batch after collation
     mode = 'retrieval'
     pos_rate = 0.5
+    hard_mining = False  # in pair mode, draw hard pairs from a bank of training features
+    hard_rate = 0.5  # the ratio of hard pairs to all pairs
+    hard_neg_candidates = 10  # hard negatives are drawn from the nearest samples of other identities
+    bank_refresh = 5  # refresh the feature bank every bank_refresh epochs
+    bank_dim = 128  # the features are randomly projected to bank_dim dims in the bank
     num_instances = 4
+    ids_per_batch = 0  # identities per batch in the cross modes, train_batch // num_instances if 0
     workers = 8
+    device_prefetch = True  # copy the next training batch to the device while the current step runs (not srl)
+    io_threads = 0  # threads per loader worker reading and decoding the images of a batch concurrently
+    io_retries = 5  # retries with exponential backoff when an image can not be read
+    io_fallback = False  # substitute a blank image for an unreadable one instead of raising the IOError
+    shards_dir = None  # pack the images into a few large shard files under this directory and read them from there
+    shard_size = 256  # MB per shard
+    shuffle_buffer = 2048  # size of the shuffle buffer when the shards are read sequentially
 
     # optimization options
     loss = 'bce'  # bce / triplet / ce / lsce
@@ -26,6 +42,12 @@ class DefaultConfig(object):
     train_batch = 256
     train_phase_num = 1  # 1 / 2
     train_mode = 'pair'  # 'pair' or 'cross' or 'normal'
+    dedup_pairs = False  # in pair mode, read and extract each distinct image of a batch only once
+    dedup_images = False  # in phase-two pair training (not srl), extract the images drawn repeatedly in a batch once
+    cross_chunk = 0  # in cross mode, compare pairs by chunks of this size with checkpointing, 0 for all at once
+    cross_pair_budget = 0  # in cross mode, at most this many pairs get gradients, 0 for all
+    # either of the two above freezes the BN statistics of the metric (see BraidCrossTrainer._frozen_metric)
+    cross_hard_ratio = 0.5  # the ratio of the hardest negatives to all in the pair budget, the rest are random
     freeze_pretrained_untill = -1  # =0, 1, 2... <=0 when always freeze pretrained
     lr = 0.4
     gamma = 0.5
@@ -34,6 +56,7 @@ class DefaultConfig(object):
     weight_decay = 5e-4
     momentum = 0.9
     margin = None
+    amp = False  # mixed precision, float16 autocast with a GradScaler on CUDA, bfloat16 autocast on CPU
 
     # Batch Normalization Settings
     bn_momentum = 0.1
@@ -121,6 +144,7 @@ class DefaultConfig(object):
     pretrained_subparams = False
     pretrained_model = None
     disable_resume = False
+    step_checkpoint = 0  # save a checkpoint resumable at the exact iteration every step_checkpoint steps, 0 to disable
     zero_tail_weight = False
     tail_times = 1
     
@@ -131,9 +155,12 @@ class DefaultConfig(object):
 
     evaluate = False
     check_discriminant = ''
+    probe_solver = 'linearsvc'  # linearsvc / sgd, the linear probes of check_discriminant
+    probe_workers = 0  # processes fitting the probes of check_discriminant, <=0 for all cpus
     check_element_discriminant = ''
     check_pair_effect = ''
     sort_pairs_by_scores = ''
+    render_workers = 0  # processes rendering the figures of sort_pairs_by_scores, <=0 for all cpus
 
     def parse_(self, kwargs):
         for k, v in kwargs.items():
@@ -157,6 +184,12 @@ class DefaultConfig(object):
         if isinstance(self.gpus, int):
             self.gpus = (self.gpus,)
 
+        # the batches of SRL are drawn by the sampler in the main process from the pos_rate of the previous step,
+        # which a prefetch would draw ahead of its update
+        if self.srl and self.device_prefetch:
+            print('In SRL mode, the training batches are not prefetched to the device.')
+            self.device_prefetch = False
+
         if self.model_name == 'braidmgn':
             self.pretrained_subparams = True
 